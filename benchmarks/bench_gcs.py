@@ -0,0 +1,137 @@
+"""
+GCS listing and download throughput against the in-process fakes.
+
+Lists a fake bucket page by page, then downloads every object with GcsClient
+at several concurrency levels, and reports objects and megabytes per second.
+The naive baseline is one unpooled ``requests.get`` per object, reading the
+whole body into memory before writing it.
+
+    python -m benchmarks.bench_gcs [--objects 200] [--size-kb 256] [--latency-ms 5]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict
+
+from benchmarks.fakes import FakeGcs, FakeUpstreams
+
+CONCURRENCY_LEVELS = (1, 4, 16)
+
+
+def _client(fake: FakeUpstreams, gcs: FakeGcs, pool_maxsize: int):
+    from scalesec_gcp_workload_identity.gcs import GcsClient #pylint: disable=import-outside-toplevel
+    from scalesec_gcp_workload_identity.main import TokenService #pylint: disable=import-outside-toplevel
+
+    token_service = TokenService(
+        gcp_project_number="123456789123",
+        gcp_workload_id="pool",
+        gcp_workload_provider="provider",
+        gcp_service_account_email="sa@project.iam.gserviceaccount.com",
+        aws_account_id="123456789123",
+        aws_role_name="role",
+        aws_region="us-east-1",
+        **fake.token_service_kwargs()
+    )
+    return GcsClient(token_service, endpoint=gcs.base_url, pool_maxsize=pool_maxsize)
+
+
+def _naive_download(client, names, directory: str) -> None:
+    """
+    The pattern of the original example: a new connection per request, whole bodies in memory
+    """
+    import requests #pylint: disable=import-error,import-outside-toplevel
+
+    for name in names:
+        token, _ = client.token_service.get_token()
+        response = requests.get(
+            client._object_url("bucket", name), #pylint: disable=protected-access
+            params={"alt": "media"},
+            headers={"authorization": "Bearer " + token},
+            timeout=30
+            )
+        response.raise_for_status()
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as output_file:
+            output_file.write(response.content)
+
+
+def run( #pylint: disable=too-many-locals
+    objects: int,
+    size_kb: int,
+    page_size: int,
+    latency_ms: float
+    ) -> Dict[str, float]:
+    """
+    Run every scenario and return the metrics
+    """
+    names = [f"data/{index:06d}.bin" for index in range(objects)]
+    megabytes = objects * size_kb / 1024
+    results: Dict[str, float] = {"objects": objects, "object_size_kb": size_kb}
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIAFAKEBENCH")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake-secret")
+
+    with FakeUpstreams() as fake, \
+            FakeGcs(FakeGcs.generate(names, size_kb * 1024), latency=latency_ms / 1000) as gcs:
+        client = _client(fake, gcs, max(CONCURRENCY_LEVELS))
+        client.token_service.get_token()
+
+        start = time.perf_counter()
+        listed = sum(1 for _ in client.list_objects("bucket", page_size=page_size))
+        elapsed = time.perf_counter() - start
+        assert listed == objects
+        results["list_objects_per_sec"] = round(objects / elapsed, 1)
+
+        directory = tempfile.mkdtemp(prefix="bench-gcs-")
+        try:
+            start = time.perf_counter()
+            _naive_download(client, names, directory)
+            elapsed = time.perf_counter() - start
+            results["naive_objects_per_sec"] = round(objects / elapsed, 1)
+            results["naive_mb_per_sec"] = round(megabytes / elapsed, 1)
+
+            for concurrency in CONCURRENCY_LEVELS:
+                shutil.rmtree(directory)
+                start = time.perf_counter()
+                failed = sum(
+                    1 for result in client.download_many(
+                        "bucket", client.list_objects("bucket", page_size=page_size),
+                        directory, max_workers=concurrency
+                        )
+                    if result.error is not None
+                    )
+                elapsed = time.perf_counter() - start
+                assert not failed
+                results[f"objects_per_sec_c{concurrency}"] = round(objects / elapsed, 1)
+                results[f"mb_per_sec_c{concurrency}"] = round(megabytes / elapsed, 1)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        results["token_mints"] = fake.calls["iam_credentials"]
+
+    return results
+
+
+def main(argv=None) -> int:
+    """
+    Print the metrics as JSON
+    """
+    parser = argparse.ArgumentParser(description="GCS throughput benchmark against a fake GCS")
+    parser.add_argument("--objects", type=int, default=200)
+    parser.add_argument("--size-kb", type=int, default=256)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="latency of every request")
+    args = parser.parse_args(argv)
+
+    print(json.dumps(run(args.objects, args.size_kb, args.page_size, args.latency_ms), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+Import and construction time benchmark.
+
+Measures, in fresh interpreters, how long it takes to import
+``scalesec_gcp_workload_identity.main`` and construct a TokenService,
+and fails if boto3, botocore or requests were loaded along the way.
+
+    python -m benchmarks.bench_import [--runs 10] [--max-ms 150]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ("boto3", "botocore", "requests")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from scalesec_gcp_workload_identity.main import TokenService
+imported = time.perf_counter()
+TokenService("1", "pool", "provider", "sa@p.iam.gserviceaccount.com", "1", "role", "us-east-1")
+constructed = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "construct_ms": (constructed - imported) * 1000,
+    "heavy_modules": sorted(m for m in %r if m in sys.modules)
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure(runs: int) -> dict:
+    """
+    Run the probe ``runs`` times and return the median timings
+    """
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE],
+            check=True,
+            capture_output=True,
+            text=True
+            ).stdout
+        samples.append(json.loads(output))
+
+    return {
+        "import_ms": statistics.median(sample["import_ms"] for sample in samples),
+        "construct_ms": statistics.median(sample["construct_ms"] for sample in samples),
+        "heavy_modules": samples[-1]["heavy_modules"]
+    }
+
+
+def main(argv=None) -> int:
+    """
+    Print the results and return a non-zero exit code on regression
+    """
+    parser = argparse.ArgumentParser(description="Import time benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=150.0,
+                        help="fail if import + construction exceeds this many milliseconds")
+    args = parser.parse_args(argv)
+
+    result = measure(args.runs)
+    print(json.dumps(result, indent=2))
+
+    if result["heavy_modules"]:
+        print(f"FAIL: heavy modules imported eagerly: {result['heavy_modules']}")
+        return 1
+    if result["import_ms"] + result["construct_ms"] > args.max_ms:
+        print(f"FAIL: import + construction slower than {args.max_ms}ms")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
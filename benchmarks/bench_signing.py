@@ -0,0 +1,72 @@
+"""
+Per-mint CPU cost of producing the GetCallerIdentity subject token.
+
+Compares the botocore path (AWSRequest + SigV4Auth, then building the token
+dict, JSON encoding and URL quoting it) with the precomputed
+CallerIdentityTokenBuilder.
+
+    python -m benchmarks.bench_signing [--iterations 20000]
+"""
+
+import argparse
+import datetime
+import json
+import sys
+import timeit
+import urllib.parse
+
+from scalesec_gcp_workload_identity.signing import CallerIdentityTokenBuilder
+from scalesec_gcp_workload_identity.utils import Utils
+
+HOST = "sts.us-east-1.amazonaws.com"
+TARGET = "//iam.googleapis.com/projects/1/locations/global/workloadIdentityPools/p/providers/a"
+CREDENTIALS = ("ASIAEXAMPLE", "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY", "session-token")
+
+
+def botocore_subject_token(utils: Utils, credentials) -> str:
+    """
+    The subject token as built before CallerIdentityTokenBuilder
+    """
+    x_amz_date = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    authorization_header = utils._generate_auth_header(x_amz_date, credentials) #pylint: disable=protected-access
+    caller_identity_token = utils._generate_caller_identity_token( #pylint: disable=protected-access
+        authorization_header,
+        x_amz_date,
+        TARGET,
+        credentials
+        )
+    return urllib.parse.quote(json.dumps(caller_identity_token))
+
+
+def main(argv=None) -> int:
+    """
+    Print the microseconds per subject token for both implementations
+    """
+    parser = argparse.ArgumentParser(description="Subject token signing benchmark")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    from botocore.credentials import ReadOnlyCredentials #pylint: disable=import-error,import-outside-toplevel
+
+    utils = Utils("1", "role", "us-east-1", "POST", HOST, "sa@p.iam.gserviceaccount.com",
+                  sts_region="us-east-1")
+    credentials = ReadOnlyCredentials(*CREDENTIALS)
+    builder = CallerIdentityTokenBuilder(HOST, "us-east-1", TARGET)
+
+    before = timeit.timeit(lambda: botocore_subject_token(utils, credentials),
+                           number=args.iterations)
+    after = timeit.timeit(lambda: builder.build(CREDENTIALS), number=args.iterations)
+
+    result = {
+        "iterations": args.iterations,
+        "botocore_us_per_mint": before / args.iterations * 1e6,
+        "builder_us_per_mint": after / args.iterations * 1e6,
+        "speedup": before / after
+    }
+    print(json.dumps(result, indent=2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
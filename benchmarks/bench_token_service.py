@@ -0,0 +1,236 @@
+"""
+End-to-end TokenService benchmark against the in-process fakes.
+
+Reports p50/p99 latency of cold mints, refreshes and cache hits, mints per
+second at several concurrency levels and upstream calls per token. With
+``--check`` the run fails if it regressed against ``benchmarks/baseline.json``;
+``--update`` rewrites the baseline.
+
+    python -m benchmarks.bench_token_service [--latency-ms 5] [--error-rate 0.01]
+    python -m benchmarks.bench_token_service --check
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Sequence
+
+from benchmarks.fakes import UPSTREAMS, FakeUpstreams, UpstreamBehaviour
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+CONCURRENCY_LEVELS = (1, 4, 16)
+
+# metric -> True if higher is better
+GATED_METRICS = {
+    "cold_mint_p50_ms": False,
+    "refresh_p50_ms": False,
+    "cached_p50_us": False,
+    "upstream_calls_per_cold_token": False,
+    "upstream_calls_per_refresh": False,
+    **{f"mints_per_sec_c{concurrency}": True for concurrency in CONCURRENCY_LEVELS}
+}
+# absolute slack on top of the tolerance, for metrics small enough to be dominated by noise
+ABSOLUTE_SLACK = {
+    "cached_p50_us": 5.0,
+    "refresh_p50_ms": 1.0,
+    "cold_mint_p50_ms": 2.0
+}
+
+
+def percentile(samples: Sequence[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile
+    """
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _timed(func: Callable[[], object], runs: int) -> List[float]:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _token_service(fake: FakeUpstreams, email: str = "sa@project.iam.gserviceaccount.com"):
+    from scalesec_gcp_workload_identity.main import TokenService #pylint: disable=import-outside-toplevel
+
+    return TokenService(
+        gcp_project_number="123456789123",
+        gcp_workload_id="pool",
+        gcp_workload_provider="provider",
+        gcp_service_account_email=email,
+        aws_account_id="123456789123",
+        aws_role_name="role",
+        aws_region="us-east-1",
+        **fake.token_service_kwargs()
+    )
+
+
+def _upstream_calls(fake: FakeUpstreams) -> int:
+    return sum(fake.calls.values())
+
+
+def _get_token(token_service, force_refresh: bool = False) -> bool:
+    try:
+        token_service.get_token(force_refresh=force_refresh)
+    except Exception: #pylint: disable=broad-except
+        return False
+    return True
+
+
+def mints_per_second(fake: FakeUpstreams, concurrency: int, mints: int) -> Dict[str, float]:
+    """
+    Refresh-path mints per second with ``concurrency`` threads, one TokenService each
+    """
+    services = [_token_service(fake, f"sa-{i}@project.iam.gserviceaccount.com")
+                for i in range(concurrency)]
+    for token_service in services:
+        _get_token(token_service)
+
+    failures = []
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(token_service) -> None:
+        barrier.wait()
+        for _ in range(mints):
+            if not _get_token(token_service, force_refresh=True):
+                failures.append(1)
+
+    threads = [threading.Thread(target=worker, args=(token_service,)) for token_service in services]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = concurrency * mints
+    return {
+        "mints_per_sec": (total - len(failures)) / elapsed,
+        "failure_rate": len(failures) / total
+    }
+
+
+def run(runs: int, mints: int, latency_ms: float, error_rate: float) -> Dict[str, object]:
+    """
+    Run every scenario against a fresh set of fakes and return the metrics
+    """
+    # boto3 signs AssumeRole with whatever credentials it finds, the fake does not check them
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIAFAKEBENCHMARK")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake-secret")
+
+    behaviours = {upstream: UpstreamBehaviour(latency_ms / 1000.0, error_rate)
+                  for upstream in UPSTREAMS}
+    results: Dict[str, object] = {"latency_ms": latency_ms, "error_rate": error_rate}
+
+    with FakeUpstreams(behaviours=behaviours, seed=0) as fake:
+        # warm up the shared STS client and HTTP session
+        _get_token(_token_service(fake))
+
+        fake.reset_counters()
+        failures = 0
+        cold = []
+        for _ in range(runs):
+            token_service = _token_service(fake)
+            start = time.perf_counter()
+            failures += not _get_token(token_service)
+            cold.append(time.perf_counter() - start)
+        results["upstream_calls_per_cold_token"] = _upstream_calls(fake) / runs
+        results["cold_mint_p50_ms"] = percentile(cold, 0.50) * 1000
+        results["cold_mint_p99_ms"] = percentile(cold, 0.99) * 1000
+        results["cold_mint_failure_rate"] = failures / runs
+
+        token_service = _token_service(fake)
+        _get_token(token_service)
+        fake.reset_counters()
+
+        refreshes = _timed(lambda: _get_token(token_service, force_refresh=True), runs)
+        results["upstream_calls_per_refresh"] = _upstream_calls(fake) / runs
+        results["refresh_p50_ms"] = percentile(refreshes, 0.50) * 1000
+        results["refresh_p99_ms"] = percentile(refreshes, 0.99) * 1000
+
+        _get_token(token_service)
+        cached = _timed(lambda: _get_token(token_service), runs * 10)
+        results["cached_p50_us"] = percentile(cached, 0.50) * 1e6
+        results["cached_p99_us"] = percentile(cached, 0.99) * 1e6
+
+        for concurrency in CONCURRENCY_LEVELS:
+            throughput = mints_per_second(fake, concurrency, mints)
+            results[f"mints_per_sec_c{concurrency}"] = throughput["mints_per_sec"]
+            results[f"failure_rate_c{concurrency}"] = throughput["failure_rate"]
+
+    return results
+
+
+def regressions(
+    results: Dict[str, object],
+    baseline: Dict[str, object],
+    tolerance: float
+    ) -> List[str]:
+    """
+    Describe every gated metric that is more than ``tolerance`` times worse than the baseline
+    """
+    found = []
+    for metric, higher_is_better in GATED_METRICS.items():
+        if metric not in baseline or metric not in results:
+            continue
+        current, expected = float(results[metric]), float(baseline[metric])
+        if metric.startswith("upstream_calls"):
+            # call counts are deterministic, any increase is a regression
+            worse = current > expected + 1e-9
+        elif higher_is_better:
+            worse = current * tolerance < expected
+        else:
+            worse = current > expected * tolerance + ABSOLUTE_SLACK.get(metric, 0.0)
+        if worse:
+            found.append(f"{metric}: {current:.3f} (baseline {expected:.3f})")
+    return found
+
+
+def main(argv=None) -> int:
+    """
+    Print the metrics as JSON, optionally checking or updating the baseline
+    """
+    parser = argparse.ArgumentParser(description="TokenService benchmark against fake upstreams")
+    parser.add_argument("--runs", type=int, default=50, help="samples per latency scenario")
+    parser.add_argument("--mints", type=int, default=20, help="mints per thread")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency of every upstream")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 503")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="allowed slowdown factor before --check fails")
+    parser.add_argument("--check", action="store_true", help="fail on regressions")
+    parser.add_argument("--update", action="store_true", help="rewrite the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(args.runs, args.mints, args.latency_ms, args.error_rate)
+    print(json.dumps(results, indent=2))
+
+    if args.update:
+        with open(args.baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+            baseline_file.write("\n")
+        return 0
+
+    if args.check:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if found else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,480 @@
+"""
+In-process fakes of AWS STS (AssumeRole), Google STS and IAM Credentials.
+
+One threaded HTTP server answers all three APIs so a TokenService pointed at it
+(``aws_sts_endpoint_url``, ``gcp_sts_endpoint``, ``gcp_iam_credentials_endpoint``)
+runs the full mint path without network access or cloud credentials. Latency
+and error rate are configurable per upstream and every call is counted. The
+fake Google STS rejects subject tokens signed more than 5 minutes away from
+its clock, which can be skewed with ``clock_offset``.
+
+FakeGcs answers the JSON API object listing (paginated) and media downloads
+of Google Cloud Storage for tokens minted by FakeUpstreams.
+"""
+
+import base64
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+AWS_STS = "aws_sts"
+GOOGLE_STS = "google_sts"
+IAM_CREDENTIALS = "iam_credentials"
+UPSTREAMS = (AWS_STS, GOOGLE_STS, IAM_CREDENTIALS)
+
+ASSUME_ROLE_RESPONSE = """<AssumeRoleResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <AssumeRoleResult>
+    <Credentials>
+      <AccessKeyId>ASIAFAKE{suffix}</AccessKeyId>
+      <SecretAccessKey>fake-secret-{suffix}</SecretAccessKey>
+      <SessionToken>fake-session-{suffix}</SessionToken>
+      <Expiration>{expiration}</Expiration>
+    </Credentials>
+    <AssumedRoleUser>
+      <AssumedRoleId>AROAFAKE:{session_name}</AssumedRoleId>
+      <Arn>{role_arn}/{session_name}</Arn>
+    </AssumedRoleUser>
+  </AssumeRoleResult>
+  <ResponseMetadata>
+    <RequestId>{request_id}</RequestId>
+  </ResponseMetadata>
+</AssumeRoleResponse>
+"""
+
+AWS_ERROR_RESPONSE = """<ErrorResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <Error>
+    <Type>Receiver</Type>
+    <Code>ServiceUnavailable</Code>
+    <Message>Service is unable to handle request.</Message>
+  </Error>
+  <RequestId>00000000-0000-0000-0000-000000000000</RequestId>
+</ErrorResponse>
+"""
+
+
+SIGNATURE_WINDOW = 300
+
+
+class UpstreamBehaviour: #pylint: disable=too-few-public-methods
+    """
+    Latency (seconds) and probability of answering 503 for one fake upstream.
+    The next ``fail_next`` calls fail regardless of ``error_rate``.
+    """
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, fail_next: int = 0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fail_next = fail_next
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes a request to the fake upstream it was meant for
+    """
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        pass
+
+    def date_time_string(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time() + self.server.clock_offset
+        return super().date_time_string(timestamp)
+
+    def _send(self, status: int, body: str, content_type: str = "application/json") -> None:
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self): #pylint: disable=invalid-name
+        """
+        Answer AssumeRole, token exchange and generateAccessToken calls
+        """
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8")
+        path = urllib.parse.urlsplit(self.path).path
+
+        if path.startswith("/aws"):
+            upstream = AWS_STS
+        elif path == "/v1beta/token":
+            upstream = GOOGLE_STS
+        elif path.endswith((":generateAccessToken", ":generateIdToken")):
+            upstream = IAM_CREDENTIALS
+        else:
+            self._send(404, json.dumps({"error": {"code": 404, "message": "Not Found"}}))
+            return
+
+        status, response, content_type = self.server.respond(upstream, path, body, self.headers)
+        self._send(status, response, content_type)
+
+
+class FakeUpstreams(ThreadingHTTPServer): #pylint: disable=too-many-instance-attributes
+    """
+    Threaded HTTP server faking the three upstreams of a token mint
+    """
+    daemon_threads = True
+
+    def __init__(
+        self,
+        server_address: Tuple[str, int] = ("127.0.0.1", 0),
+        token_lifetime: int = 3600,
+        behaviours: Optional[Dict[str, UpstreamBehaviour]] = None,
+        seed: Optional[int] = None,
+        clock_offset: float = 0.0
+        ) -> None:
+        super().__init__(server_address, FakeRequestHandler)
+        self.token_lifetime = token_lifetime
+        self.clock_offset = clock_offset
+        self.behaviours = {upstream: UpstreamBehaviour() for upstream in UPSTREAMS}
+        self.behaviours.update(behaviours or {})
+        self.calls = dict.fromkeys(UPSTREAMS, 0)
+        self.errors = dict.fromkeys(UPSTREAMS, 0)
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def base_url(self) -> str:
+        """
+        http://host:port of the server
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def token_service_kwargs(self) -> Dict[str, str]:
+        """
+        TokenService keyword arguments that route every upstream call to this server
+        """
+        return {
+            "aws_sts_endpoint_url": f"{self.base_url}/aws",
+            "gcp_sts_endpoint": f"{self.base_url}/v1beta/token",
+            "gcp_iam_credentials_endpoint": f"{self.base_url}/v1"
+        }
+
+    def start(self) -> None:
+        """
+        Serve in a daemon thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop serving and close the socket
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def reset_counters(self) -> None:
+        """
+        Zero the call and error counters
+        """
+        with self._lock:
+            self.calls = dict.fromkeys(UPSTREAMS, 0)
+            self.errors = dict.fromkeys(UPSTREAMS, 0)
+
+    def respond(self, upstream: str, path: str, body: str, headers) -> Tuple[int, str, str]:
+        """
+        Apply the upstream's latency and error rate, then build its response
+        """
+        behaviour = self.behaviours[upstream]
+        with self._lock:
+            self.calls[upstream] += 1
+            failed = behaviour.error_rate and self._random.random() < behaviour.error_rate
+            if behaviour.fail_next > 0:
+                behaviour.fail_next -= 1
+                failed = True
+            if failed:
+                self.errors[upstream] += 1
+
+        if behaviour.latency:
+            time.sleep(behaviour.latency)
+
+        if failed:
+            if upstream == AWS_STS:
+                return 503, AWS_ERROR_RESPONSE, "text/xml"
+            error = {"error": {"code": 503, "message": "The service is currently unavailable."}}
+            return 503, json.dumps(error), "application/json"
+
+        if upstream == AWS_STS:
+            return 200, self._assume_role(body), "text/xml"
+        if upstream == GOOGLE_STS:
+            return self._exchange_token(body)
+        if path.endswith(":generateIdToken"):
+            return self._generate_id_token(path, body, headers)
+        return self._generate_access_token(path, headers)
+
+    def _now(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=self.clock_offset)
+
+    def _expiration(self) -> str:
+        expiration = self._now() + datetime.timedelta(seconds=self.token_lifetime)
+        return expiration.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def _assume_role(self, body: str) -> str:
+        params = dict(urllib.parse.parse_qsl(body))
+        return ASSUME_ROLE_RESPONSE.format(
+            suffix=uuid.uuid4().hex[:16].upper(),
+            expiration=self._expiration(),
+            session_name=params.get("RoleSessionName", "session"),
+            role_arn=params.get("RoleArn", "arn:aws:iam::000000000000:role/role"),
+            request_id=uuid.uuid4()
+            )
+
+    def _exchange_token(self, body: str) -> Tuple[int, str, str]:
+        data = json.loads(body or "{}")
+        if data.get("subjectTokenType") == "urn:ietf:params:oauth:token-type:access_token":
+            return self._downscope_token(data)
+
+        try:
+            subject_token = json.loads(urllib.parse.unquote(data["subjectToken"]))
+            signed_headers = {header["key"]: header["value"] for header in subject_token["headers"]}
+            signed_at = datetime.datetime.strptime(
+                signed_headers["x-amz-date"], "%Y%m%dT%H%M%SZ"
+                ).replace(tzinfo=datetime.timezone.utc)
+        except (KeyError, TypeError, ValueError):
+            error = {"error": "invalid_request", "error_description": "Invalid subject token"}
+            return 400, json.dumps(error), "application/json"
+
+        if "Authorization" not in signed_headers:
+            error = {"error": "invalid_grant", "error_description": "Unsigned subject token"}
+            return 400, json.dumps(error), "application/json"
+
+        if abs((self._now() - signed_at).total_seconds()) > SIGNATURE_WINDOW:
+            error = {
+                "error": "invalid_grant",
+                "error_description": "Received invalid AWS response of type RequestExpired: "
+                                     "Signature expired: the request date is out of range."
+            }
+            return 400, json.dumps(error), "application/json"
+
+        response = {
+            "access_token": f"fed.{uuid.uuid4().hex}",
+            "issued_token_type": "urn:ietf:params:oauth:token-type:access_token",
+            "token_type": "Bearer",
+            "expires_in": self.token_lifetime
+        }
+        return 200, json.dumps(response), "application/json"
+
+    def _downscope_token(self, data: dict) -> Tuple[int, str, str]:
+        if not str(data.get("subjectToken", "")).startswith("ya29.fake."):
+            error = {"error": "invalid_grant", "error_description": "Invalid subject token"}
+            return 400, json.dumps(error), "application/json"
+
+        try:
+            rules = json.loads(data["options"])["accessBoundary"]["accessBoundaryRules"]
+        except (KeyError, TypeError, ValueError):
+            rules = None
+        if not rules:
+            error = {"error": "invalid_request", "error_description": "Invalid access boundary"}
+            return 400, json.dumps(error), "application/json"
+
+        response = {
+            "access_token": f"ya29.downscoped.{uuid.uuid4().hex}",
+            "issued_token_type": "urn:ietf:params:oauth:token-type:access_token",
+            "token_type": "Bearer",
+            "expires_in": self.token_lifetime
+        }
+        return 200, json.dumps(response), "application/json"
+
+    def _generate_access_token(self, path: str, headers) -> Tuple[int, str, str]:
+        if not (headers.get("Authorization") or "").startswith("Bearer fed."):
+            error = {"error": {"code": 401, "message": "Request had invalid authentication."}}
+            return 401, json.dumps(error), "application/json"
+
+        email = urllib.parse.unquote(path.rsplit("/", 1)[-1].split(":", 1)[0])
+        response = {
+            "accessToken": f"ya29.fake.{email}.{uuid.uuid4().hex}",
+            "expireTime": self._expiration()
+        }
+        return 200, json.dumps(response), "application/json"
+
+    def _generate_id_token(self, path: str, body: str, headers) -> Tuple[int, str, str]:
+        if not (headers.get("Authorization") or "").startswith("Bearer fed."):
+            error = {"error": {"code": 401, "message": "Request had invalid authentication."}}
+            return 401, json.dumps(error), "application/json"
+
+        data = json.loads(body or "{}")
+        if not data.get("audience"):
+            error = {"error": {"code": 400, "message": "audience is required"}}
+            return 400, json.dumps(error), "application/json"
+
+        email = urllib.parse.unquote(path.rsplit("/", 1)[-1].split(":", 1)[0])
+        now = int(self._now().timestamp())
+        claims = {
+            "aud": data["audience"],
+            "iss": "https://accounts.google.com",
+            "sub": "100000000000000000000",
+            "iat": now,
+            "exp": now + min(self.token_lifetime, 3600),
+            "jti": uuid.uuid4().hex
+        }
+        if data.get("includeEmail"):
+            claims.update(email=email, email_verified=True)
+
+        def encode(segment: dict) -> str:
+            raw = json.dumps(segment, separators=(",", ":")).encode("utf-8")
+            return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+        token = f"{encode({'alg': 'RS256', 'typ': 'JWT'})}.{encode(claims)}.fake-signature"
+        return 200, json.dumps({"token": token}), "application/json"
+
+
+class FakeGcsRequestHandler(FakeRequestHandler):
+    """
+    Answers object listings and media downloads
+    """
+    def do_GET(self): #pylint: disable=invalid-name
+        """
+        GET /storage/v1/b/<bucket>/o[/<object>]
+        """
+        split = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(split.query))
+        parts = split.path.split("/")
+        if len(parts) < 6 or parts[1:4] != ["storage", "v1", "b"] or parts[5] != "o":
+            self._send(404, json.dumps({"error": {"code": 404, "message": "Not Found"}}))
+            return
+
+        authorization = self.headers.get("Authorization") or ""
+        if not self.server.authorized(authorization[len("Bearer "):]):
+            error = {"error": {"code": 401, "message": "Invalid Credentials"}}
+            self._send(401, json.dumps(error))
+            return
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if len(parts) == 6 or not parts[6]:
+            self._send(200, json.dumps(self.server.list_page(params)))
+            return
+
+        name = urllib.parse.unquote(parts[6])
+        body = self.server.objects.get(name)
+        if body is None or params.get("alt") != "media":
+            error = {"error": {"code": 404, "message": f"No such object: {name}"}}
+            self._send(404, json.dumps(error))
+            return
+
+        with self.server.lock:
+            self.server.downloads += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        view = memoryview(body)
+        for offset in range(0, len(body), 64 * 1024):
+            self.wfile.write(view[offset:offset + 64 * 1024])
+
+
+class FakeGcs(ThreadingHTTPServer): #pylint: disable=too-many-instance-attributes
+    """
+    Threaded HTTP server holding the objects of a single bucket in memory.
+    Requests must carry a token of the fake IAM Credentials API that is not in ``revoked``.
+    """
+    daemon_threads = True
+
+    def __init__(
+        self,
+        objects: Optional[Dict[str, bytes]] = None,
+        server_address: Tuple[str, int] = ("127.0.0.1", 0),
+        latency: float = 0.0
+        ) -> None:
+        super().__init__(server_address, FakeGcsRequestHandler)
+        self.objects: Dict[str, bytes] = dict(objects or {})
+        self.latency = latency
+        self.revoked: Set[str] = set()
+        self.clock_offset = 0.0
+        self.lock = threading.Lock()
+        self.list_calls = 0
+        self.downloads = 0
+        self.unauthorized = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    @property
+    def base_url(self) -> str:
+        """
+        http://host:port of the server
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @staticmethod
+    def generate(names: Iterable[str], size: int) -> Dict[str, bytes]:
+        """
+        Deterministic pseudo random bodies of ``size`` bytes
+        """
+        objects = {}
+        for name in names:
+            seed = hashlib.sha256(name.encode("utf-8")).digest()
+            objects[name] = (seed * (size // len(seed) + 1))[:size]
+        return objects
+
+    def authorized(self, token: str) -> bool:
+        """
+        True for a token minted by the fake IAM Credentials API that was not revoked
+        """
+        if token.startswith("ya29.fake.") and token not in self.revoked:
+            return True
+        with self.lock:
+            self.unauthorized += 1
+        return False
+
+    def list_page(self, params: Dict[str, str]) -> dict:
+        """
+        One page of the listing, names in lexicographic order
+        """
+        with self.lock:
+            self.list_calls += 1
+        prefix = params.get("prefix", "")
+        names = sorted(name for name in self.objects if name.startswith(prefix))
+        start = int(params.get("pageToken") or 0)
+        end = start + int(params.get("maxResults") or 1000)
+
+        page: dict = {"items": [
+            {
+                "name": name,
+                "size": str(len(self.objects[name])),
+                "generation": "1",
+                "md5Hash": base64.b64encode(hashlib.md5(self.objects[name]).digest()).decode(),
+                "updated": "2021-06-08T00:00:00.000Z"
+            }
+            for name in names[start:end]
+        ]}
+        if end < len(names):
+            page["nextPageToken"] = str(end)
+        return page
@@ -1,20 +1,20 @@
 """
 This is an example script
-to generate a SA access token
-and download objects from a GCS bucket.
+to generate a SA access token,
+list every object in a GCS bucket
+and optionally download them.
 """
 #!/usr/bin/env python
 
-import json
 from os import getenv
-import requests #pylint: disable=import-error
+from scalesec_gcp_workload_identity.gcs import GcsClient #pylint: disable=import-error
 from scalesec_gcp_workload_identity.main import TokenService #pylint: disable=import-error
 
 
 def gcs_object_lister():
     """
-    Generates an access token
-    and downloads objects from a GCS bucket.
+    Lists the objects of a GCS bucket page by page
+    and downloads them if DOWNLOAD_DIR is set.
     """
 
     # The arguments to TokenService can be ingested
@@ -30,30 +30,34 @@ def gcs_object_lister():
         aws_region=getenv('AWS_REGION'),
     )
 
-    # Return our GCP SA access token
-    # This sa_token is used for listing objects in our bucket
-    sa_token, expiry_date = token_service.get_token() #pylint: disable=unused-variable
+    # The client asks token_service for the SA access token on every request,
+    # so the token is renewed transparently during long runs
+    gcs_client = GcsClient(token_service, pool_maxsize=16)
 
     # The name for the bucket we want to list object in
     # Export this as an environment variable
     bucket_name = getenv("BUCKET_NAME")
-
-    # List objects in our bucket using our GCP SA Access token
-    try:
-        files = requests.get(
-            f'https://storage.googleapis.com/storage/v1/b/{bucket_name}/o/?fields=items/name',
-            params={'access_token': sa_token}).json()
-    except Exception as error:
-        print(error)
-        raise
-
-    # Make our object names pretty!
-    object_names = json.dumps(files, indent=4)
-
-    # Print our object names found in our bucket
-    print(f"The items in bucket {bucket_name} are: {object_names} \n")
-
-    print(f"The expiry is: {expiry_date}.")
+    download_dir = getenv("DOWNLOAD_DIR")
+
+    # Pages of 1000 objects are requested as the listing is consumed
+    objects = gcs_client.list_objects(bucket_name, prefix=getenv("PREFIX"))
+
+    if not download_dir:
+        for gcs_object in objects:
+            print(f"{gcs_object.name} ({gcs_object.size} bytes)")
+        return
+
+    # Download 16 objects at a time, streaming each to disk
+    downloaded = failed = 0
+    for result in gcs_client.download_many(bucket_name, objects, download_dir):
+        if result.error is not None:
+            failed += 1
+            print(f"Failed to download {result.name}: {result.error}")
+        else:
+            downloaded += 1
+            print(f"Downloaded {result.name} to {result.path} ({result.size} bytes)")
+
+    print(f"Downloaded {downloaded} objects from bucket {bucket_name}, {failed} failed.")
 
 if __name__ == "__main__":
     gcs_object_lister()
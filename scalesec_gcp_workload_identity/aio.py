@@ -0,0 +1,454 @@
+"""
+asyncio flavour of TokenService.
+
+Requires the optional ``httpx`` dependency:
+``pip install scalesec-gcp-workload-identity[async]``
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from typing import AsyncIterator, Callable, Hashable, Optional, Tuple, TypeVar
+
+try:
+    import httpx #pylint: disable=import-error
+except ImportError: # pragma: no cover
+    httpx = None
+
+from scalesec_gcp_workload_identity import forking
+from scalesec_gcp_workload_identity.cache import CachedToken, TokenCache, parse_expire_time, utcnow
+from scalesec_gcp_workload_identity.circuit import CircuitOpenError
+from scalesec_gcp_workload_identity.instrumentation import (
+    ERROR,
+    FEDERATED_TOKEN,
+    SA_TOKEN,
+    SUCCESS,
+    StageEvent,
+    notify_cache,
+    notify_stage,
+    status_code_of
+)
+from scalesec_gcp_workload_identity.main import TokenService
+from scalesec_gcp_workload_identity.ratelimit import GOOGLE_STS, IAM_CREDENTIALS
+from scalesec_gcp_workload_identity.retry import (
+    retry_after_seconds,
+    server_clock_offset,
+    signature_rejected
+)
+from scalesec_gcp_workload_identity.session import DEFAULT_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@contextlib.asynccontextmanager
+async def _cache_refresh_lock(cache: TokenCache, key: Hashable) -> AsyncIterator[None]:
+    """
+    ``cache.refresh_lock(key)``, e.g. the file lock of a FileTokenCache, acquired
+    in the default executor so waiting for it does not block the event loop
+    """
+    lock = cache.refresh_lock(key)
+    acquire = asyncio.get_running_loop().run_in_executor(None, lock.__enter__)
+    try:
+        await asyncio.shield(acquire)
+    except asyncio.CancelledError:
+        # the executor still takes the lock, release it as soon as it has
+        acquire.add_done_callback(lambda _: lock.__exit__(None, None, None))
+        raise
+
+    try:
+        yield
+    finally:
+        lock.__exit__(None, None, None)
+
+
+class AsyncTokenService:
+    """
+    Mints GCP Service Account Access Tokens without blocking the event loop.
+
+    Takes the same arguments as TokenService, plus an optional ``httpx.AsyncClient``.
+    The AWS leg (AssumeRole and SigV4 signing) runs in the default executor and
+    the Google token exchanges use the async HTTP client. Tokens are cached in
+    the same TokenCache as the wrapped TokenService.
+    """
+    def __init__(
+        self,
+        *args,
+        http_client=None,
+        http2: bool = False,
+        **kwargs
+        ) -> None:
+        if httpx is None and http_client is None:
+            raise ImportError(
+                "AsyncTokenService requires httpx: "
+                "pip install scalesec-gcp-workload-identity[async]"
+                )
+
+        self.token_service = TokenService(*args, **kwargs)
+        self.http2 = http2
+        self.http_pool_maxsize = kwargs.get("http_pool_maxsize", DEFAULT_POOL_SIZE)
+
+        self._http_client = http_client
+        self._owns_http_client = http_client is None
+        self._inflight: Optional[asyncio.Future] = None
+        self._inflight_forced = False
+        forking.register(self)
+
+    def _after_fork_in_child(self) -> None:
+        """
+        The event loop and connections of the parent are unusable in a forked child
+        """
+        self._inflight = None
+        self._inflight_forced = False
+        if self._owns_http_client:
+            self._http_client = None
+
+    def __repr__(self):
+        return f"AsyncTokenService({self.token_service.gcp_sa_token!r})"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    @property
+    def token_cache(self) -> TokenCache:
+        """
+        The cache shared with the wrapped TokenService
+        """
+        return self.token_service.token_cache
+
+    @property
+    def http_client(self):
+        """
+        The async HTTP client, created on first use
+        """
+        if self._http_client is None:
+            timeout = self.token_service.utils.http_timeout
+            if isinstance(timeout, tuple):
+                connect_timeout, read_timeout = timeout
+                timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+            self._http_client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=self.http_pool_maxsize)
+                )
+
+        return self._http_client
+
+    async def aclose(self) -> None:
+        """
+        Close the HTTP client if we created it
+        """
+        if self._owns_http_client and self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+    async def get_token(self, force_refresh: bool = False) -> Tuple[str, str]:
+        """
+        Return a GCP Service Account Access Token
+
+        Concurrent coroutines share a single in-flight mint. A forced refresh
+        only shares a forced one, after a mint in flight finishes a new one is started.
+        """
+        token_service = self.token_service
+        stale = None
+        if not force_refresh:
+            key = token_service._cache_key() #pylint: disable=protected-access
+            cached = token_service.token_cache.get(key, min_ttl=token_service.token_refresh_skew)
+            if token_service._observers: #pylint: disable=protected-access
+                notify_cache(token_service._observers, SA_TOKEN, cached is not None) #pylint: disable=protected-access
+            if cached is not None:
+                logger.debug("Serving cached SA token.")
+                return cached.token, cached.expire_time
+
+            stale = token_service.token_cache.peek(key)
+            circuit_open = token_service._circuit_open() #pylint: disable=protected-access
+            if circuit_open and stale is not None and stale.seconds_remaining() > 0:
+                logger.debug("Circuit open, serving cached SA token.")
+                return stale.token, stale.expire_time
+
+        # a mint started before the force may serve the token that was to be replaced
+        while force_refresh and self._inflight is not None and not self._inflight_forced:
+            await asyncio.wait([self._inflight])
+
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._guarded_refresh(stale, force_refresh))
+            self._inflight_forced = force_refresh
+            self._inflight.add_done_callback(self._clear_inflight)
+
+        # shield so a cancelled caller does not cancel the mint for everybody else
+        cached = await asyncio.shield(self._inflight)
+
+        return cached.token, cached.expire_time
+
+    def _clear_inflight(self, _future: asyncio.Future) -> None:
+        self._inflight = None
+
+    async def _guarded_refresh(self, stale: Optional[CachedToken], force: bool) -> CachedToken:
+        """
+        _refresh through the circuit breaker of the TokenService, see CircuitBreaker.call
+        """
+        breaker = self.token_service.circuit_breaker
+        if breaker is None:
+            return await self._refresh(force)
+
+        usable = stale if stale is not None and stale.seconds_remaining() > 0 else None
+        if not breaker.allow_request():
+            if usable is not None:
+                return usable
+            raise CircuitOpenError("Token refresh circuit is open and no cached token is valid")
+
+        try:
+            cached = await self._refresh(force)
+        except asyncio.CancelledError:
+            # an Exception before Python 3.8, but not an upstream failure
+            breaker.release_probe()
+            raise
+        except Exception as err:
+            breaker.record_failure()
+            if usable is None:
+                raise
+            logger.warning("Token refresh failed (%s), serving the cached token.", err)
+            return usable
+        except BaseException:
+            breaker.release_probe()
+            raise
+
+        breaker.record_success()
+        return cached
+
+    async def _post(
+        self,
+        stage: str,
+        request: Tuple[str, dict, dict],
+        parse: Callable[..., T]
+        ) -> T:
+        """
+        POST a (url, body, headers) request to a Google API and parse the response,
+        retrying and hedging it according to the TokenService retry policy
+        """
+        policy = self.token_service.retry_policy
+        attempt = 1
+        while True:
+            try:
+                return await self._hedged_post(stage, request, parse, attempt)
+            except Exception as err: #pylint: disable=broad-except
+                delay = policy.retry_delay(err, attempt)
+                if delay is None:
+                    raise
+                logger.info("%s attempt %s failed (%s), retrying in %.2fs.",
+                            stage, attempt, err, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _hedged_post(
+        self,
+        stage: str,
+        request: Tuple[str, dict, dict],
+        parse: Callable[..., T],
+        attempt: int
+        ) -> T:
+        hedge_after = self.token_service.retry_policy.hedge_after
+        if hedge_after is None:
+            return await self._attempt(stage, request, parse, attempt)
+
+        pending = {asyncio.ensure_future(self._attempt(stage, request, parse, attempt))}
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if not done:
+            logger.debug("%s slower than %ss, sending a hedged request.", stage, hedge_after)
+            pending.add(asyncio.ensure_future(self._attempt(stage, request, parse, attempt)))
+
+        while True:
+            error = None
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+    async def _attempt(
+        self,
+        stage: str,
+        request: Tuple[str, dict, dict],
+        parse: Callable[..., T],
+        attempt: int
+        ) -> T:
+        """
+        One POST, admitted by the TokenService rate limiter if it has one
+        """
+        token_service = self.token_service
+        rate_limiter = token_service.rate_limiter
+        if rate_limiter is None:
+            return await self._timed_attempt(stage, request, parse, attempt)
+
+        if stage == FEDERATED_TOKEN:
+            endpoint = GOOGLE_STS
+            key = token_service._federated_cache_key() #pylint: disable=protected-access
+        else:
+            endpoint = IAM_CREDENTIALS
+            key = token_service.gcp_service_account_email
+
+        # acquire may block until the bucket refills, wait for it off the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, rate_limiter.acquire, endpoint, key
+            )
+        try:
+            return await self._timed_attempt(stage, request, parse, attempt)
+        except Exception as err:
+            if status_code_of(err) == 429:
+                rate_limiter.throttled(endpoint, retry_after_seconds(err))
+            raise
+
+    async def _timed_attempt(
+        self,
+        stage: str,
+        request: Tuple[str, dict, dict],
+        parse: Callable[..., T],
+        attempt: int
+        ) -> T:
+        """
+        One POST, reported to the observers as ``stage``
+        """
+        url, body, headers = request
+        observers = self.token_service._observers #pylint: disable=protected-access
+        if not observers:
+            return parse(await self.http_client.post(url, json=body, headers=headers))
+
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            result = parse(await self.http_client.post(url, json=body, headers=headers))
+        except Exception as err:
+            notify_stage(observers, StageEvent(
+                stage, time.perf_counter() - start, ERROR, status_code_of(err), attempt, err,
+                start_time
+                ))
+            raise
+
+        notify_stage(observers, StageEvent(
+            stage, time.perf_counter() - start, SUCCESS, 200, attempt, None, start_time
+            ))
+        return result
+
+    async def _exchange_federated_token(self) -> str:
+        token_service = self.token_service
+        utils = token_service.utils
+        issued_at = utcnow()
+        loop = asyncio.get_running_loop()
+
+        resigns = 0
+        while True:
+            # the AWS leg may call sts:AssumeRole through boto3, keep it off the event loop
+            subject_token = await loop.run_in_executor(
+                None,
+                token_service._subject_token #pylint: disable=protected-access
+                )
+
+            # get the federated token from GCP
+            request = utils._federated_token_request( #pylint: disable=protected-access
+                subject_token,
+                token_service.x_goog_cloud_target_resource
+                )
+            try:
+                federated_access_token, expires_in = await self._post(
+                    FEDERATED_TOKEN,
+                    request,
+                    utils._parse_federated_token_response #pylint: disable=protected-access
+                    )
+                break
+            except Exception as err: #pylint: disable=broad-except
+                if resigns >= token_service.retry_policy.max_resigns or not signature_rejected(err):
+                    raise
+
+                offset = server_clock_offset(err)
+                if offset is not None:
+                    token_service.clock_offset = offset
+                resigns += 1
+                logger.warning("Subject token signature rejected, re-signing.")
+
+        token_service._store_federated_token(federated_access_token, expires_in, issued_at) #pylint: disable=protected-access
+
+        return federated_access_token
+
+    async def _get_federated_token(self, force_refresh: bool = False) -> str:
+        """
+        Return a GCP federated token, from the cache when possible,
+        otherwise by running the AWS leg and exchanging the result
+        """
+        token_service = self.token_service
+        if not force_refresh:
+            federated_access_token = token_service._cached_federated_token() #pylint: disable=protected-access
+            if federated_access_token is not None:
+                return federated_access_token
+
+        key = token_service._federated_cache_key() #pylint: disable=protected-access
+        async with _cache_refresh_lock(token_service.federated_token_cache, key):
+            if not force_refresh:
+                cached = token_service.federated_token_cache.peek(key)
+                skew = token_service.token_refresh_skew
+                if cached is not None and cached.seconds_remaining() > skew:
+                    return cached.token
+
+            return await self._exchange_federated_token()
+
+    async def _get_sa_token(self, federated_access_token: str) -> Tuple[str, str]:
+        token_service = self.token_service
+        utils = token_service.utils
+        request = utils._sa_token_request( #pylint: disable=protected-access
+            federated_access_token,
+            token_service.gcp_token_lifetime,
+            token_service.gcp_token_scopes
+            )
+        return await self._post(
+            SA_TOKEN,
+            request,
+            utils._parse_sa_token_response #pylint: disable=protected-access
+            )
+
+    async def _mint_token(self) -> CachedToken:
+        """
+        Run the full AssumeRole -> federation -> SA token exchange
+        """
+        token_service = self.token_service
+        issued_at = utcnow()
+
+        try:
+            sa_token, sa_expire_time = await self._get_sa_token(await self._get_federated_token())
+        except Exception as err: #pylint: disable=broad-except
+            if not token_service._cached_federated_token_rejected(err, issued_at): #pylint: disable=protected-access
+                raise
+
+            logger.info("Cached federated token was rejected, exchanging a new one.")
+            sa_token, sa_expire_time = await self._get_sa_token(
+                await self._get_federated_token(force_refresh=True)
+                )
+
+        return CachedToken(sa_token, sa_expire_time, parse_expire_time(sa_expire_time), issued_at)
+
+    async def _refresh(self, force: bool = False) -> CachedToken:
+        """
+        Mint and cache a new token, unless another process did so while we waited
+        """
+        token_service = self.token_service
+        key = token_service._cache_key() #pylint: disable=protected-access
+        async with _cache_refresh_lock(token_service.token_cache, key):
+            if not force:
+                cached = token_service.token_cache.peek(key)
+                skew = token_service.token_refresh_skew
+                if cached is not None and cached.seconds_remaining() > skew:
+                    return cached
+
+            cached = await self._mint_token()
+            token_service.token_cache.set(key, cached)
+            token_service.gcp_sa_token = cached.token
+
+        return cached
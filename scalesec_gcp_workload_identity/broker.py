@@ -0,0 +1,182 @@
+"""
+Multi-tenant token broker.
+
+Keeps one TokenService per (GCP project, pool, provider, service account,
+AWS account, role, region) in a bounded LRU with idle TTL eviction. The
+tenants share the process wide HTTP session and STS clients, and a single
+federated token cache, so evicting and recreating a tenant is cheap.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+from scalesec_gcp_workload_identity import forking
+from scalesec_gcp_workload_identity.cache import TokenCache
+from scalesec_gcp_workload_identity.main import TokenService
+
+logger = logging.getLogger(__name__)
+
+
+class Tenant(NamedTuple):
+    """
+    Identifies the TokenService of one federation path
+    """
+    gcp_project_number: str
+    gcp_workload_id: str
+    gcp_workload_provider: str
+    gcp_service_account_email: str
+    aws_account_id: str
+    aws_role_name: str
+    aws_region: str
+
+
+class _Entry: #pylint: disable=too-few-public-methods
+    __slots__ = ("token_service", "last_used")
+
+    def __init__(self, token_service: TokenService, last_used: float) -> None:
+        self.token_service = token_service
+        self.last_used = last_used
+
+
+class TokenBroker: #pylint: disable=too-many-instance-attributes
+    """
+    Lazily creates and caches a TokenService per tenant.
+
+    max_size: the most tenants kept, the least recently used is evicted beyond it
+    ttl: seconds a tenant may stay unused before it is evicted (None to disable)
+    service_kwargs: passed to every TokenService, e.g. ``gcp_token_lifetime``,
+        ``retry_policy`` or ``observers``
+
+    Each tenant has its own SA token cache, which is dropped with it.
+    Federated tokens are cached in ``federated_token_cache``, shared by every tenant.
+    """
+    def __init__(
+        self,
+        max_size: int = 256,
+        ttl: Optional[float] = 3600.0,
+        federated_token_cache: Optional[TokenCache] = None,
+        clock: Callable[[], float] = time.monotonic,
+        **service_kwargs: Any
+        ) -> None:
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.federated_token_cache = (
+            federated_token_cache if federated_token_cache is not None else TokenCache()
+            )
+        self.service_kwargs = service_kwargs
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._clock = clock
+        self._entries: "OrderedDict[Tenant, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        forking.register(self)
+
+    def _after_fork_in_child(self) -> None:
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, tenant: Tenant) -> bool:
+        return tenant in self._entries
+
+    def get_service(self, tenant: Tenant) -> TokenService:
+        """
+        Return the TokenService for ``tenant``, creating it if needed
+        """
+        now = self._clock()
+        with self._lock:
+            self._expire(now)
+
+            entry = self._entries.get(tenant)
+            if entry is not None:
+                self.hits += 1
+                entry.last_used = now
+                self._entries.move_to_end(tenant)
+                return entry.token_service
+
+            self.misses += 1
+            token_service = TokenService(
+                **tenant._asdict(),
+                federated_token_cache=self.federated_token_cache,
+                **self.service_kwargs
+                )
+            self._entries[tenant] = _Entry(token_service, now)
+
+            while len(self._entries) > self.max_size:
+                evicted_tenant, evicted = self._entries.popitem(last=False)
+                self.evictions += 1
+                logger.debug("Evicted least recently used tenant %s.", evicted_tenant)
+                self._close(evicted)
+
+        return token_service
+
+    def get_token(self, tenant: Tenant, force_refresh: bool = False) -> Tuple[str, str]:
+        """
+        Return a GCP Service Account Access Token for ``tenant``
+        """
+        return self.get_service(tenant).get_token(force_refresh=force_refresh)
+
+    def evict(self, tenant: Tenant) -> bool:
+        """
+        Drop ``tenant`` and its cached SA tokens, returns whether it was present
+        """
+        with self._lock:
+            entry = self._entries.pop(tenant, None)
+        if entry is None:
+            return False
+        self._close(entry)
+        return True
+
+    def clear(self) -> None:
+        """
+        Drop every tenant
+        """
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            self._close(entry)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the number of tenants and the hit, miss, eviction and expiration counters
+        """
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+    def _expire(self, now: float) -> None:
+        """
+        Evict tenants idle for longer than the TTL, oldest first. Must hold the lock.
+        """
+        if self.ttl is None:
+            return
+        while self._entries:
+            tenant, entry = next(iter(self._entries.items()))
+            if now - entry.last_used <= self.ttl:
+                break
+            del self._entries[tenant]
+            self.expirations += 1
+            logger.debug("Evicted idle tenant %s.", tenant)
+            self._close(entry)
+
+    @staticmethod
+    def _close(entry: _Entry) -> None:
+        # a tenant with a background refresher would otherwise keep minting
+        entry.token_service.stop_background_refresh(timeout=0)
@@ -0,0 +1,420 @@
+"""
+In-memory and file backed caches for GCP service account tokens.
+"""
+
+import base64
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Hashable, Iterator, List, NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None # no cross-process locking on Windows
+
+from scalesec_gcp_workload_identity import forking
+
+logger = logging.getLogger(__name__)
+
+# expired tokens are dropped from a cache on writes, at most this often (seconds)
+PRUNE_INTERVAL = 600.0
+
+
+class CachedToken(NamedTuple):
+    """
+    A token together with its expiry.
+
+    token: str - the access token
+    expire_time: str - the expiry exactly as returned by GCP
+    expires_at: datetime.datetime - the parsed, timezone aware (UTC) expiry
+    issued_at: datetime.datetime - when the token was requested, if known
+    """
+    token: str
+    expire_time: str
+    expires_at: datetime.datetime
+    issued_at: Optional[datetime.datetime] = None
+
+    def seconds_remaining(self, now: Optional[datetime.datetime] = None) -> float:
+        """
+        Seconds until the token expires (negative once it has expired)
+        """
+        if now is None:
+            now = utcnow()
+        return (self.expires_at - now).total_seconds()
+
+
+def utcnow() -> datetime.datetime:
+    """
+    Timezone aware current UTC time
+    """
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def parse_expire_time(expire_time: str) -> datetime.datetime:
+    """
+    Parse an RFC 3339 timestamp as returned by the IAM Credentials API,
+    e.g. ``2021-03-04T05:06:07Z`` or ``2021-03-04T05:06:07.123456789Z``.
+
+    Returns:
+        expires_at: datetime.datetime - timezone aware (UTC) expiry
+    """
+    value = expire_time.strip()
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+
+    # GCP may return nanosecond precision, datetime only supports microseconds
+    if "." in value:
+        head, _, tail = value.partition(".")
+        digits = len(tail) - len(tail.lstrip("0123456789"))
+        fraction, offset = tail[:digits], tail[digits:]
+        value = f"{head}.{fraction[:6].ljust(6, '0')}{offset}"
+
+    try:
+        expires_at = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Unable to parse expireTime: {expire_time!r}') #pylint: disable=raise-missing-from
+
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+
+    return expires_at.astimezone(datetime.timezone.utc)
+
+
+def parse_jwt_expiry(token: str) -> datetime.datetime:
+    """
+    Read the ``exp`` claim of a JWT (e.g. a Google ID token) without verifying it.
+
+    Returns:
+        expires_at: datetime.datetime - timezone aware (UTC) expiry
+    """
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return datetime.datetime.fromtimestamp(int(claims["exp"]), datetime.timezone.utc)
+    except (IndexError, KeyError, TypeError, ValueError):
+        raise ValueError("Unable to read the exp claim of the token") #pylint: disable=raise-missing-from
+
+
+class TokenCache:
+    """
+    Thread-safe in-memory token cache with hit/miss counters.
+    """
+    def __init__(self) -> None:
+        self._tokens: Dict[Hashable, CachedToken] = {}
+        self._lock = threading.Lock()
+        # per-key refresh locks, with the number of threads holding or waiting for each
+        self._refresh_locks: Dict[Hashable, List] = {}
+        self._next_prune = time.monotonic() + PRUNE_INTERVAL
+        self.hits = 0
+        self.misses = 0
+        # forked children keep the cached tokens
+        forking.register(self)
+
+    def _after_fork_in_child(self) -> None:
+        self._lock = threading.Lock()
+        self._refresh_locks = {}
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def __repr__(self):
+        return f"TokenCache(size={len(self)}, hits={self.hits}, misses={self.misses})"
+
+    def get(self, key: Hashable, min_ttl: float = 0.0) -> Optional[CachedToken]:
+        """
+        Return the cached token for ``key`` if it is valid for at least
+        ``min_ttl`` more seconds, otherwise None.
+        """
+        cached = self._tokens.get(key)
+        with self._lock:
+            if cached is not None and cached.seconds_remaining() > min_ttl:
+                self.hits += 1
+                return cached
+            self.misses += 1
+        return None
+
+    def peek(self, key: Hashable) -> Optional[CachedToken]:
+        """
+        Return the cached token for ``key``, even if expired, without touching the counters
+        """
+        return self._tokens.get(key)
+
+    def set(self, key: Hashable, token: CachedToken) -> None:
+        """
+        Store a token in the cache
+        """
+        with self._lock:
+            self._tokens[key] = token
+        self._maybe_prune()
+
+    def prune(self) -> int:
+        """
+        Drop every expired token and return how many were dropped
+        """
+        now = utcnow()
+        with self._lock:
+            expired = [key for key, token in self._tokens.items() if token.expires_at <= now]
+            for key in expired:
+                del self._tokens[key]
+        return len(expired)
+
+    def _maybe_prune(self) -> None:
+        """
+        Prune if PRUNE_INTERVAL has passed since the last time, e.g. so the tokens
+        of many short-lived downscoped boundaries do not accumulate
+        """
+        now = time.monotonic()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + PRUNE_INTERVAL
+
+        pruned = self.prune()
+        if pruned:
+            logger.debug("Pruned %s expired tokens from %r.", pruned, self)
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Drop a single token from the cache
+        """
+        with self._lock:
+            self._tokens.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Drop every cached token and reset the counters
+        """
+        with self._lock:
+            self._tokens.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def refreshing(self, key: Hashable) -> bool:
+        """
+        True while a thread of this process holds or waits for ``refresh_lock(key)``
+        """
+        return key in self._refresh_locks
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the cache size and hit/miss counters
+        """
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
+
+    @contextlib.contextmanager
+    def refresh_lock(self, key: Hashable) -> Iterator[None]:
+        """
+        Held while a token for ``key`` is refreshed, so the threads of every
+        TokenService sharing this cache refresh it once. A lock is dropped
+        once no thread holds or waits for it.
+        """
+        with self._lock:
+            entry = self._refresh_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._refresh_locks[key]
+
+
+def default_cache_directory() -> str:
+    """
+    ``$XDG_CACHE_HOME/scalesec-gcp-workload-identity``, defaulting to ``~/.cache``
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "scalesec-gcp-workload-identity")
+
+
+class FileTokenCache(TokenCache):
+    """
+    Token cache shared by every process on the host through a directory of
+    JSON files. Files are only readable by the owner and are replaced
+    atomically. ``refresh_lock`` takes an exclusive file lock so only one
+    process refreshes a given token at a time.
+    """
+    def __init__(self, directory: Optional[str] = None) -> None:
+        super().__init__()
+        self.directory = directory or default_cache_directory()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def __len__(self) -> int:
+        return sum(1 for name in os.listdir(self.directory) if name.endswith(".json"))
+
+    def __repr__(self):
+        return f"FileTokenCache({self.directory!r}, hits={self.hits}, misses={self.misses})"
+
+    def _path(self, key: Hashable, suffix: str = ".json") -> str:
+        serialized = json.dumps(key if isinstance(key, str) else list(key))
+        digest = hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    def _read(self, key: Hashable) -> Optional[CachedToken]:
+        try:
+            with open(self._path(key), encoding="utf-8") as cache_file:
+                data = json.load(cache_file)
+
+            issued_at = data.get("issued_at")
+            return CachedToken(
+                data["token"],
+                data["expire_time"],
+                datetime.datetime.fromtimestamp(data["expires_at"], datetime.timezone.utc),
+                datetime.datetime.fromtimestamp(issued_at, datetime.timezone.utc)
+                if issued_at is not None else None
+                )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logger.warning("Ignoring unreadable token cache file: %s", err)
+            return None
+
+    def get(self, key: Hashable, min_ttl: float = 0.0) -> Optional[CachedToken]:
+        cached = self._read(key)
+        with self._lock:
+            if cached is not None and cached.seconds_remaining() > min_ttl:
+                self.hits += 1
+                return cached
+            self.misses += 1
+        return None
+
+    def peek(self, key: Hashable) -> Optional[CachedToken]:
+        return self._read(key)
+
+    def set(self, key: Hashable, token: CachedToken) -> None:
+        data = {
+            "token": token.token,
+            "expire_time": token.expire_time,
+            "expires_at": token.expires_at.timestamp(),
+            "issued_at": token.issued_at.timestamp() if token.issued_at is not None else None
+        }
+
+        # mkstemp creates the file with 0600 permissions
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(file_descriptor, "w", encoding="utf-8") as cache_file:
+                json.dump(data, cache_file)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+            raise
+        self._maybe_prune()
+
+    def prune(self) -> int:
+        # lock files go with their expired token, or alone once no refresh holds them
+        now = utcnow().timestamp()
+        digests = {
+            name[:-len(suffix)]
+            for name in os.listdir(self.directory)
+            for suffix in (".json", ".lock")
+            if name.endswith(suffix) and not name.startswith(".")
+        }
+        return sum(1 for digest in digests if self._prune_digest(digest, now))
+
+    def _prune_digest(self, digest: str, now: float) -> bool:
+        """
+        Remove the token file of ``digest`` if it has expired, together with its
+        lock file, under that lock. Return True if a token was removed.
+        """
+        token_path = os.path.join(self.directory, digest + ".json")
+        lock_path = os.path.join(self.directory, digest + ".lock")
+        if self._expires_at(token_path) > now:
+            return False
+
+        lock_fd = None
+        try:
+            if fcntl is not None:
+                lock_fd = _lock_file(lock_path, blocking=False)
+                if lock_fd is None:
+                    # a refresh is under way
+                    return False
+            # a token stored meanwhile is kept
+            expires_at = self._expires_at(token_path)
+            if expires_at > now:
+                return False
+            if lock_fd is not None:
+                os.unlink(lock_path)
+            if expires_at == float("-inf"):
+                return False
+            os.unlink(token_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)
+
+    @staticmethod
+    def _expires_at(token_path: str) -> float:
+        """
+        Expiry timestamp of a token file, -inf if it is missing and inf if it is unreadable
+        """
+        try:
+            with open(token_path, encoding="utf-8") as cache_file:
+                return json.load(cache_file)["expires_at"]
+        except FileNotFoundError:
+            return float("-inf")
+        except (OSError, ValueError, KeyError, TypeError):
+            return float("inf")
+
+    def invalidate(self, key: Hashable) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self._path(key))
+
+    def clear(self) -> None:
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(os.path.join(self.directory, name))
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    @contextlib.contextmanager
+    def refresh_lock(self, key: Hashable) -> Iterator[None]:
+        # threads of this process queue on the in-memory lock, not on the file
+        with super().refresh_lock(key):
+            if fcntl is None:
+                yield
+                return
+
+            lock_fd = _lock_file(self._path(key, ".lock"))
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                os.close(lock_fd)
+
+
+def _lock_file(path: str, blocking: bool = True) -> Optional[int]:
+    """
+    Open ``path`` and take an exclusive lock on it, returning the descriptor, or None
+    if ``blocking`` is False and the lock is held. ``prune`` unlinks lock files, so
+    the lock is retaken until it is on the file currently at ``path``.
+    """
+    operation = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    while True:
+        lock_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, operation)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return None
+
+        try:
+            if os.fstat(lock_fd).st_ino == os.stat(path).st_ino:
+                return lock_fd
+        except FileNotFoundError:
+            pass
+        os.close(lock_fd)
@@ -0,0 +1,188 @@
+"""
+Circuit breaker for token refreshes.
+
+While Google STS or IAM Credentials is failing, a TokenService with a
+CircuitBreaker stops calling it: callers are served the cached token until
+its hard ``expireTime`` instead of waiting on slow failing refreshes, and an
+error is only raised once no valid token is left. After ``reset_timeout``
+seconds a single probe refresh is let through (half-open); its success
+closes the circuit, its failure keeps it open for another ``reset_timeout``.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional, Union
+
+from scalesec_gcp_workload_identity import forking
+from scalesec_gcp_workload_identity.cache import CachedToken
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    The circuit is open and no cached token is valid
+    """
+
+
+class CircuitBreaker: #pylint: disable=too-many-instance-attributes
+    """
+    Tracks refresh failures and decides when refreshes are attempted.
+
+    failure_threshold: consecutive failed refreshes that open the circuit
+    reset_timeout: seconds the circuit stays open before a probe is let through
+
+    One breaker may be shared by several TokenServices calling the same upstreams.
+    """
+    def __init__(
+        self,
+        failure_threshold: int = 1,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic
+        ) -> None:
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened = 0
+        self.short_circuited = 0
+        self.probes = 0
+
+        self._clock = clock
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        forking.register(self)
+
+    def __repr__(self):
+        return f"CircuitBreaker(state={self.state!r}, failures={self.failures})"
+
+    def _after_fork_in_child(self) -> None:
+        self._lock = threading.Lock()
+        # the probe of a parent thread will never report back
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        """
+        closed, open or half_open
+        """
+        with self._lock:
+            if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def is_open(self) -> bool:
+        """
+        True while refreshes are short-circuited and no probe is due
+        """
+        return self.state == OPEN or (self.state == HALF_OPEN and self._probing)
+
+    def allow_request(self) -> bool:
+        """
+        True if a refresh may be attempted. Once ``reset_timeout`` has passed
+        a single caller is let through as the probe.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+
+            if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                self.probes += 1
+                logger.info("Circuit half open, probing the upstream.")
+                return True
+
+            self.short_circuited += 1
+            return False
+
+    def record_success(self) -> None:
+        """
+        A refresh succeeded, close the circuit
+        """
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info("Upstream recovered, circuit closed.")
+            self._state = CLOSED
+            self._probing = False
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        """
+        A refresh failed, open the circuit if the threshold is reached or the probe failed
+        """
+        with self._lock:
+            self.failures += 1
+            if self._state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self.opened += 1
+                    logger.warning(
+                        "Token refresh failing, circuit open for %ss.", self.reset_timeout
+                        )
+                self._state = OPEN
+                self._opened_at = self._clock()
+                self._probing = False
+
+    def release_probe(self) -> None:
+        """
+        A refresh was abandoned without an outcome, e.g. cancelled or interrupted.
+        It is not an upstream failure, but the next caller may probe again.
+        """
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> Dict[str, Union[str, int]]:
+        """
+        Current state and counters
+        """
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened,
+            "short_circuited": self.short_circuited,
+            "probes": self.probes
+        }
+
+    def call(
+        self,
+        mint: Callable[[], CachedToken],
+        stale: Optional[CachedToken] = None
+        ) -> CachedToken:
+        """
+        Return ``mint()`` through the breaker. While the circuit is open, or if
+        the refresh fails, ``stale`` is returned if it has not expired.
+        """
+        usable = stale if stale is not None and stale.seconds_remaining() > 0 else None
+
+        if not self.allow_request():
+            if usable is not None:
+                logger.debug("Circuit open, serving the cached token.")
+                return usable
+            raise CircuitOpenError("Token refresh circuit is open and no cached token is valid")
+
+        try:
+            cached = mint()
+        except Exception as err:
+            self.record_failure()
+            if usable is None:
+                raise
+            logger.warning(
+                "Token refresh failed (%s), serving the cached token for %ds more.",
+                err, usable.seconds_remaining()
+                )
+            return usable
+        except BaseException:
+            # e.g. KeyboardInterrupt
+            self.release_probe()
+            raise
+
+        self.record_success()
+        return cached
@@ -0,0 +1,188 @@
+"""
+Command line entry point printing a GCP Service Account Access Token.
+
+    scalesec-gcp-workload-identity [--format executable|token] [--output-file PATH]
+
+The response follows the executable-sourced credential format (version,
+success, expiration_time, or code and message on failure). It is written to
+the output file (``GOOGLE_EXTERNAL_ACCOUNT_OUTPUT_FILE`` by default) and,
+while the token in that file is valid, repeated invocations print it without
+federating again. A cache hit only imports this module: boto3, botocore and
+requests are not loaded.
+
+The federation is configured from the same environment variables as the
+README (GCP_PROJECT_NUMBER, GCP_WORKLOAD_ID, ...).
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+EXECUTABLE_RESPONSE_VERSION = 1
+ACCESS_TOKEN_TYPE = "urn:ietf:params:oauth:token-type:access_token"
+DEFAULT_SCOPES = "https://www.googleapis.com/auth/cloud-platform"
+
+
+def read_cached_response(path: str, min_ttl: float) -> Optional[dict]:
+    """
+    Return the successful response stored in ``path``
+    if it remains valid for at least ``min_ttl`` seconds
+    """
+    try:
+        with open(path, encoding="utf-8") as output_file:
+            response = json.load(output_file)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        not isinstance(response, dict)
+        or response.get("version") != EXECUTABLE_RESPONSE_VERSION
+        or response.get("success") is not True
+        or not response.get("access_token")
+        or not isinstance(response.get("expiration_time"), int)
+        ):
+        return None
+    if response["expiration_time"] - time.time() < min_ttl:
+        return None
+
+    return response
+
+
+def write_response(path: str, response: dict) -> None:
+    """
+    Atomically write ``response`` to ``path``, readable by the owner only
+    """
+    import tempfile #pylint: disable=import-outside-toplevel
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix=".token-", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w", encoding="utf-8") as tmp_file:
+            json.dump(response, tmp_file)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def mint_response(args: argparse.Namespace) -> dict:
+    """
+    Federate and return a successful executable response
+    """
+    # only loaded on a cache miss
+    from scalesec_gcp_workload_identity.cache import parse_expire_time #pylint: disable=import-outside-toplevel
+    from scalesec_gcp_workload_identity.main import TokenService #pylint: disable=import-outside-toplevel
+
+    environ = os.environ
+    token_service = TokenService(
+        gcp_project_number=environ.get("GCP_PROJECT_NUMBER"),
+        gcp_workload_id=environ.get("GCP_WORKLOAD_ID"),
+        gcp_workload_provider=environ.get("GCP_WORKLOAD_PROVIDER"),
+        gcp_service_account_email=(
+            environ.get("GOOGLE_EXTERNAL_ACCOUNT_IMPERSONATED_EMAIL")
+            or environ.get("GCP_SERVICE_ACCOUNT_EMAIL")
+            ),
+        aws_account_id=environ.get("AWS_ACCOUNT_ID"),
+        aws_role_name=environ.get("AWS_ROLE_NAME"),
+        aws_region=environ.get("AWS_REGION"),
+        gcp_token_lifetime=environ.get("TOKEN_LIFETIME") or "3600s",
+        gcp_token_scopes=environ.get("TOKEN_SCOPES") or DEFAULT_SCOPES,
+        aws_credential_source=args.aws_credential_source
+    )
+    sa_token, expire_time = token_service.get_token()
+
+    return {
+        "version": EXECUTABLE_RESPONSE_VERSION,
+        "success": True,
+        "token_type": ACCESS_TOKEN_TYPE,
+        "access_token": sa_token,
+        "expiration_time": int(parse_expire_time(expire_time).timestamp())
+    }
+
+
+def error_response(err: Exception) -> dict:
+    """
+    Executable response describing a failure
+    """
+    response = getattr(err, "response", None)
+    status_code = getattr(response, "status_code", None)
+    return {
+        "version": EXECUTABLE_RESPONSE_VERSION,
+        "success": False,
+        "code": str(status_code) if status_code is not None else type(err).__name__,
+        "message": str(err)
+    }
+
+
+def render(response: dict, output_format: str) -> str:
+    """
+    The text printed for a successful ``response``
+    """
+    if output_format == "token":
+        return response["access_token"]
+    return json.dumps(response)
+
+
+def main(argv=None) -> int:
+    """
+    Print a token, from the output file when it is still valid
+    """
+    parser = argparse.ArgumentParser(
+        prog="scalesec-gcp-workload-identity",
+        description="Print a GCP Service Account Access Token federated from AWS"
+        )
+    parser.add_argument(
+        "--format",
+        choices=("executable", "token"),
+        default="executable",
+        help="executable-sourced credential JSON, or the bare access token"
+        )
+    parser.add_argument(
+        "--output-file",
+        default=os.environ.get("GOOGLE_EXTERNAL_ACCOUNT_OUTPUT_FILE"),
+        help="response cache, defaults to $GOOGLE_EXTERNAL_ACCOUNT_OUTPUT_FILE"
+        )
+    parser.add_argument(
+        "--min-ttl",
+        type=float,
+        default=300,
+        help="seconds a cached token must remain valid to be reused"
+        )
+    parser.add_argument(
+        "--aws-credential-source",
+        choices=("assume_role", "ambient"),
+        default=os.environ.get("AWS_CREDENTIAL_SOURCE") or "assume_role"
+        )
+    args = parser.parse_args(argv)
+
+    if args.output_file:
+        cached = read_cached_response(args.output_file, args.min_ttl)
+        if cached is not None:
+            print(render(cached, args.format))
+            return 0
+
+    try:
+        response = mint_response(args)
+    except Exception as err: #pylint: disable=broad-except
+        # executable consumers read errors from stdout, a bare token must never be an error
+        stream = sys.stdout if args.format == "executable" else sys.stderr
+        print(json.dumps(error_response(err)), file=stream)
+        return 1
+
+    if args.output_file:
+        try:
+            write_response(args.output_file, response)
+        except OSError as err:
+            print(f"Unable to write {args.output_file}: {err}", file=sys.stderr)
+
+    print(render(response, args.format))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
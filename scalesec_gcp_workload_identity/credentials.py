@@ -0,0 +1,159 @@
+"""
+Ambient AWS credentials read directly from the Lambda environment, the
+ECS/EKS container credentials endpoint or EC2 IMDSv2, without boto3.
+"""
+
+import datetime
+import json
+import logging
+import os
+import threading
+from typing import Dict, Mapping, Optional, Tuple
+
+from scalesec_gcp_workload_identity.cache import parse_expire_time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IMDS_ENDPOINT = "http://169.254.169.254"
+ECS_CONTAINER_ENDPOINT = "http://169.254.170.2"
+IMDS_TOKEN_TTL = 21600
+
+AwsCredentials = Tuple[str, str, str, Optional[datetime.datetime]]
+
+
+class CredentialsNotFound(RuntimeError):
+    """
+    No ambient AWS credentials are available
+    """
+
+
+class AmbientCredentials: #pylint: disable=too-few-public-methods
+    """
+    Resolves the credentials of the role we are already running as.
+
+    Sources are tried in order:
+        1. ``AWS_ACCESS_KEY_ID`` / ``AWS_SECRET_ACCESS_KEY`` / ``AWS_SESSION_TOKEN`` (Lambda)
+        2. ``AWS_CONTAINER_CREDENTIALS_RELATIVE_URI`` / ``_FULL_URI`` (ECS, EKS Pod Identity)
+        3. EC2 instance metadata (IMDSv2), ``AWS_EC2_METADATA_SERVICE_ENDPOINT`` if set
+
+    Calling the instance returns the access key, secret access key, session
+    token and expiration (None for environment credentials).
+    """
+    def __init__(
+        self,
+        imds_endpoint: Optional[str] = None,
+        timeout: float = 1.0,
+        environ: Optional[Mapping[str, str]] = None
+        ) -> None:
+        self.environ = environ if environ is not None else os.environ
+        self.imds_endpoint = (
+            imds_endpoint
+            or self.environ.get("AWS_EC2_METADATA_SERVICE_ENDPOINT")
+            or DEFAULT_IMDS_ENDPOINT
+            ).rstrip("/")
+        self.timeout = timeout
+
+        self._opener = None
+        self._imds_role: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _after_fork_in_child(self) -> None:
+        self._lock = threading.Lock()
+        self._opener = None
+
+    def __call__(self) -> AwsCredentials:
+        with self._lock:
+            credentials = self._from_environment()
+            if credentials is None:
+                credentials = self._from_container()
+            if credentials is None:
+                credentials = self._from_imds()
+
+        return credentials
+
+    def _request(
+        self,
+        url: str,
+        method: str = "GET",
+        headers: Optional[Dict[str, str]] = None
+        ) -> str:
+        import urllib.request #pylint: disable=import-outside-toplevel
+
+        if self._opener is None:
+            # metadata endpoints are link-local, never go through a proxy
+            self._opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+        request = urllib.request.Request(url, method=method, headers=headers or {})
+        with self._opener.open(request, timeout=self.timeout) as response:
+            return response.read().decode("utf-8")
+
+    @staticmethod
+    def _parse(data: dict) -> AwsCredentials:
+        try:
+            expiration = data.get("Expiration")
+            return (
+                data["AccessKeyId"],
+                data["SecretAccessKey"],
+                data["Token"],
+                parse_expire_time(expiration) if expiration else None
+                )
+        except KeyError as err:
+            logger.error("Something went wrong reading ambient credentials")
+            raise err
+
+    def _from_environment(self) -> Optional[AwsCredentials]:
+        access_key = self.environ.get("AWS_ACCESS_KEY_ID")
+        secret_key = self.environ.get("AWS_SECRET_ACCESS_KEY")
+        session_token = self.environ.get("AWS_SESSION_TOKEN")
+
+        # the signed GetCallerIdentity request requires a session token
+        if not (access_key and secret_key and session_token):
+            return None
+
+        logger.debug("Using AWS credentials from the environment.")
+        return access_key, secret_key, session_token, None
+
+    def _from_container(self) -> Optional[AwsCredentials]:
+        relative_uri = self.environ.get("AWS_CONTAINER_CREDENTIALS_RELATIVE_URI")
+        full_uri = self.environ.get("AWS_CONTAINER_CREDENTIALS_FULL_URI")
+        if relative_uri:
+            url = ECS_CONTAINER_ENDPOINT + relative_uri
+        elif full_uri:
+            url = full_uri
+        else:
+            return None
+
+        headers = {}
+        token = self.environ.get("AWS_CONTAINER_AUTHORIZATION_TOKEN")
+        token_file = self.environ.get("AWS_CONTAINER_AUTHORIZATION_TOKEN_FILE")
+        if token_file:
+            with open(token_file, encoding="utf-8") as token_fp:
+                token = token_fp.read().strip()
+        if token:
+            headers["Authorization"] = token
+
+        logger.info("Fetching AWS credentials from the container credentials endpoint.")
+        return self._parse(json.loads(self._request(url, headers=headers)))
+
+    def _from_imds(self) -> AwsCredentials:
+        try:
+            imds_token = self._request(
+                f"{self.imds_endpoint}/latest/api/token",
+                method="PUT",
+                headers={"X-aws-ec2-metadata-token-ttl-seconds": str(IMDS_TOKEN_TTL)}
+                )
+            headers = {"X-aws-ec2-metadata-token": imds_token}
+            base_url = f"{self.imds_endpoint}/latest/meta-data/iam/security-credentials/"
+
+            if self._imds_role is None:
+                self._imds_role = self._request(base_url, headers=headers).splitlines()[0].strip()
+
+            logger.info("Fetching AWS credentials from the instance metadata service.")
+            data = json.loads(self._request(base_url + self._imds_role, headers=headers))
+        except (OSError, IndexError) as err:
+            raise CredentialsNotFound( #pylint: disable=raise-missing-from
+                f"No ambient AWS credentials found in the environment, "
+                f"container endpoint or instance metadata: {err}"
+                )
+
+        return self._parse(data)
@@ -0,0 +1,132 @@
+"""
+Credential Access Boundaries for downscoped tokens.
+
+A Credential Access Boundary restricts which Cloud Storage resources, and
+with which permissions, a token may be used for. Google STS exchanges a
+service account access token and a boundary for a downscoped token that
+expires with the source token. ``TokenService.get_downscoped_token`` caches
+the downscoped tokens by the hash of their boundary, so handing many tenants
+their own bucket or prefix costs one STS call per boundary and token lifetime,
+on top of a single cached SA token.
+
+Deriving downscoped tokens locally from an intermediary token, as the Java
+and C++ auth libraries do, is not supported: it needs the boundary encrypted
+with Tink and its conditions compiled to the protobuf CEL AST.
+
+https://cloud.google.com/iam/docs/downscoping-short-lived-credentials
+"""
+
+import hashlib
+import json
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+ACCESS_TOKEN_TYPE = "urn:ietf:params:oauth:token-type:access_token"
+TOKEN_EXCHANGE_GRANT_TYPE = "urn:ietf:params:oauth:grant-type:token-exchange"
+
+# a Credential Access Boundary may hold up to 10 rules
+MAX_RULES = 10
+
+STORAGE_OBJECT_VIEWER = "inRole:roles/storage.objectViewer"
+
+
+class AvailabilityCondition(NamedTuple):
+    """
+    CEL expression further restricting the resources of a rule
+    """
+    expression: str
+    title: Optional[str] = None
+    description: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        """
+        The JSON representation expected by Google STS
+        """
+        condition = {"expression": self.expression}
+        if self.title:
+            condition["title"] = self.title
+        if self.description:
+            condition["description"] = self.description
+        return condition
+
+
+class AccessBoundaryRule(NamedTuple):
+    """
+    Permissions (``inRole:roles/...``) available on one resource,
+    e.g. ``//storage.googleapis.com/projects/_/buckets/my-bucket``
+    """
+    available_resource: str
+    available_permissions: Tuple[str, ...]
+    availability_condition: Optional[AvailabilityCondition] = None
+
+    def to_dict(self) -> dict:
+        """
+        The JSON representation expected by Google STS
+        """
+        rule = {
+            "availableResource": self.available_resource,
+            "availablePermissions": list(self.available_permissions)
+        }
+        if self.availability_condition is not None:
+            rule["availabilityCondition"] = self.availability_condition.to_dict()
+        return rule
+
+
+class CredentialAccessBoundary:
+    """
+    The rules a downscoped token is restricted to
+    """
+    def __init__(self, rules: Iterable[AccessBoundaryRule]) -> None:
+        self.rules = tuple(rules)
+        if not self.rules:
+            raise ValueError("A Credential Access Boundary needs at least one rule")
+        if len(self.rules) > MAX_RULES:
+            raise ValueError(f"A Credential Access Boundary holds at most {MAX_RULES} rules")
+        for rule in self.rules:
+            if not rule.available_permissions:
+                raise ValueError(f"No permissions for {rule.available_resource}")
+
+        self._json = json.dumps(
+            {"accessBoundary": {"accessBoundaryRules": [rule.to_dict() for rule in self.rules]}},
+            sort_keys=True,
+            separators=(",", ":")
+            )
+        self.hash = hashlib.sha256(self._json.encode("utf-8")).hexdigest()
+
+    def __repr__(self):
+        return f"CredentialAccessBoundary({len(self.rules)} rules, hash={self.hash[:12]})"
+
+    def __eq__(self, other):
+        return isinstance(other, CredentialAccessBoundary) and other.hash == self.hash
+
+    def __hash__(self):
+        return hash(self.hash)
+
+    def to_json(self) -> str:
+        """
+        The ``options`` of the token exchange request, canonically encoded
+        """
+        return self._json
+
+
+def gcs_bucket_rule(
+    bucket: str,
+    prefix: Optional[str] = None,
+    permissions: Iterable[str] = (STORAGE_OBJECT_VIEWER,)
+    ) -> AccessBoundaryRule:
+    """
+    Rule granting ``permissions`` on ``bucket``, restricted to the objects
+    below ``prefix`` if given
+    """
+    condition = None
+    if prefix:
+        escaped = prefix.replace("\\", "\\\\").replace("'", "\\'")
+        condition = AvailabilityCondition(
+            f"resource.name.startsWith('projects/_/buckets/{bucket}/objects/{escaped}')",
+            title=f"{bucket}/{prefix}"[:100]
+            )
+
+    return AccessBoundaryRule(
+        f"//storage.googleapis.com/projects/_/buckets/{bucket}",
+        tuple(permissions),
+        condition
+        )
@@ -0,0 +1,84 @@
+"""
+Fork safety for pre-fork servers (gunicorn ``--preload``) and multiprocessing.
+
+A forked child inherits copies of the parent's locks, possibly held by a
+parent thread that does not exist in the child, and of its pooled sockets,
+which the parent keeps using. Objects registered here have their
+``_after_fork_in_child`` method called in every child created by
+``os.fork``: they replace their locks and drop their clients and connections,
+which are rebuilt on first use. Cached tokens are kept, so children serve
+the token minted by the parent instead of federating on boot.
+
+Objects registered with ``prewarm=True`` have their ``_before_fork`` method
+called in the parent before each fork, e.g. to mint the token the children
+will inherit.
+
+Nothing is registered on platforms without ``os.register_at_fork``.
+"""
+
+import logging
+import os
+import threading
+import weakref
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+_instances: "weakref.WeakSet" = weakref.WeakSet()
+_prewarm: "weakref.WeakSet" = weakref.WeakSet()
+_registry_lock = threading.Lock()
+
+
+def after_fork_in_child(func: Callable[[], None]) -> Callable[[], None]:
+    """
+    Decorator running the module level ``func`` in forked children
+    """
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=func)
+    return func
+
+
+def register(instance, prewarm: bool = False) -> None:
+    """
+    Call ``instance._after_fork_in_child()`` in forked children and, with
+    ``prewarm``, ``instance._before_fork()`` in the parent before forking
+    """
+    with _registry_lock:
+        _instances.add(instance)
+        if prewarm:
+            _prewarm.add(instance)
+
+
+def unregister(instance) -> None:
+    """
+    Stop calling the fork hooks of ``instance``
+    """
+    with _registry_lock:
+        _instances.discard(instance)
+        _prewarm.discard(instance)
+
+
+def _before_fork() -> None:
+    with _registry_lock:
+        instances = list(_prewarm)
+    for instance in instances:
+        try:
+            instance._before_fork() #pylint: disable=protected-access
+        except Exception as err: #pylint: disable=broad-except
+            # a failed pre-warm must not prevent the fork, the children mint on demand
+            logger.warning("Failed to pre-warm %r before forking: %s", instance, err)
+
+
+def _after_in_child() -> None:
+    global _registry_lock #pylint: disable=global-statement,invalid-name
+    _registry_lock = threading.Lock()
+
+    for instance in list(_instances):
+        try:
+            instance._after_fork_in_child() #pylint: disable=protected-access
+        except Exception: #pylint: disable=broad-except
+            logger.exception("Failed to reset %r after fork.", instance)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_in_child)
@@ -0,0 +1,295 @@
+"""
+Paginated listing and concurrent downloads of Google Cloud Storage objects.
+
+GcsClient authenticates every request with a TokenService. The token is read
+from the TokenService cache per request, so a long running job picks up a
+renewed token as soon as the current one nears its ``expireTime``, and a
+token rejected with 401 is replaced once. Listings are generators that fetch
+one page at a time, and object bodies are streamed to disk in chunks over a
+pooled, keep-alive session.
+"""
+
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+
+from scalesec_gcp_workload_identity import forking
+from scalesec_gcp_workload_identity.main import TokenService
+from scalesec_gcp_workload_identity.retry import RetryPolicy, call_with_retries
+from scalesec_gcp_workload_identity.session import DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, build_session
+
+logger = logging.getLogger(__name__)
+
+GCS_URL = "https://storage.googleapis.com"
+
+# bytes read from the socket and written to disk at a time
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# instrumentation stages reported to the observers of the TokenService
+GCS_LIST = "gcs_list"
+GCS_DOWNLOAD = "gcs_download"
+
+LIST_FIELDS = "items(name,size,generation,md5Hash,updated),nextPageToken"
+
+
+class GcsObject(NamedTuple):
+    """
+    One object of a listing
+    """
+    name: str
+    size: int
+    generation: Optional[str] = None
+    md5_hash: Optional[str] = None
+    updated: Optional[str] = None
+
+
+class DownloadResult(NamedTuple):
+    """
+    Outcome of downloading one object.
+    Either ``path`` and ``size`` or ``error`` is set.
+    """
+    name: str
+    path: Optional[str] = None
+    size: int = 0
+    error: Optional[Exception] = None
+
+
+class GcsClient: #pylint: disable=too-many-instance-attributes
+    """
+    Lists and downloads GCS objects with tokens from ``token_service``.
+
+    http_session: a requests.Session, by default a new pooled session of ``pool_maxsize``
+    pool_maxsize: connections kept open, and the default download concurrency
+    chunk_size: bytes streamed to disk at a time
+    retry_policy: defaults to the retry policy of ``token_service``
+    """
+    def __init__( #pylint: disable=too-many-arguments
+        self,
+        token_service: TokenService,
+        endpoint: str = GCS_URL,
+        http_session=None,
+        pool_maxsize: int = DEFAULT_POOL_SIZE,
+        http_timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        retry_policy: Optional[RetryPolicy] = None
+        ) -> None:
+        self.token_service = token_service
+        self.endpoint = endpoint.rstrip("/")
+        self.session = http_session if http_session is not None else build_session(pool_maxsize)
+        self.pool_maxsize = pool_maxsize
+        self.http_timeout = http_timeout
+        self.chunk_size = chunk_size
+        self.retry_policy = retry_policy if retry_policy is not None else token_service.retry_policy
+
+        self._token_lock = threading.Lock()
+        forking.register(self)
+
+    def __repr__(self):
+        return f"GcsClient({self.endpoint!r})"
+
+    def _after_fork_in_child(self) -> None:
+        """
+        Keep the session, without the connections of the parent
+        """
+        self._token_lock = threading.Lock()
+        self.session.close()
+
+    def _access_token(self, rejected: Optional[str] = None) -> str:
+        """
+        The current SA token. If GCS rejected ``rejected``, one thread mints a
+        new token and the others reuse it.
+        """
+        token, _ = self.token_service.get_token()
+        if token != rejected:
+            return token
+
+        with self._token_lock:
+            token, _ = self.token_service.get_token()
+            if token == rejected:
+                logger.info("GCS rejected the access token, minting a new one.")
+                token, _ = self.token_service.get_token(force_refresh=True)
+        return token
+
+    def _get(self, url: str, params: Optional[dict] = None, stream: bool = False):
+        """
+        GET ``url``, replacing the token once if it is rejected
+        """
+        token = self._access_token()
+        for retry in (False, True):
+            response = self.session.get(
+                url,
+                params=params,
+                headers={"authorization": "Bearer " + token},
+                stream=stream,
+                timeout=self.http_timeout
+                )
+            if response.status_code != 401 or retry:
+                break
+            response.close()
+            token = self._access_token(rejected=token)
+
+        if response.status_code != 200:
+            logger.error("GCS request failed: %s %s", response.status_code, response.text)
+            response.raise_for_status()
+        return response
+
+    def _object_url(self, bucket: str, name: str) -> str:
+        return (
+            f"{self.endpoint}/storage/v1/b/{urllib.parse.quote(bucket, safe='')}"
+            f"/o/{urllib.parse.quote(name, safe='')}"
+            )
+
+    def list_pages(
+        self,
+        bucket: str,
+        prefix: Optional[str] = None,
+        page_size: int = 1000
+        ) -> Iterator[Tuple[GcsObject, ...]]:
+        """
+        Yield the objects of ``bucket`` one page at a time. The next page is
+        only requested once the previous one has been consumed.
+        """
+        url = f"{self.endpoint}/storage/v1/b/{urllib.parse.quote(bucket, safe='')}/o"
+        params = {"maxResults": page_size, "fields": LIST_FIELDS}
+        if prefix:
+            params["prefix"] = prefix
+
+        while True:
+            data = call_with_retries(
+                self.retry_policy,
+                self.token_service._observers, #pylint: disable=protected-access
+                GCS_LIST,
+                lambda: self._get(url, params).json()
+                )
+            yield tuple(
+                GcsObject(
+                    item["name"],
+                    int(item.get("size", 0)),
+                    item.get("generation"),
+                    item.get("md5Hash"),
+                    item.get("updated")
+                    )
+                for item in data.get("items", ())
+                )
+
+            page_token = data.get("nextPageToken")
+            if not page_token:
+                return
+            params["pageToken"] = page_token
+
+    def list_objects(
+        self,
+        bucket: str,
+        prefix: Optional[str] = None,
+        page_size: int = 1000
+        ) -> Iterator[GcsObject]:
+        """
+        Yield every object of ``bucket`` (under ``prefix``), fetching pages lazily
+        """
+        for page in self.list_pages(bucket, prefix, page_size):
+            yield from page
+
+    def download(
+        self,
+        bucket: str,
+        name: str,
+        path: str,
+        generation: Optional[str] = None
+        ) -> int:
+        """
+        Stream object ``name`` to ``path`` in ``chunk_size`` chunks. The file is
+        written under a temporary name and moved into place once complete.
+
+        Returns:
+            size: the number of bytes written
+        """
+        params = {"alt": "media"}
+        if generation:
+            params["generation"] = generation
+
+        return call_with_retries(
+            self.retry_policy,
+            self.token_service._observers, #pylint: disable=protected-access
+            GCS_DOWNLOAD,
+            self._stream_to_file,
+            self._object_url(bucket, name),
+            params,
+            path
+            )
+
+    def _stream_to_file(self, url: str, params: dict, path: str) -> int:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        size = 0
+        with contextlib.closing(self._get(url, params, stream=True)) as response:
+            file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".download-")
+            try:
+                with os.fdopen(file_descriptor, "wb") as output_file:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        output_file.write(chunk)
+                        size += len(chunk)
+                os.replace(temp_path, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(temp_path)
+                raise
+
+        return size
+
+    def download_many(
+        self,
+        bucket: str,
+        objects: Iterable[Union[GcsObject, str]],
+        directory: str,
+        max_workers: Optional[int] = None
+        ) -> Iterator[DownloadResult]:
+        """
+        Download ``objects`` (e.g. ``list_objects(bucket)``) below ``directory``
+        on up to ``max_workers`` threads (default ``pool_maxsize``), yielding a
+        DownloadResult as each completes. ``objects`` is consumed lazily, so a
+        listing of millions of objects is never held in memory. Folder
+        placeholders and names escaping ``directory`` are skipped.
+        """
+        max_workers = max_workers or self.pool_maxsize
+        root = os.path.abspath(directory)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gcs-download")
+        with executor:
+            pending: Dict = {}
+            for item in objects:
+                gcs_object = item if isinstance(item, GcsObject) else GcsObject(item, 0)
+                if gcs_object.name.endswith("/"):
+                    continue
+
+                path = os.path.abspath(os.path.join(root, gcs_object.name))
+                if not path.startswith(root + os.sep):
+                    logger.warning("Skipping object outside the directory: %s", gcs_object.name)
+                    continue
+
+                future = executor.submit(
+                    self.download, bucket, gcs_object.name, path, gcs_object.generation
+                    )
+                pending[future] = (gcs_object.name, path)
+
+                # keep a bounded number of downloads queued
+                if len(pending) >= 2 * max_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for completed in done:
+                        yield _download_result(completed, *pending.pop(completed))
+
+            for completed in list(pending):
+                yield _download_result(completed, *pending.pop(completed))
+
+
+def _download_result(future, name: str, path: str) -> DownloadResult:
+    error = future.exception()
+    if error is not None:
+        logger.error("Failed to download %s: %s", name, error)
+        return DownloadResult(name, error=error)
+    return DownloadResult(name, path, future.result())
@@ -0,0 +1,290 @@
+"""
+Structured instrumentation of the token pipeline.
+
+Observers registered on a TokenService receive a StageEvent for every stage
+of a mint (AssumeRole, signing, token exchange, generateAccessToken,
+generateIdToken, downscoping) and a CacheEvent for every token cache lookup.
+Nothing is timed or allocated when no observer is registered.
+
+Two observers are provided: PrometheusObserver renders the Prometheus text
+exposition format and OpenTelemetryObserver records each stage as a span
+(requires ``opentelemetry-api``).
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional, Sequence, Tuple
+
+from scalesec_gcp_workload_identity import forking
+
+logger = logging.getLogger(__name__)
+
+# pipeline stages
+ASSUME_ROLE = "assume_role"
+SIGN = "sign"
+FEDERATED_TOKEN = "federated_token"
+SA_TOKEN = "sa_token"
+ID_TOKEN = "id_token"
+DOWNSCOPED_TOKEN = "downscoped_token"
+MINT = "mint"
+
+# outcomes
+SUCCESS = "success"
+ERROR = "error"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class StageEvent(NamedTuple):
+    """
+    One completed pipeline stage.
+
+    ``duration`` is in seconds and ``start_time`` in seconds since the epoch.
+    ``attempt`` counts from 1, so ``attempt - 1`` is the number of retries.
+    ``status_code`` is the HTTP status of the upstream response, when there was one.
+    """
+    stage: str
+    duration: float
+    outcome: str
+    status_code: Optional[int] = None
+    attempt: int = 1
+    error: Optional[BaseException] = None
+    start_time: float = 0.0
+
+
+class CacheEvent(NamedTuple):
+    """
+    A token cache lookup: ``cache`` is "sa_token", "federated_token", "id_token"
+    or "downscoped_token"
+    """
+    cache: str
+    hit: bool
+
+
+class Observer:
+    """
+    Base class for pipeline observers, override the events you are interested in.
+    Observers are called on the minting thread and must not block.
+    """
+    def on_stage(self, event: StageEvent) -> None:
+        """
+        Called when a pipeline stage completes or fails
+        """
+
+    def on_cache(self, event: CacheEvent) -> None:
+        """
+        Called on every token cache lookup
+        """
+
+
+def status_code_of(err: BaseException) -> Optional[int]:
+    """
+    HTTP status code carried by a requests, httpx or botocore exception, if any
+    """
+    response = getattr(err, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return getattr(response, "status_code", None)
+
+
+def notify_stage(observers: Sequence[Observer], event: StageEvent) -> None:
+    """
+    Deliver a StageEvent, a failing observer never fails the mint
+    """
+    for observer in observers:
+        try:
+            observer.on_stage(event)
+        except Exception as err: #pylint: disable=broad-except
+            logger.warning("Observer %r failed: %s", observer, err)
+
+
+def notify_cache(observers: Sequence[Observer], cache: str, hit: bool) -> None:
+    """
+    Deliver a CacheEvent, a failing observer never fails the mint
+    """
+    event = CacheEvent(cache, hit)
+    for observer in observers:
+        try:
+            observer.on_cache(event)
+        except Exception as err: #pylint: disable=broad-except
+            logger.warning("Observer %r failed: %s", observer, err)
+
+
+def timed( #pylint: disable=too-many-arguments
+    observers: Sequence[Observer],
+    stage: str,
+    func: Callable[..., Any],
+    *args,
+    attempt: int = 1,
+    status_code: Optional[int] = None,
+    **kwargs
+    ) -> Any:
+    """
+    Call ``func`` and report it to ``observers`` as ``stage``.
+    With no observers this is a plain call.
+
+    status_code: reported on success, e.g. 200 for a stage that is a single HTTP call
+    """
+    if not observers:
+        return func(*args, **kwargs)
+
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as err:
+        notify_stage(observers, StageEvent(
+            stage, time.perf_counter() - start, ERROR, status_code_of(err), attempt, err, start_time
+            ))
+        raise
+
+    notify_stage(observers, StageEvent(
+        stage, time.perf_counter() - start, SUCCESS, status_code, attempt, None, start_time
+        ))
+    return result
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[Any, ...]) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class PrometheusObserver(Observer):
+    """
+    Aggregates pipeline events and renders them in the Prometheus text format:
+
+        <namespace>_stage_duration_seconds   histogram by stage and outcome
+        <namespace>_stage_requests_total     counter by stage, outcome and status code
+        <namespace>_stage_retries_total      counter by stage
+        <namespace>_cache_lookups_total      counter by cache and result
+
+    Serve ``render()`` from any HTTP handler as ``text/plain; version=0.0.4``.
+    """
+    def __init__(
+        self,
+        namespace: str = "gcp_workload_identity",
+        buckets: Iterable[float] = DEFAULT_BUCKETS
+        ) -> None:
+        self.namespace = namespace
+        self.buckets = tuple(sorted(buckets))
+
+        self._lock = threading.Lock()
+        forking.register(self)
+        # (stage, outcome) -> [bucket counts..., sum, count]
+        self._durations: Dict[Tuple[str, str], list] = {}
+        self._requests: Dict[Tuple[str, str, str], int] = {}
+        self._retries: Dict[str, int] = {}
+        self._cache: Dict[Tuple[str, str], int] = {}
+
+    def _after_fork_in_child(self) -> None:
+        self._lock = threading.Lock()
+
+    def on_stage(self, event: StageEvent) -> None:
+        status_code = str(event.status_code) if event.status_code is not None else ""
+        with self._lock:
+            histogram = self._durations.get((event.stage, event.outcome))
+            if histogram is None:
+                histogram = self._durations[(event.stage, event.outcome)] = [0] * (
+                    len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if event.duration <= bound:
+                    histogram[index] += 1
+            histogram[-2] += event.duration
+            histogram[-1] += 1
+
+            key = (event.stage, event.outcome, status_code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if event.attempt > 1:
+                self._retries[event.stage] = self._retries.get(event.stage, 0) + 1
+
+    def on_cache(self, event: CacheEvent) -> None:
+        key = (event.cache, "hit" if event.hit else "miss")
+        with self._lock:
+            self._cache[key] = self._cache.get(key, 0) + 1
+
+    def render(self) -> str:
+        """
+        The current metrics in the Prometheus text exposition format
+        """
+        name = self.namespace
+        lines = [
+            f"# HELP {name}_stage_duration_seconds Duration of token pipeline stages.",
+            f"# TYPE {name}_stage_duration_seconds histogram"
+        ]
+        with self._lock:
+            for (stage, outcome), histogram in sorted(self._durations.items()):
+                names = ("stage", "outcome", "le")
+                for bound, count in zip(self.buckets, histogram):
+                    labels = _labels(names, (stage, outcome, repr(float(bound))))
+                    lines.append(f"{name}_stage_duration_seconds_bucket{labels} {count}")
+                labels = _labels(names, (stage, outcome, "+Inf"))
+                lines.append(f"{name}_stage_duration_seconds_bucket{labels} {histogram[-1]}")
+                labels = _labels(names[:2], (stage, outcome))
+                lines.append(f"{name}_stage_duration_seconds_sum{labels} {histogram[-2]}")
+                lines.append(f"{name}_stage_duration_seconds_count{labels} {histogram[-1]}")
+
+            lines.append(f"# HELP {name}_stage_requests_total Token pipeline stages run.")
+            lines.append(f"# TYPE {name}_stage_requests_total counter")
+            for key, count in sorted(self._requests.items()):
+                labels = _labels(("stage", "outcome", "status_code"), key)
+                lines.append(f"{name}_stage_requests_total{labels} {count}")
+
+            lines.append(f"# HELP {name}_stage_retries_total Token pipeline stage retries.")
+            lines.append(f"# TYPE {name}_stage_retries_total counter")
+            for stage, count in sorted(self._retries.items()):
+                lines.append(f"{name}_stage_retries_total{_labels(('stage',), (stage,))} {count}")
+
+            lines.append(f"# HELP {name}_cache_lookups_total Token cache lookups.")
+            lines.append(f"# TYPE {name}_cache_lookups_total counter")
+            for key, count in sorted(self._cache.items()):
+                labels = _labels(("cache", "result"), key)
+                lines.append(f"{name}_cache_lookups_total{labels} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+class OpenTelemetryObserver(Observer):
+    """
+    Records every pipeline stage as an OpenTelemetry span, parented to the
+    span that is current when the stage completes. Cache lookups are added
+    as events on the current span.
+
+    Requires ``opentelemetry-api`` unless a tracer is passed in:
+    ``pip install scalesec-gcp-workload-identity[opentelemetry]``
+    """
+    def __init__(self, tracer=None, span_prefix: str = "gcp_workload_identity.") -> None:
+        try:
+            from opentelemetry import trace #pylint: disable=import-error,import-outside-toplevel
+        except ImportError:
+            if tracer is None:
+                raise
+            trace = None
+
+        self._trace = trace
+        self.tracer = tracer if tracer is not None else trace.get_tracer(__name__)
+        self.span_prefix = span_prefix
+
+    def on_stage(self, event: StageEvent) -> None:
+        start_ns = int(event.start_time * 1e9)
+        span = self.tracer.start_span(self.span_prefix + event.stage, start_time=start_ns)
+        span.set_attribute("gcp_workload_identity.outcome", event.outcome)
+        span.set_attribute("gcp_workload_identity.attempt", event.attempt)
+        if event.status_code is not None:
+            span.set_attribute("http.status_code", event.status_code)
+        if event.error is not None:
+            span.record_exception(event.error)
+            if self._trace is not None:
+                span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, str(event.error)))
+        span.end(end_time=start_ns + int(event.duration * 1e9))
+
+    def on_cache(self, event: CacheEvent) -> None:
+        if self._trace is not None:
+            self._trace.get_current_span().add_event(
+                "gcp_workload_identity.cache",
+                {"cache": event.cache, "hit": event.hit}
+                )
@@ -4,17 +4,82 @@ our access token.
 """
 import datetime
 import logging
-from typing import Tuple
-from botocore.credentials import ReadOnlyCredentials #pylint: disable=import-error
-from scalesec_gcp_workload_identity.utils import Utils
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple, Union
+from scalesec_gcp_workload_identity import forking
+from scalesec_gcp_workload_identity.cache import (
+    CachedToken,
+    TokenCache,
+    parse_expire_time,
+    parse_jwt_expiry,
+    utcnow
+)
+from scalesec_gcp_workload_identity.circuit import CircuitBreaker
+from scalesec_gcp_workload_identity.credentials import AmbientCredentials
+from scalesec_gcp_workload_identity.downscope import CredentialAccessBoundary
+from scalesec_gcp_workload_identity.instrumentation import (
+    ASSUME_ROLE,
+    DOWNSCOPED_TOKEN,
+    FEDERATED_TOKEN,
+    ID_TOKEN,
+    MINT,
+    SA_TOKEN,
+    SIGN,
+    Observer,
+    notify_cache,
+    timed
+)
+from scalesec_gcp_workload_identity.ratelimit import (
+    GOOGLE_STS,
+    IAM_CREDENTIALS,
+    RateLimiter,
+    rate_limited
+)
+from scalesec_gcp_workload_identity.refresher import BackgroundRefresher
+from scalesec_gcp_workload_identity.retry import (
+    RetryPolicy,
+    call_with_retries,
+    server_clock_offset,
+    signature_rejected
+)
+from scalesec_gcp_workload_identity.session import DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT
+from scalesec_gcp_workload_identity.signing import CallerIdentityTokenBuilder
+from scalesec_gcp_workload_identity.utils import (
+    GOOGLE_STS_URL,
+    IAM_CREDENTIALS_URL,
+    Utils,
+    sts_host
+)
 
 logger = logging.getLogger(__name__)
 
+
+def _lifetime_seconds(gcp_token_lifetime: str) -> Optional[float]:
+    """
+    Seconds of a lifetime in the Duration format of GCP, e.g. "3600s", or None if malformed
+    """
+    try:
+        return float(gcp_token_lifetime.rstrip("s"))
+    except (AttributeError, ValueError):
+        return None
+
+
+class TokenResult(NamedTuple):
+    """
+    Outcome of minting a token for one service account in a batch.
+    Either ``token`` and ``expire_time`` or ``error`` is set.
+    """
+    token: Optional[str] = None
+    expire_time: Optional[str] = None
+    error: Optional[Exception] = None
+
+
 class TokenService: #pylint: disable=too-many-instance-attributes
     """
     Contains all vars and functions.
     """
-    def __init__( #pylint: disable=too-many-arguments
+    def __init__( #pylint: disable=too-many-arguments,too-many-locals
         self,
         gcp_project_number: str,
         gcp_workload_id: str,
@@ -24,7 +89,24 @@ class TokenService: #pylint: disable=too-many-instance-attributes
         aws_role_name: str,
         aws_region: str,
         gcp_token_lifetime: str = "3600s",
-        gcp_token_scopes: str = "https://www.googleapis.com/auth/cloud-platform"
+        gcp_token_scopes: str = "https://www.googleapis.com/auth/cloud-platform",
+        token_cache: Optional[TokenCache] = None,
+        token_refresh_skew: int = 300,
+        federated_token_cache: Optional[TokenCache] = None,
+        aws_session_duration: int = 3600,
+        aws_credential_source: str = "assume_role",
+        aws_sts_region: Optional[str] = None,
+        aws_sts_endpoint_url: Optional[str] = None,
+        gcp_sts_endpoint: str = GOOGLE_STS_URL,
+        gcp_iam_credentials_endpoint: str = IAM_CREDENTIALS_URL,
+        http_session=None,
+        http_pool_maxsize: int = DEFAULT_POOL_SIZE,
+        http_timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT,
+        observers: Optional[Iterable[Observer]] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        prewarm_before_fork: bool = False,
+        circuit_breaker: Optional[CircuitBreaker] = None
         ) -> None:
 
         # GCP
@@ -39,15 +121,66 @@ class TokenService: #pylint: disable=too-many-instance-attributes
         self.gcp_sa_token = None
         self.authorization_header = None
 
+        # Cached SA tokens are served until ``token_refresh_skew`` seconds before they expire
+        self.token_cache = token_cache if token_cache is not None else TokenCache()
+        # A skew reaching the lifetime would make every token stale as soon as it is minted
+        lifetime = _lifetime_seconds(gcp_token_lifetime)
+        if lifetime is not None and token_refresh_skew > lifetime / 2:
+            logger.warning(
+                "token_refresh_skew of %ss limited to half the token lifetime of %s",
+                token_refresh_skew,
+                gcp_token_lifetime
+                )
+            token_refresh_skew = int(lifetime // 2)
+        self.token_refresh_skew = token_refresh_skew
+
+        # Federated tokens are cached separately so an SA token miss
+        # costs a single generateAccessToken call
+        if federated_token_cache is None:
+            federated_token_cache = TokenCache()
+        self.federated_token_cache = federated_token_cache
+        self._federation_lock = threading.Lock()
+
+        # Only one thread mints at a time, the others wait for its result
+        self._refresh_lock = threading.Lock()
+        # Renews a token inside the skew while callers keep using it
+        self._background_refresh: Optional[threading.Thread] = None
+        self._background_refresh_lock = threading.Lock()
+        self._refresher: Optional[BackgroundRefresher] = None
+
+        # Receive per-stage timings and cache events, see instrumentation.py
+        self._observers: Tuple[Observer, ...] = tuple(observers or ())
+
+        # Retries, hedging and re-signing of the Google token calls
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        # Correction applied to the local clock when signing, learnt from rejected signatures
+        self.clock_offset = datetime.timedelta(0)
+        # Client-side admission control of the Google token calls, e.g. get_shared_rate_limiter()
+        self.rate_limiter = rate_limiter
+        # When set, failing refreshes serve the cached token until it truly expires
+        self.circuit_breaker = circuit_breaker
+
         # AWS
         self.method = "POST"
-        self.host = "sts.amazonaws.com"
         self.aws_account_id = aws_account_id
         self.aws_role_name = aws_role_name
         self.aws_region = aws_region
 
+        # Regional STS endpoint, follows aws_region unless overridden
+        # ("global" selects sts.amazonaws.com)
+        self.aws_sts_region = aws_sts_region or aws_region
+        if self.aws_sts_region == "global":
+            self.aws_sts_region = None
+        self.host = sts_host(self.aws_sts_region)
+
         self.x_goog_cloud_target_resource = f"//iam.googleapis.com/projects/{self.gcp_project_number}/locations/global/workloadIdentityPools/{self.gcp_workload_id}/providers/{self.gcp_provider}" #pylint: disable=line-too-long
 
+        # "assume_role" calls sts:AssumeRole, "ambient" uses the role we already run as
+        if aws_credential_source not in ("assume_role", "ambient"):
+            raise ValueError(f"Unknown aws_credential_source: {aws_credential_source!r}")
+        self.aws_credential_source = aws_credential_source
+        credential_provider = AmbientCredentials() if aws_credential_source == "ambient" else None
+
         # Utils class
         self.utils = Utils(
             self.aws_account_id,
@@ -55,48 +188,674 @@ class TokenService: #pylint: disable=too-many-instance-attributes
             self.aws_region,
             self.method,
             self.host,
-            self.gcp_service_account_email
+            self.gcp_service_account_email,
+            aws_session_duration=aws_session_duration,
+            session=http_session,
+            http_timeout=http_timeout,
+            http_pool_maxsize=http_pool_maxsize,
+            credential_provider=credential_provider,
+            sts_region=self.aws_sts_region,
+            sts_endpoint_url=aws_sts_endpoint_url,
+            gcp_sts_url=gcp_sts_endpoint,
+            gcp_iam_credentials_url=gcp_iam_credentials_endpoint
+            )
+
+        # Prebuilt, signed GetCallerIdentity subject token template
+        self._subject_token_builder = CallerIdentityTokenBuilder(
+            self.host,
+            self.utils.signing_region,
+            self.x_goog_cloud_target_resource,
+            self.method
             )
 
+        # Forked children keep the cached tokens and rebuild their clients and connections.
+        # With prewarm_before_fork, a fresh token is minted before forking for them to inherit
+        forking.register(self, prewarm=prewarm_before_fork)
+
     def __repr__(self):
         return f"TokenService({self.gcp_sa_token!r})"
 
     def __str__(self):
         return f"TokenService: {self.gcp_sa_token}"
 
-    def get_token(self) -> Tuple[str, str]:
+    def _before_fork(self) -> None:
+        """
+        Renew the token in the parent when it is within ``token_refresh_skew`` of expiry,
+        synchronously as a renewal thread would not survive the fork
+        """
+        cached = self.token_cache.peek(self._cache_key())
+        if cached is None or cached.seconds_remaining() <= self.token_refresh_skew:
+            self._refresh()
+
+    def _after_fork_in_child(self) -> None:
+        """
+        Replace the locks, which may have been held by a parent thread, and
+        drop the clients and connections of the parent
+        """
+        self._federation_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._background_refresh = None
+        self._background_refresh_lock = threading.Lock()
+        # threads are not forked
+        self._refresher = None
+        self.utils._after_fork_in_child() #pylint: disable=protected-access
+        self._subject_token_builder._after_fork_in_child() #pylint: disable=protected-access
+
+    def add_observer(self, observer: Observer) -> None:
+        """
+        Register an observer for pipeline stage and cache events
+        """
+        self._observers = self._observers + (observer,)
+
+    def remove_observer(self, observer: Observer) -> None:
+        """
+        Unregister an observer
+        """
+        self._observers = tuple(item for item in self._observers if item is not observer)
+
+    def _cache_key(
+        self,
+        gcp_service_account_email: Optional[str] = None,
+        gcp_token_scopes: Optional[str] = None,
+        gcp_token_lifetime: Optional[str] = None
+        ) -> Tuple[str, str, str]:
+        return (
+            gcp_service_account_email or self.gcp_service_account_email,
+            gcp_token_scopes or self.gcp_token_scopes,
+            gcp_token_lifetime or self.gcp_token_lifetime
+            )
+
+    def get_token(self, force_refresh: bool = False) -> Tuple[str, str]:
         """
         Return a GCP Service Account Access Token
+
+        The token is served from ``token_cache`` until ``token_refresh_skew``
+        seconds before its expiry. Pass ``force_refresh=True`` to always mint a new one.
+        Concurrent callers share a single refresh. While the cached token is
+        still valid it is returned at once and renewed in a background thread,
+        callers only wait on the network when no valid token is cached.
         """
+        if not force_refresh:
+            key = self._cache_key()
+            cached = self.token_cache.get(key, min_ttl=self.token_refresh_skew)
+            if self._observers:
+                notify_cache(self._observers, SA_TOKEN, cached is not None)
+            if cached is not None:
+                logger.debug("Serving cached SA token.")
+                return cached.token, cached.expire_time
 
-        aws_access_key, aws_secret_access_key, aws_session_token = self.utils._assume_role() #pylint: disable=protected-access
+            cached = self.token_cache.peek(key)
+            if cached is not None and cached.seconds_remaining() > 0:
+                if not (self._refresh_lock.locked() or self._circuit_open()):
+                    self._refresh_in_background()
+                logger.debug("Serving cached SA token while it is renewed.")
+                return cached.token, cached.expire_time
 
-        # create a ReadOnlyCredentials object with the assume_role credentials
-        credentials = ReadOnlyCredentials(aws_access_key, aws_secret_access_key, aws_session_token)
+        cached = self._refresh(force=force_refresh)
 
-        # Generate time used for signature
-        # It seems if too much time passes between generation and use, the signature check will fail (<10% of the time) #pylint: disable=line-too-long
-        current_time = datetime.datetime.utcnow()
-        x_amz_date = current_time.strftime('%Y%m%dT%H%M%SZ')
+        return cached.token, cached.expire_time
 
-        # create the Authorization header
-        authorization_header = self.utils._generate_auth_header(x_amz_date, credentials) #pylint: disable=protected-access
+    def _refresh_in_background(self) -> None:
+        """
+        Start a thread running ``_refresh``, unless one is already running
+        """
+        with self._background_refresh_lock:
+            if self._background_refresh is not None and self._background_refresh.is_alive():
+                return
+            self._background_refresh = threading.Thread(
+                target=self._background_refresh_target,
+                name="gcp-token-renewal",
+                daemon=True
+                )
+            self._background_refresh.start()
 
-        # generate the identity token
-        caller_identity_token = self.utils._generate_caller_identity_token( #pylint: disable=protected-access
-            authorization_header,
-            x_amz_date,
-            self.x_goog_cloud_target_resource,
-            credentials
+    def _background_refresh_target(self) -> None:
+        try:
+            self._refresh()
+        except Exception as err: #pylint: disable=broad-except
+            # Callers still hold a valid token or will refresh in the foreground
+            logger.error("Token renewal failed: %s", err)
+
+    def _refresh(self, force: bool = False) -> CachedToken:
+        """
+        Mint and cache a new token, unless another thread did so while we waited
+        """
+        key = self._cache_key()
+        with self._refresh_lock, self.token_cache.refresh_lock(key):
+            stale = None
+            if not force:
+                stale = self.token_cache.peek(key)
+                if stale is not None and stale.seconds_remaining() > self.token_refresh_skew:
+                    return stale
+
+            cached = self._guarded_mint(
+                lambda: timed(self._observers, MINT, self._mint_token),
+                stale
+                )
+            if cached is not stale:
+                self.token_cache.set(key, cached)
+                self.gcp_sa_token = cached.token
+
+        return cached
+
+    def _circuit_open(self) -> bool:
+        return self.circuit_breaker is not None and self.circuit_breaker.is_open()
+
+    def _guarded_mint(
+        self,
+        mint: Callable[[], CachedToken],
+        stale: Optional[CachedToken]
+        ) -> CachedToken:
+        """
+        ``mint()`` through the circuit breaker, if any, falling back to ``stale``
+        """
+        if self.circuit_breaker is None:
+            return mint()
+        return self.circuit_breaker.call(mint, stale)
+
+    def get_id_token(
+        self,
+        audience: str,
+        include_email: bool = False,
+        force_refresh: bool = False
+        ) -> Tuple[str, str]:
+        """
+        Return a Google signed OIDC ID token of the service account for ``audience``,
+        e.g. a Cloud Run service URL or an IAP OAuth client ID
+
+        The token is minted with the cached federated token and cached per audience
+        in ``token_cache`` until ``token_refresh_skew`` seconds before the ``exp`` of
+        the JWT, which is read locally.
+
+        Returns:
+            id_token, expire_time
+        """
+        key = self._id_token_cache_key(audience, include_email)
+        if not force_refresh:
+            cached = self.token_cache.get(key, min_ttl=self.token_refresh_skew)
+            if self._observers:
+                notify_cache(self._observers, ID_TOKEN, cached is not None)
+            if cached is not None:
+                return cached.token, cached.expire_time
+
+            cached = self.token_cache.peek(key)
+            refreshing = self.token_cache.refreshing(key) or self._circuit_open()
+            if refreshing and cached is not None and cached.seconds_remaining() > 0:
+                logger.debug("Refresh in progress, serving cached ID token.")
+                return cached.token, cached.expire_time
+
+        # audiences are minted concurrently, callers of one audience share its mint
+        with self.token_cache.refresh_lock(key):
+            stale = None
+            if not force_refresh:
+                stale = self.token_cache.peek(key)
+                if stale is not None and stale.seconds_remaining() > self.token_refresh_skew:
+                    return stale.token, stale.expire_time
+
+            cached = self._guarded_mint(
+                lambda: self._mint_id_token(audience, include_email),
+                stale
+                )
+            if cached is not stale:
+                self.token_cache.set(key, cached)
+
+        return cached.token, cached.expire_time
+
+    def get_downscoped_token(
+        self,
+        access_boundary: CredentialAccessBoundary,
+        force_refresh: bool = False
+        ) -> Tuple[str, str]:
+        """
+        Return the SA token downscoped to ``access_boundary``
+
+        The cached SA token is exchanged with Google STS, and the downscoped
+        token is cached in ``token_cache`` by the hash of the boundary until
+        ``token_refresh_skew`` seconds before it expires with its source token,
+        or until the SA token has been renewed.
+
+        Returns:
+            downscoped_token, expire_time
+        """
+        key = self._downscoped_cache_key(access_boundary)
+        if not force_refresh:
+            cached = self.token_cache.get(key, min_ttl=self.token_refresh_skew)
+            if self._observers:
+                notify_cache(self._observers, DOWNSCOPED_TOKEN, cached is not None)
+            if cached is not None:
+                return cached.token, cached.expire_time
+
+            cached = self.token_cache.peek(key)
+            refreshing = self.token_cache.refreshing(key) or self._circuit_open()
+            if refreshing and cached is not None and cached.seconds_remaining() > 0:
+                logger.debug("Refresh in progress, serving cached downscoped token.")
+                return cached.token, cached.expire_time
+
+        # boundaries are exchanged concurrently, callers of one boundary share its exchange
+        with self.token_cache.refresh_lock(key):
+            stale = None
+            if not force_refresh:
+                stale = self.token_cache.peek(key)
+                if stale is not None and stale.seconds_remaining() > self.token_refresh_skew:
+                    return stale.token, stale.expire_time
+
+            # get_token passes the circuit breaker on its own: were it called from the
+            # guarded mint, a half-open probe taken here would short-circuit its refresh
+            sa_token, sa_expire_time = self.get_token()
+            # while the SA token is renewed, a token exchanged from it would expire no later
+            # than the cached one (to the second) and every call would exchange again
+            sa_expires_at = parse_expire_time(sa_expire_time)
+            if stale is not None and stale.seconds_remaining() > 0 and (
+                    stale.expires_at >= sa_expires_at - datetime.timedelta(seconds=1)):
+                logger.debug("SA token renewal in progress, serving cached downscoped token.")
+                return stale.token, stale.expire_time
+
+            cached = self._guarded_mint(
+                lambda: self._mint_downscoped_token(access_boundary, sa_token, sa_expire_time),
+                stale
+                )
+            if cached is not stale:
+                self.token_cache.set(key, cached)
+
+        return cached.token, cached.expire_time
+
+    def get_downscoped_tokens(
+        self,
+        access_boundaries: Iterable[CredentialAccessBoundary],
+        max_workers: int = 8
+        ) -> Dict[CredentialAccessBoundary, TokenResult]:
+        """
+        Return the SA token downscoped to each of ``access_boundaries``
+
+        Cached tokens are reused and the others are exchanged concurrently on up
+        to ``max_workers`` threads, all from one SA token. A failure for one
+        boundary is reported in its TokenResult and does not abort the batch.
+        """
+        def downscope(access_boundary: CredentialAccessBoundary) -> TokenResult:
+            try:
+                return TokenResult(*self.get_downscoped_token(access_boundary))
+            except Exception as err: #pylint: disable=broad-except
+                logger.error("Failed to downscope to %r: %s", access_boundary, err)
+                return TokenResult(error=err)
+
+        access_boundaries = list(dict.fromkeys(access_boundaries))
+        if not access_boundaries:
+            return {}
+
+        try:
+            # mint the shared source token once, not in every worker
+            self.get_token()
+        except Exception as err: #pylint: disable=broad-except
+            logger.error("Failed to get SA token for batch: %s", err)
+            return {boundary: TokenResult(error=err) for boundary in access_boundaries}
+
+        workers = max(1, min(max_workers, len(access_boundaries)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(access_boundaries, executor.map(downscope, access_boundaries)))
+
+    def get_tokens(
+        self,
+        gcp_service_account_emails: Iterable[str],
+        gcp_token_scopes: Optional[str] = None,
+        gcp_token_lifetime: Optional[str] = None,
+        max_workers: int = 8
+        ) -> Dict[str, TokenResult]:
+        """
+        Return GCP Service Account Access Tokens for many service accounts
+
+        The AWS and federation legs run once, then the generateAccessToken
+        calls are issued concurrently on up to ``max_workers`` threads.
+        Cached tokens are reused. A failure for one service account is
+        reported in its TokenResult and does not abort the batch.
+        """
+        gcp_token_scopes = gcp_token_scopes or self.gcp_token_scopes
+        gcp_token_lifetime = gcp_token_lifetime or self.gcp_token_lifetime
+
+        results: Dict[str, TokenResult] = {}
+        to_mint = []
+        for email in dict.fromkeys(gcp_service_account_emails):
+            key = self._cache_key(email, gcp_token_scopes, gcp_token_lifetime)
+            cached = self.token_cache.get(key, min_ttl=self.token_refresh_skew)
+            if self._observers:
+                notify_cache(self._observers, SA_TOKEN, cached is not None)
+            if cached is not None:
+                results[email] = TokenResult(cached.token, cached.expire_time)
+            else:
+                to_mint.append(email)
+
+        if not to_mint:
+            return results
+
+        try:
+            federated_access_token = self._get_federated_token()
+        except Exception as err: #pylint: disable=broad-except
+            logger.error("Failed to get federated token for batch: %s", err)
+            results.update((email, TokenResult(error=err)) for email in to_mint)
+            return results
+
+        def mint(email: str) -> TokenResult:
+            issued_at = utcnow()
+            try:
+                sa_token, sa_expire_time = call_with_retries(
+                    self.retry_policy,
+                    self._observers,
+                    SA_TOKEN,
+                    self._rate_limited_sa_token(email),
+                    federated_access_token,
+                    gcp_token_lifetime,
+                    gcp_token_scopes,
+                    email
+                    )
+                cached = CachedToken(
+                    sa_token,
+                    sa_expire_time,
+                    parse_expire_time(sa_expire_time),
+                    issued_at
+                    )
+            except Exception as err: #pylint: disable=broad-except
+                logger.error("Failed to get SA token for %s: %s", email, err)
+                return TokenResult(error=err)
+
+            key = self._cache_key(email, gcp_token_scopes, gcp_token_lifetime)
+            self.token_cache.set(key, cached)
+            return TokenResult(cached.token, cached.expire_time)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(to_mint)))) as executor:
+            results.update(zip(to_mint, executor.map(mint, to_mint)))
+
+        return results
+
+    def start_background_refresh(
+        self,
+        refresh_fraction: float = 0.75,
+        jitter: float = 0.1
+        ) -> None:
+        """
+        Renew the token in a daemon thread once ``refresh_fraction`` of its
+        lifetime (randomised by +/- ``jitter``) has passed.
+        """
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+
+        self._refresher = BackgroundRefresher(self, refresh_fraction, jitter)
+        self._refresher.start()
+
+    def stop_background_refresh(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the background refresher, if running
+        """
+        if self._refresher is None:
+            return
+
+        self._refresher.stop()
+        self._refresher.join(timeout)
+        self._refresher = None
+
+    def _mint_token(self) -> CachedToken:
+        """
+        Run the full AssumeRole -> federation -> SA token exchange
+        """
+        from requests.exceptions import HTTPError #pylint: disable=import-error,import-outside-toplevel
+
+        issued_at = utcnow()
+
+        federated_access_token = self._get_federated_token()
+
+        # get the SA token
+        try:
+            sa_token, sa_expire_time = call_with_retries(
+                self.retry_policy,
+                self._observers,
+                SA_TOKEN,
+                self._rate_limited_sa_token(self.gcp_service_account_email),
+                federated_access_token,
+                self.gcp_token_lifetime,
+                self.gcp_token_scopes
+                )
+        except HTTPError as err:
+            if not self._cached_federated_token_rejected(err, issued_at):
+                raise
+
+            logger.info("Cached federated token was rejected, exchanging a new one.")
+            sa_token, sa_expire_time = timed(
+                self._observers,
+                SA_TOKEN,
+                self._rate_limited_sa_token(self.gcp_service_account_email),
+                self._get_federated_token(force_refresh=True),
+                self.gcp_token_lifetime,
+                self.gcp_token_scopes,
+                attempt=2,
+                status_code=200
+                )
+
+        return CachedToken(sa_token, sa_expire_time, parse_expire_time(sa_expire_time), issued_at)
+
+    def _mint_id_token(self, audience: str, include_email: bool) -> CachedToken:
+        """
+        Call generateIdToken with the (cached) federated token
+        """
+        from requests.exceptions import HTTPError #pylint: disable=import-error,import-outside-toplevel
+
+        issued_at = utcnow()
+        get_id_token = rate_limited(
+            self.rate_limiter,
+            IAM_CREDENTIALS,
+            self.gcp_service_account_email,
+            self.utils._get_id_token #pylint: disable=protected-access
+            )
+
+        try:
+            id_token = call_with_retries(
+                self.retry_policy,
+                self._observers,
+                ID_TOKEN,
+                get_id_token,
+                self._get_federated_token(),
+                audience,
+                include_email
+                )
+        except HTTPError as err:
+            if not self._cached_federated_token_rejected(err, issued_at):
+                raise
+
+            logger.info("Cached federated token was rejected, exchanging a new one.")
+            id_token = timed(
+                self._observers,
+                ID_TOKEN,
+                get_id_token,
+                self._get_federated_token(force_refresh=True),
+                audience,
+                include_email,
+                attempt=2,
+                status_code=200
+                )
+
+        expires_at = parse_jwt_expiry(id_token)
+        expire_time = expires_at.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return CachedToken(id_token, expire_time, expires_at, issued_at)
+
+    def _mint_downscoped_token(
+        self,
+        access_boundary: CredentialAccessBoundary,
+        sa_token: str,
+        sa_expire_time: str
+        ) -> CachedToken:
+        """
+        Exchange the SA token for a token restricted to ``access_boundary``
+        """
+        issued_at = utcnow()
+
+        downscoped_token, expires_in = call_with_retries(
+            self.retry_policy,
+            self._observers,
+            DOWNSCOPED_TOKEN,
+            rate_limited(
+                self.rate_limiter,
+                GOOGLE_STS,
+                access_boundary.hash,
+                self.utils._exchange_downscoped_token #pylint: disable=protected-access
+                ),
+            sa_token,
+            access_boundary.to_json()
             )
 
-        # get the federated token from GCP
-        federated_access_token = self.utils._get_federated_access_token( #pylint: disable=protected-access
-            caller_identity_token,
-            self.x_goog_cloud_target_resource
+        # the downscoped token never outlives its source token
+        expires_at = parse_expire_time(sa_expire_time)
+        if expires_in is not None:
+            expires_at = min(expires_at, issued_at + datetime.timedelta(seconds=expires_in))
+        expire_time = expires_at.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return CachedToken(downscoped_token, expire_time, expires_at, issued_at)
+
+    def _downscoped_cache_key(
+        self,
+        access_boundary: CredentialAccessBoundary
+        ) -> Tuple[str, str, str, str, str]:
+        return (
+            "downscoped",
+            self.gcp_service_account_email,
+            self.gcp_token_scopes,
+            self.gcp_token_lifetime,
+            access_boundary.hash
             )
 
-        # get the SA token
-        self.gcp_sa_token, sa_expire_time = self.utils._get_sa_token(federated_access_token, self.gcp_token_lifetime, self.gcp_token_scopes) #pylint: disable=protected-access
+    def _id_token_cache_key(self, audience: str, include_email: bool) -> Tuple[str, str, str, bool]:
+        return ("id_token", self.gcp_service_account_email, audience, include_email)
+
+    def _rate_limited_sa_token(self, gcp_service_account_email: str):
+        """
+        utils._get_sa_token, admitted by the rate limiter in the queue of the service account
+        """
+        return rate_limited(
+            self.rate_limiter,
+            IAM_CREDENTIALS,
+            gcp_service_account_email,
+            self.utils._get_sa_token #pylint: disable=protected-access
+            )
+
+    def _federated_cache_key(self) -> Tuple[str, str, str]:
+        return (self.aws_account_id, self.aws_role_name, self.x_goog_cloud_target_resource)
+
+    def _cached_federated_token(self) -> Optional[str]:
+        """
+        Return the cached federated token if it is not about to expire
+        """
+        cached = self.federated_token_cache.get(
+            self._federated_cache_key(),
+            min_ttl=self.token_refresh_skew
+            )
+        if self._observers:
+            notify_cache(self._observers, FEDERATED_TOKEN, cached is not None)
+        return cached.token if cached is not None else None
+
+    def _store_federated_token(
+        self,
+        federated_token: str,
+        expires_in: int,
+        issued_at: datetime.datetime
+        ) -> None:
+        expires_at = issued_at + datetime.timedelta(seconds=expires_in)
+        cached = CachedToken(
+            federated_token,
+            expires_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            expires_at,
+            issued_at
+            )
+        self.federated_token_cache.set(self._federated_cache_key(), cached)
+        self.gcp_federated_token = federated_token
+
+    def _cached_federated_token_rejected(
+        self,
+        err: Exception,
+        issued_at: datetime.datetime
+        ) -> bool:
+        """
+        True if generateAccessToken returned 401 for a federated token
+        that was served from the cache (e.g. it has been revoked)
+        """
+        response = getattr(err, "response", None)
+        if response is None or response.status_code != 401:
+            return False
+
+        cached = self.federated_token_cache.peek(self._federated_cache_key())
+        return cached is not None and cached.issued_at is not None and cached.issued_at < issued_at
+
+    def _get_federated_token(self, force_refresh: bool = False) -> str:
+        """
+        Return a GCP federated token, from the cache when possible,
+        otherwise by running the AWS leg and exchanging the result
+        """
+        if not force_refresh:
+            federated_token = self._cached_federated_token()
+            if federated_token is not None:
+                logger.debug("Serving cached federated token.")
+                return federated_token
+
+        key = self._federated_cache_key()
+        with self._federation_lock, self.federated_token_cache.refresh_lock(key):
+            if not force_refresh:
+                cached = self.federated_token_cache.peek(key)
+                if cached is not None and cached.seconds_remaining() > self.token_refresh_skew:
+                    return cached.token
+
+            issued_at = utcnow()
+            federated_token, expires_in = self._exchange_subject_token()
+            self._store_federated_token(federated_token, expires_in, issued_at)
+
+        return federated_token
+
+    def _exchange_subject_token(self) -> Tuple[str, int]:
+        """
+        Sign a subject token and exchange it for a federated token. A signature
+        rejected because our clock is off is re-signed with the server's time.
+        """
+        from requests.exceptions import HTTPError #pylint: disable=import-error,import-outside-toplevel
+
+        resigns = 0
+        while True:
+            subject_token = self._subject_token()
+            try:
+                return call_with_retries(
+                    self.retry_policy,
+                    self._observers,
+                    FEDERATED_TOKEN,
+                    rate_limited(
+                        self.rate_limiter,
+                        GOOGLE_STS,
+                        self._federated_cache_key(),
+                        self.utils._exchange_federated_token #pylint: disable=protected-access
+                        ),
+                    subject_token,
+                    self.x_goog_cloud_target_resource
+                    )
+            except HTTPError as err:
+                if resigns >= self.retry_policy.max_resigns or not signature_rejected(err):
+                    raise
+
+                offset = server_clock_offset(err)
+                if offset is not None:
+                    self.clock_offset = offset
+                resigns += 1
+                logger.warning(
+                    "Subject token signature rejected, re-signing with a clock offset of %ss.",
+                    int(self.clock_offset.total_seconds())
+                    )
+
+    def _subject_token(self) -> str:
+        """
+        Run the AWS leg: get the AWS credentials and sign the GetCallerIdentity
+        request into the URL encoded subject token for Google STS
+        """
+        credentials = timed(
+            self._observers,
+            ASSUME_ROLE,
+            self.utils._assume_role #pylint: disable=protected-access
+            )
+
+        # The date is generated and signed in one step. Signing with botocore used its
+        # own timestamp, which could differ from the x-amz-date sent to GCP and fail
+        # the signature check
+        now = None
+        if self.clock_offset:
+            now = datetime.datetime.now(datetime.timezone.utc) + self.clock_offset
 
-        return self.gcp_sa_token, sa_expire_time
+        return timed(self._observers, SIGN, self._subject_token_builder.build, credentials, now)
@@ -0,0 +1,172 @@
+"""
+Local token vending daemon that emulates the GCE metadata server.
+
+Google client libraries pointed at it with ``GCE_METADATA_HOST`` (and
+``GCE_METADATA_IP``) fetch their access tokens from the TokenService cache:
+
+    python -m scalesec_gcp_workload_identity.metadata_server --port 8080
+    export GCE_METADATA_HOST=127.0.0.1:8080 GCE_METADATA_IP=127.0.0.1:8080
+"""
+
+import argparse
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+from typing import Optional, Tuple
+from urllib.parse import urlsplit
+
+from scalesec_gcp_workload_identity.cache import parse_expire_time, utcnow
+from scalesec_gcp_workload_identity.main import TokenService
+
+logger = logging.getLogger(__name__)
+
+METADATA_FLAVOR = "Google"
+SERVICE_ACCOUNTS_PATH = "/computeMetadata/v1/instance/service-accounts/"
+
+
+class MetadataRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the subset of the metadata API used for service account credentials
+    """
+    server_version = "Metadata Server for VM"
+    sys_version = ""
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send(self, status: int, body: str, content_type: str = "application/text") -> None:
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Metadata-Flavor", METADATA_FLAVOR)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self): #pylint: disable=invalid-name
+        """
+        Route a metadata request
+        """
+        path = urlsplit(self.path).path
+
+        # the root is used by client libraries to detect the metadata server
+        if path == "/":
+            self._send(200, "")
+            return
+
+        # same protections as the real metadata server
+        if self.headers.get("X-Forwarded-For"):
+            self._send(403, "Forbidden")
+            return
+        if self.headers.get("Metadata-Flavor") != METADATA_FLAVOR:
+            self._send(403, "Missing Metadata-Flavor:Google header.")
+            return
+
+        try:
+            status, body, content_type = self.server.route(path)
+        except Exception as err: #pylint: disable=broad-except
+            logger.error("Failed to serve %s: %s", path, err)
+            self._send(500, "Failed to obtain a token")
+            return
+
+        self._send(status, body, content_type)
+
+
+class MetadataServer(ThreadingHTTPServer):
+    """
+    HTTP server answering metadata requests from a TokenService.
+    The token is renewed in the background so requests are served from cache.
+    """
+    daemon_threads = True
+
+    def __init__(
+        self,
+        token_service: TokenService,
+        server_address: Tuple[str, int] = ("127.0.0.1", 8080),
+        project_id: Optional[str] = None,
+        background_refresh: bool = True
+        ) -> None:
+        super().__init__(server_address, MetadataRequestHandler)
+        self.token_service = token_service
+        self.project_id = project_id
+        self.background_refresh = background_refresh
+
+    def serve_forever(self, poll_interval: float = 0.5) -> None:
+        if self.background_refresh:
+            self.token_service.start_background_refresh()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.token_service.stop_background_refresh()
+
+    def route(self, path: str) -> Tuple[int, str, str]: #pylint: disable=too-many-return-statements
+        """
+        Return the status, body and content type for a metadata path
+        """
+        if path == "/computeMetadata/v1/project/project-id" and self.project_id:
+            return 200, self.project_id, "application/text"
+        if path == "/computeMetadata/v1/project/numeric-project-id":
+            return 200, str(self.token_service.gcp_project_number), "application/text"
+
+        if not path.startswith(SERVICE_ACCOUNTS_PATH):
+            return 404, "Not Found", "text/html"
+
+        email = self.token_service.gcp_service_account_email
+        scopes = self.token_service.gcp_token_scopes.split(",")
+        account, _, attribute = path[len(SERVICE_ACCOUNTS_PATH):].partition("/")
+        if account not in ("default", email):
+            return 404, "Not Found", "text/html"
+
+        if attribute == "token":
+            sa_token, expire_time = self.token_service.get_token()
+            expires_in = int((parse_expire_time(expire_time) - utcnow()).total_seconds())
+            body = {"access_token": sa_token, "expires_in": expires_in, "token_type": "Bearer"}
+            return 200, json.dumps(body), "application/json"
+        if attribute == "email":
+            return 200, email, "application/text"
+        if attribute == "scopes":
+            return 200, "\n".join(scopes), "application/text"
+        if attribute == "":
+            body = {"aliases": ["default"], "email": email, "scopes": scopes}
+            return 200, json.dumps(body), "application/json"
+
+        return 404, "Not Found", "text/html"
+
+
+def main(argv=None) -> None:
+    """
+    Run the metadata server, configured from the same environment variables as the README
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--project-id", default=getenv("GCP_PROJECT_ID"))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    token_service = TokenService(
+        gcp_project_number=getenv('GCP_PROJECT_NUMBER'),
+        gcp_workload_id=getenv('GCP_WORKLOAD_ID'),
+        gcp_workload_provider=getenv('GCP_WORKLOAD_PROVIDER'),
+        gcp_service_account_email=getenv('GCP_SERVICE_ACCOUNT_EMAIL'),
+        aws_account_id=getenv('AWS_ACCOUNT_ID'),
+        aws_role_name=getenv('AWS_ROLE_NAME'),
+        aws_region=getenv('AWS_REGION'),
+        gcp_token_lifetime=getenv('TOKEN_LIFETIME') or "3600s",
+        gcp_token_scopes=getenv('TOKEN_SCOPES') or "https://www.googleapis.com/auth/cloud-platform"
+    )
+
+    server = MetadataServer(token_service, (args.host, args.port), project_id=args.project_id)
+    logger.info("Serving GCE metadata on %s:%s", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""
+Client-side rate limiting of the Google STS and IAM Credentials calls.
+
+Each upstream endpoint has a token bucket. Callers that find it empty wait
+(up to ``max_wait``) in per-service-account queues that are served round
+robin, so one busy service account cannot starve the others. A 429 pauses
+the endpoint for its ``Retry-After``.
+
+RateLimiter keeps the buckets in memory and is shared by every TokenService
+in the process that is given it (see ``get_shared_rate_limiter``).
+FileRateLimiter keeps them in lock protected files so every process on the
+host draws from the same buckets.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Hashable, Mapping, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+from scalesec_gcp_workload_identity import forking
+from scalesec_gcp_workload_identity.cache import default_cache_directory
+from scalesec_gcp_workload_identity.instrumentation import status_code_of
+from scalesec_gcp_workload_identity.retry import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_STS = "google_sts"
+IAM_CREDENTIALS = "iam_credentials"
+
+# (requests per second, burst) per endpoint
+DEFAULT_RATES: Dict[str, Tuple[float, float]] = {
+    GOOGLE_STS: (20.0, 40.0),
+    IAM_CREDENTIALS: (100.0, 200.0)
+}
+DEFAULT_RETRY_AFTER = 1.0
+
+_shared_rate_limiter: Optional["RateLimiter"] = None #pylint: disable=invalid-name
+_shared_rate_limiter_lock = threading.Lock()
+
+
+@forking.after_fork_in_child
+def _reset_shared_rate_limiter_lock() -> None:
+    global _shared_rate_limiter_lock #pylint: disable=global-statement,invalid-name
+    _shared_rate_limiter_lock = threading.Lock()
+
+
+class RateLimitExceeded(RuntimeError):
+    """
+    A caller waited ``max_wait`` seconds without being admitted
+    """
+
+
+class _BucketState: #pylint: disable=too-few-public-methods
+    __slots__ = ("tokens", "updated", "blocked_until")
+
+    def __init__(self, tokens: float, updated: float, blocked_until: float = 0.0) -> None:
+        self.tokens = tokens
+        self.updated = updated
+        self.blocked_until = blocked_until
+
+
+class _Endpoint: #pylint: disable=too-few-public-methods,too-many-instance-attributes
+    __slots__ = (
+        "rate", "burst", "state", "queues", "waiting",
+        "admitted", "delayed", "rejected", "throttled", "wait_seconds", "max_wait_seconds"
+        )
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.state = _BucketState(burst, now)
+        # service account -> FIFO of waiters, in round robin order
+        self.queues: "collections.OrderedDict[Hashable, Deque[object]]" = (
+            collections.OrderedDict())
+        self.waiting = 0
+
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+
+def _take(state: _BucketState, rate: float, burst: float, now: float) -> float:
+    """
+    Take a token from the bucket if possible. Returns 0 when one was taken,
+    otherwise the seconds until one is available.
+    """
+    if now < state.blocked_until:
+        return state.blocked_until - now
+
+    state.tokens = min(burst, state.tokens + (now - state.updated) * rate)
+    state.updated = now
+    if state.tokens >= 1:
+        state.tokens -= 1
+        return 0.0
+
+    return (1 - state.tokens) / rate
+
+
+class RateLimiter:
+    """
+    Token buckets per upstream endpoint with fair queuing across service accounts.
+
+    rates: endpoint -> (requests per second, burst); endpoints not listed are not limited
+    max_wait: the longest a caller waits before RateLimitExceeded is raised
+    """
+    def __init__(
+        self,
+        rates: Optional[Mapping[str, Tuple[float, float]]] = None,
+        max_wait: float = 10.0
+        ) -> None:
+        self.rates = dict(DEFAULT_RATES if rates is None else rates)
+        self.max_wait = max_wait
+
+        self._condition = threading.Condition()
+        self._endpoints: Dict[str, _Endpoint] = {}
+        forking.register(self)
+
+    def _after_fork_in_child(self) -> None:
+        """
+        The waiters of the parent do not exist in a forked child, drop their queues
+        """
+        self._condition = threading.Condition()
+        for state in self._endpoints.values():
+            state.queues.clear()
+            state.waiting = 0
+
+    def _endpoint(self, endpoint: str) -> Optional[_Endpoint]:
+        state = self._endpoints.get(endpoint)
+        if state is None and endpoint in self.rates:
+            rate, burst = self.rates[endpoint]
+            state = self._endpoints[endpoint] = _Endpoint(rate, burst, time.monotonic())
+        return state
+
+    def _try_take(self, endpoint: str, state: _Endpoint, now: float) -> float: #pylint: disable=unused-argument
+        """
+        Take a token for ``endpoint``, see _take. Called with the condition held.
+        """
+        return _take(state.state, state.rate, state.burst, now)
+
+    def _block(self, endpoint: str, state: _Endpoint, until: float) -> None: #pylint: disable=unused-argument
+        state.state.blocked_until = max(state.state.blocked_until, until)
+
+    def acquire(self, endpoint: str, key: Hashable = None) -> float:
+        """
+        Wait until a call to ``endpoint`` on behalf of ``key`` (e.g. the service
+        account) is admitted. Returns the seconds waited.
+        """
+        with self._condition:
+            state = self._endpoint(endpoint)
+            if state is None:
+                return 0.0
+
+            start = time.monotonic()
+            if not state.queues and self._try_take(endpoint, state, start) == 0:
+                state.admitted += 1
+                return 0.0
+
+            waiter = object()
+            state.queues.setdefault(key, collections.deque()).append(waiter)
+            state.waiting += 1
+            deadline = start + self.max_wait
+            try:
+                while True:
+                    now = time.monotonic()
+                    head_key = next(iter(state.queues))
+                    if state.queues[head_key][0] is waiter:
+                        delay = self._try_take(endpoint, state, now)
+                        if delay == 0:
+                            self._dequeue(state, key)
+                            break
+                    else:
+                        delay = self.max_wait
+
+                    if now >= deadline:
+                        self._remove(state, key, waiter)
+                        state.rejected += 1
+                        raise RateLimitExceeded(
+                            f"Waited {self.max_wait}s for the {endpoint} rate limit"
+                            )
+                    self._condition.wait(min(delay, deadline - now))
+            finally:
+                state.waiting -= 1
+                self._condition.notify_all()
+
+            waited = time.monotonic() - start
+            state.admitted += 1
+            state.delayed += 1
+            state.wait_seconds += waited
+            state.max_wait_seconds = max(state.max_wait_seconds, waited)
+
+        return waited
+
+    @staticmethod
+    def _dequeue(state: _Endpoint, key: Hashable) -> None:
+        queue = state.queues[key]
+        queue.popleft()
+        if queue:
+            # the next waiter of this service account goes to the back of the round
+            state.queues.move_to_end(key)
+        else:
+            del state.queues[key]
+
+    @staticmethod
+    def _remove(state: _Endpoint, key: Hashable, waiter: object) -> None:
+        queue = state.queues[key]
+        queue.remove(waiter)
+        if not queue:
+            del state.queues[key]
+
+    def throttled(self, endpoint: str, retry_after: Optional[float] = None) -> None:
+        """
+        Record a 429 from ``endpoint``: nobody is admitted for ``retry_after`` seconds
+        """
+        with self._condition:
+            state = self._endpoint(endpoint)
+            if state is None:
+                return
+            delay = DEFAULT_RETRY_AFTER if retry_after is None else retry_after
+            state.throttled += 1
+            self._block(endpoint, state, time.monotonic() + delay)
+            logger.info("%s is throttling, pausing it for %.2fs.", endpoint, delay)
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Per endpoint queue depth, admission counters and wait times in seconds
+        """
+        with self._condition:
+            return {
+                endpoint: {
+                    "queue_depth": state.waiting,
+                    "admitted": state.admitted,
+                    "delayed": state.delayed,
+                    "rejected": state.rejected,
+                    "throttled": state.throttled,
+                    "wait_seconds_total": state.wait_seconds,
+                    "wait_seconds_max": state.max_wait_seconds
+                }
+                for endpoint, state in self._endpoints.items()
+            }
+
+
+class FileRateLimiter(RateLimiter):
+    """
+    RateLimiter whose buckets are shared by every process on the host through
+    small files locked with ``flock``. Fair queuing applies within each process.
+    Wall clock time is used so that processes agree on the bucket state.
+    """
+    def __init__(
+        self,
+        rates: Optional[Mapping[str, Tuple[float, float]]] = None,
+        max_wait: float = 10.0,
+        directory: Optional[str] = None
+        ) -> None:
+        if fcntl is None: # pragma: no cover
+            raise RuntimeError("FileRateLimiter requires fcntl")
+        super().__init__(rates, max_wait)
+        self.directory = directory or os.path.join(default_cache_directory(), "ratelimit")
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def _update(self, endpoint: str, state: _Endpoint, update) -> float:
+        """
+        Apply ``update(bucket_state, now)`` to the shared state of ``endpoint``
+        """
+        path = os.path.join(self.directory, f"{endpoint}.json")
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            now = time.time()
+            raw = os.read(descriptor, 4096)
+            try:
+                data = json.loads(raw)
+                bucket = _BucketState(data["tokens"], data["updated"], data["blocked_until"])
+            except (ValueError, KeyError, TypeError):
+                bucket = _BucketState(state.burst, now)
+
+            result = update(bucket, now)
+
+            payload = json.dumps({
+                "tokens": bucket.tokens,
+                "updated": bucket.updated,
+                "blocked_until": bucket.blocked_until
+            }).encode("utf-8")
+            os.lseek(descriptor, 0, os.SEEK_SET)
+            os.ftruncate(descriptor, 0)
+            os.write(descriptor, payload)
+        finally:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+            os.close(descriptor)
+        return result
+
+    def _try_take(self, endpoint: str, state: _Endpoint, now: float) -> float:
+        return self._update(
+            endpoint,
+            state,
+            lambda bucket, wall_now: _take(bucket, state.rate, state.burst, wall_now)
+            )
+
+    def _block(self, endpoint: str, state: _Endpoint, until: float) -> None:
+        # ``until`` is on the monotonic clock, the shared state is on the wall clock
+        wall_until = time.time() + (until - time.monotonic())
+
+        def block(bucket: _BucketState, _now: float) -> float:
+            bucket.blocked_until = max(bucket.blocked_until, wall_until)
+            return 0.0
+
+        self._update(endpoint, state, block)
+
+
+def get_shared_rate_limiter() -> RateLimiter:
+    """
+    The process wide RateLimiter with the default rates, created on first use
+    """
+    global _shared_rate_limiter #pylint: disable=global-statement
+    with _shared_rate_limiter_lock:
+        if _shared_rate_limiter is None:
+            _shared_rate_limiter = RateLimiter()
+    return _shared_rate_limiter
+
+
+def rate_limited(
+    rate_limiter: Optional[RateLimiter],
+    endpoint: str,
+    key: Hashable,
+    func: Callable[..., Any]
+    ) -> Callable[..., Any]:
+    """
+    Wrap an upstream call so every invocation is admitted by ``rate_limiter``
+    and a 429 response pauses ``endpoint``
+    """
+    if rate_limiter is None:
+        return func
+
+    def call(*args):
+        rate_limiter.acquire(endpoint, key)
+        try:
+            return func(*args)
+        except Exception as err:
+            if status_code_of(err) == 429:
+                rate_limiter.throttled(endpoint, retry_after_seconds(err))
+            raise
+
+    return call
@@ -0,0 +1,75 @@
+"""
+Background renewal of cached SA tokens.
+"""
+
+import logging
+import random
+import threading
+
+from scalesec_gcp_workload_identity.cache import utcnow
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRefresher(threading.Thread):
+    """
+    Daemon thread that renews a TokenService token at a fraction of its lifetime.
+    """
+    def __init__(
+        self,
+        token_service,
+        refresh_fraction: float = 0.75,
+        jitter: float = 0.1,
+        retry_interval: float = 10.0
+        ) -> None:
+        super().__init__(name="gcp-token-refresher", daemon=True)
+
+        if not 0 < refresh_fraction < 1:
+            raise ValueError("refresh_fraction must be between 0 and 1")
+        if not 0 <= jitter < 1:
+            raise ValueError("jitter must be between 0 and 1")
+
+        self.token_service = token_service
+        self.refresh_fraction = refresh_fraction
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        self._stop_event = threading.Event()
+        # the jittered fraction is drawn once per token, identified by its issue time
+        self._jittered_for = None
+        self._jittered_fraction = refresh_fraction
+
+    def stop(self) -> None:
+        """
+        Ask the thread to exit at its next wake up
+        """
+        self._stop_event.set()
+
+    def _seconds_until_refresh(self) -> float:
+        cached = self.token_service.token_cache.peek(self.token_service._cache_key()) #pylint: disable=protected-access
+        if cached is None or cached.issued_at is None:
+            return 0.0
+
+        if cached.issued_at != self._jittered_for:
+            fraction = self.refresh_fraction * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._jittered_fraction = min(fraction, 1.0)
+            self._jittered_for = cached.issued_at
+
+        lifetime = (cached.expires_at - cached.issued_at).total_seconds()
+        refresh_at = cached.issued_at.timestamp() + lifetime * self._jittered_fraction
+
+        return refresh_at - utcnow().timestamp()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            delay = self._seconds_until_refresh()
+            if delay > 0:
+                self._stop_event.wait(delay)
+                continue
+
+            try:
+                logger.debug("Refreshing SA token in the background.")
+                self.token_service._refresh(force=True) #pylint: disable=protected-access
+            except Exception as err: #pylint: disable=broad-except
+                # Callers still hold a valid token or will refresh in the foreground
+                logger.error("Background token refresh failed: %s", err)
+                self._stop_event.wait(self.retry_interval)
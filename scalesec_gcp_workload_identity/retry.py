@@ -0,0 +1,248 @@
+"""
+Retries, hedging and clock skew handling for the Google token calls.
+
+Transient failures (429, 5xx, connection errors and timeouts) of the token
+exchange and generateAccessToken calls are retried with capped exponential
+backoff and full jitter, honouring ``Retry-After``. A hedged second request
+can be sent when the first is slower than ``hedge_after`` seconds.
+
+Google STS verifies the signed GetCallerIdentity request with AWS, which
+rejects signatures dated too far from its own clock. Such rejections are
+detected so the subject token can be re-signed with the clock corrected by
+the ``Date`` of the rejection.
+"""
+
+import datetime
+import email.utils
+import logging
+import random
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Optional, Sequence, Tuple
+
+from scalesec_gcp_workload_identity.forking import after_fork_in_child
+from scalesec_gcp_workload_identity.instrumentation import Observer, status_code_of, timed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# AWS errors relayed by Google STS when the subject token signature is rejected
+SIGNATURE_ERRORS = (
+    "SignatureDoesNotMatch",
+    "Signature expired",
+    "RequestExpired",
+    "RequestTimeTooSkewed",
+    "InvalidSignatureException"
+)
+
+_hedge_executor: Optional[ThreadPoolExecutor] = None #pylint: disable=invalid-name
+_hedge_executor_lock = threading.Lock()
+
+
+@after_fork_in_child
+def _forget_hedge_executor() -> None:
+    """
+    The worker threads of the parent's executor do not exist in a forked child
+    """
+    global _hedge_executor, _hedge_executor_lock #pylint: disable=global-statement,invalid-name
+    _hedge_executor = None
+    _hedge_executor_lock = threading.Lock()
+
+
+class RetryPolicy: #pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """
+    How the token exchange and generateAccessToken calls are retried.
+
+    max_attempts: calls per request, including the first (1 disables retries)
+    initial_backoff / max_backoff / multiplier: the exponential backoff cap in
+        seconds before attempt n + 1 is min(max_backoff, initial_backoff * multiplier ** (n - 1)),
+        the actual delay is drawn uniformly below it (full jitter)
+    retry_statuses: HTTP status codes that are retried
+    respect_retry_after: wait at least ``Retry-After`` (up to max_backoff) when it is sent
+    hedge_after: send a second, concurrent request if the first has not
+        completed after this many seconds, and use whichever succeeds first
+    max_resigns: times the subject token is re-signed after a signature or clock skew rejection
+    """
+    def __init__( #pylint: disable=too-many-arguments
+        self,
+        max_attempts: int = 3,
+        initial_backoff: float = 0.1,
+        max_backoff: float = 2.0,
+        multiplier: float = 2.0,
+        retry_statuses: Iterable[int] = DEFAULT_RETRY_STATUSES,
+        respect_retry_after: bool = True,
+        hedge_after: Optional[float] = None,
+        max_resigns: int = 1
+        ) -> None:
+        self.max_attempts = max(1, max_attempts)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.retry_statuses = frozenset(retry_statuses)
+        self.respect_retry_after = respect_retry_after
+        self.hedge_after = hedge_after
+        self.max_resigns = max_resigns
+
+    def __repr__(self):
+        return (
+            f"RetryPolicy(max_attempts={self.max_attempts}, "
+            f"max_backoff={self.max_backoff}, hedge_after={self.hedge_after})"
+            )
+
+    def is_retryable(self, err: BaseException) -> bool:
+        """
+        True if ``err`` is a transient failure worth retrying
+        """
+        status_code = status_code_of(err)
+        if status_code is not None:
+            return status_code in self.retry_statuses
+        return isinstance(err, _transient_exceptions())
+
+    def retry_delay(self, err: BaseException, attempt: int) -> Optional[float]:
+        """
+        Seconds to wait before retrying after ``attempt`` failed with ``err``,
+        or None if it should not be retried
+        """
+        if attempt >= self.max_attempts or not self.is_retryable(err):
+            return None
+
+        cap = min(self.max_backoff, self.initial_backoff * self.multiplier ** (attempt - 1))
+        delay = random.uniform(0, cap)
+
+        if self.respect_retry_after:
+            retry_after = retry_after_seconds(err)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_backoff))
+
+        return delay
+
+
+NO_RETRIES = RetryPolicy(max_attempts=1, max_resigns=0)
+
+
+def _transient_exceptions() -> Tuple[type, ...]:
+    exceptions = []
+    # only look at HTTP libraries that are already loaded
+    requests_exceptions = sys.modules.get("requests.exceptions")
+    if requests_exceptions is not None:
+        exceptions += [requests_exceptions.ConnectionError, requests_exceptions.Timeout]
+    httpx = sys.modules.get("httpx")
+    if httpx is not None:
+        exceptions.append(httpx.TransportError)
+    return tuple(exceptions)
+
+
+def _response_header(err: BaseException, name: str) -> Optional[str]:
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None)
+    return headers.get(name) if headers is not None else None
+
+
+def retry_after_seconds(err: BaseException) -> Optional[float]:
+    """
+    The ``Retry-After`` of the response that caused ``err``, in seconds
+    """
+    value = _response_header(err, "Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def signature_rejected(err: BaseException) -> bool:
+    """
+    True if Google STS rejected the subject token because of its signature or date
+    """
+    response = getattr(err, "response", None)
+    if response is None or getattr(response, "status_code", None) not in (400, 401, 403):
+        return False
+    text = getattr(response, "text", "") or ""
+    return any(error in text for error in SIGNATURE_ERRORS)
+
+
+def server_clock_offset(err: BaseException) -> Optional[datetime.timedelta]:
+    """
+    Server time minus local time, from the ``Date`` header of the response that caused ``err``
+    """
+    value = _response_header(err, "Date")
+    if not value:
+        return None
+    try:
+        server_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return server_time - datetime.datetime.now(datetime.timezone.utc)
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor #pylint: disable=global-statement
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(thread_name_prefix="token-hedge")
+    return _hedge_executor
+
+
+def _hedged_call( #pylint: disable=too-many-arguments
+    policy: RetryPolicy,
+    observers: Sequence[Observer],
+    stage: str,
+    func: Callable[..., Any],
+    args: tuple,
+    attempt: int
+    ) -> Any:
+    if policy.hedge_after is None:
+        return timed(observers, stage, func, *args, attempt=attempt, status_code=200)
+
+    executor = _get_hedge_executor()
+    pending = {executor.submit(timed, observers, stage, func, *args,
+                               attempt=attempt, status_code=200)}
+    done, pending = wait(pending, timeout=policy.hedge_after)
+    if not done:
+        logger.debug("%s slower than %ss, sending a hedged request.", stage, policy.hedge_after)
+        pending.add(executor.submit(timed, observers, stage, func, *args,
+                                    attempt=attempt, status_code=200))
+
+    error: Optional[BaseException] = None
+    while done or pending:
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        if not pending:
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    raise error
+
+
+def call_with_retries(
+    policy: RetryPolicy,
+    observers: Sequence[Observer],
+    stage: str,
+    func: Callable[..., Any],
+    *args
+    ) -> Any:
+    """
+    Call ``func(*args)`` under ``policy``, reporting every attempt to ``observers`` as ``stage``
+    """
+    attempt = 1
+    while True:
+        try:
+            return _hedged_call(policy, observers, stage, func, args, attempt)
+        except Exception as err: #pylint: disable=broad-except
+            delay = policy.retry_delay(err, attempt)
+            if delay is None:
+                raise
+            logger.info("%s attempt %s failed (%s), retrying in %.2fs.", stage, attempt, err, delay)
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,86 @@
+"""
+Pooled, keep-alive HTTP sessions for the Google STS and IAM Credentials calls.
+
+requests is imported on first use to keep ``import`` and construction cheap.
+"""
+
+import logging
+import socket
+import threading
+from typing import TYPE_CHECKING, Dict, Tuple
+
+from scalesec_gcp_workload_identity.forking import after_fork_in_child
+
+if TYPE_CHECKING: # pragma: no cover
+    import requests #pylint: disable=import-error
+
+logger = logging.getLogger(__name__)
+
+# connections kept open per host
+DEFAULT_POOL_SIZE = 10
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5.0, 30.0)
+
+# urllib3's default (TCP_NODELAY) plus TCP keep-alive
+KEEPALIVE_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+]
+
+_shared_sessions: Dict[Tuple[int, bool], "requests.Session"] = {}
+_shared_sessions_lock = threading.Lock()
+
+
+@after_fork_in_child
+def _forget_shared_sessions() -> None:
+    """
+    A forked child must not reuse the parent's pooled sockets
+    """
+    global _shared_sessions_lock #pylint: disable=global-statement,invalid-name
+    _shared_sessions_lock = threading.Lock()
+    _shared_sessions.clear()
+
+
+def build_session(
+    pool_maxsize: int = DEFAULT_POOL_SIZE,
+    keepalive: bool = True
+    ) -> "requests.Session":
+    """
+    Create a new session with a connection pool of ``pool_maxsize`` per host
+    """
+    import requests #pylint: disable=import-error,import-outside-toplevel,redefined-outer-name
+    from requests.adapters import HTTPAdapter #pylint: disable=import-error,import-outside-toplevel
+
+    adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+    if keepalive:
+        adapter.init_poolmanager(
+            pool_maxsize,
+            pool_maxsize,
+            socket_options=KEEPALIVE_SOCKET_OPTIONS
+            )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def get_shared_session(
+    pool_maxsize: int = DEFAULT_POOL_SIZE,
+    keepalive: bool = True
+    ) -> "requests.Session":
+    """
+    Return the process wide session for this pool configuration,
+    creating it on first use
+    """
+    key = (pool_maxsize, keepalive)
+    with _shared_sessions_lock:
+        session = _shared_sessions.get(key)
+        if session is None:
+            logger.debug("Creating shared HTTP session (pool_maxsize=%s).", pool_maxsize)
+            session = build_session(pool_maxsize, keepalive)
+            _shared_sessions[key] = session
+
+    return session
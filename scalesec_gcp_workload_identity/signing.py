@@ -0,0 +1,156 @@
+"""
+Precomputed SigV4 signing of the GetCallerIdentity subject token.
+
+The request signed for GCP never changes apart from the date, the session
+token and the signature, so the canonical request, the token JSON and its
+URL encoding are prepared once per (STS host, region, target resource).
+The derived signing key is cached per (secret key, date).
+"""
+
+import datetime
+import hashlib
+import hmac
+import json
+import threading
+import urllib.parse
+from typing import Dict, Optional, Tuple
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+SERVICE = "sts"
+QUERY_STRING = "Action=GetCallerIdentity&Version=2011-06-15"
+SIGNED_HEADERS = "host;x-amz-date;x-amz-security-token"
+EMPTY_PAYLOAD_HASH = hashlib.sha256(b"").hexdigest()
+
+# markers substituted into the prebuilt token template
+_AUTHORIZATION = "@@AUTHORIZATION@@"
+_DATE = "@@DATE@@"
+_SESSION_TOKEN = "@@SESSION_TOKEN@@"
+
+
+def _hmac(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _quote_json_string(value: str) -> str:
+    # the JSON encoding of a string without its quotes, then URL encoded
+    return urllib.parse.quote(json.dumps(value)[1:-1])
+
+
+class CallerIdentityTokenBuilder: #pylint: disable=too-many-instance-attributes
+    """
+    Builds the URL encoded caller identity token exchanged with Google STS
+    """
+    def __init__(
+        self,
+        host: str,
+        region: str,
+        x_goog_cloud_target_resource: str,
+        method: str = "POST"
+        ) -> None:
+        self.host = host
+        self.region = region
+        self.x_goog_cloud_target_resource = x_goog_cloud_target_resource
+        self.method = method
+        self.url = f"https://{host}?{QUERY_STRING}"
+
+        self._canonical_request_prefix = f"{method}\n/\n{QUERY_STRING}\nhost:{host}\nx-amz-date:"
+        self._signing_keys: Dict[Tuple[str, str], bytes] = {}
+        self._lock = threading.Lock()
+
+        identity_token = {
+            "url": self.url,
+            "method": method,
+            "headers": [
+                {"key": "Authorization", "value": _AUTHORIZATION},
+                {"key": "host", "value": host},
+                {"key": "x-amz-date", "value": _DATE},
+                {"key": "x-goog-cloud-target-resource", "value": x_goog_cloud_target_resource},
+                {"key": "x-amz-security-token", "value": _SESSION_TOKEN}
+            ]
+        }
+        template = json.dumps(identity_token)
+        head, rest = template.split(_AUTHORIZATION)
+        middle, rest = rest.split(_DATE)
+        tail_before_token, tail = rest.split(_SESSION_TOKEN)
+        self._template = tuple(
+            urllib.parse.quote(piece) for piece in (head, middle, tail_before_token, tail)
+            )
+
+    def _after_fork_in_child(self) -> None:
+        self._lock = threading.Lock()
+
+    def signing_key(self, secret_access_key: str, datestamp: str) -> bytes:
+        """
+        Derive (or reuse) the SigV4 signing key for a day
+        """
+        key = (secret_access_key, datestamp)
+        signing_key = self._signing_keys.get(key)
+        if signing_key is None:
+            signing_key = _hmac(("AWS4" + secret_access_key).encode("utf-8"), datestamp)
+            signing_key = _hmac(signing_key, self.region)
+            signing_key = _hmac(signing_key, SERVICE)
+            signing_key = _hmac(signing_key, "aws4_request")
+            with self._lock:
+                # keys for previous days are no longer useful
+                self._signing_keys = {key: signing_key}
+
+        return signing_key
+
+    def authorization_header(
+        self,
+        credentials: Tuple[str, str, str],
+        x_amz_date: str
+        ) -> str:
+        """
+        SigV4 Authorization header for the GetCallerIdentity request
+        """
+        access_key, secret_access_key, session_token = credentials
+        datestamp = x_amz_date[:8]
+        scope = f"{datestamp}/{self.region}/{SERVICE}/aws4_request"
+
+        canonical_request = (
+            f"{self._canonical_request_prefix}{x_amz_date}\n"
+            f"x-amz-security-token:{session_token}\n\n"
+            f"{SIGNED_HEADERS}\n{EMPTY_PAYLOAD_HASH}"
+            )
+        string_to_sign = (
+            f"{ALGORITHM}\n{x_amz_date}\n{scope}\n"
+            f"{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
+            )
+        signature = hmac.new(
+            self.signing_key(secret_access_key, datestamp),
+            string_to_sign.encode("utf-8"),
+            hashlib.sha256
+            ).hexdigest()
+
+        return (
+            f"{ALGORITHM} Credential={access_key}/{scope}, "
+            f"SignedHeaders={SIGNED_HEADERS}, Signature={signature}"
+            )
+
+    def build(
+        self,
+        credentials: Tuple[str, str, str],
+        now: Optional[datetime.datetime] = None
+        ) -> str:
+        """
+        Return the URL encoded caller identity token, signed at ``now`` (default: current time)
+
+        credentials: the AWS access key, secret access key and session token
+        """
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        x_amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+
+        authorization_header = self.authorization_header(credentials, x_amz_date)
+        head, middle, tail_before_token, tail = self._template
+
+        return "".join((
+            head,
+            _quote_json_string(authorization_header),
+            middle,
+            x_amz_date,
+            tail_before_token,
+            _quote_json_string(credentials[2]),
+            tail
+            ))
@@ -1,49 +1,114 @@
 """
 Utility functions and classes.
+
+boto3, botocore and requests are imported on first use so importing
+the package and constructing a TokenService stay cheap.
 """
 
+import datetime
 import json
 import logging
-from typing import Tuple
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 import urllib.parse
 
-import boto3 #pylint: disable=import-error
-from botocore import exceptions #pylint: disable=import-error
-from botocore.auth import SigV4Auth #pylint: disable=import-error
-from botocore.awsrequest import AWSRequest #pylint: disable=import-error
-import requests #pylint: disable=import-error
-
+from scalesec_gcp_workload_identity.credentials import AwsCredentials
+from scalesec_gcp_workload_identity.downscope import ACCESS_TOKEN_TYPE, TOKEN_EXCHANGE_GRANT_TYPE
+from scalesec_gcp_workload_identity.forking import after_fork_in_child
+from scalesec_gcp_workload_identity.session import (
+    DEFAULT_POOL_SIZE,
+    DEFAULT_TIMEOUT,
+    get_shared_session
+)
 
 logger = logging.getLogger(__name__)
 
+GLOBAL_STS_HOST = "sts.amazonaws.com"
+GOOGLE_STS_URL = "https://sts.googleapis.com/v1beta/token"
+IAM_CREDENTIALS_URL = "https://iamcredentials.googleapis.com/v1"
+
+_sts_clients: Dict[Tuple[Optional[str], ...], Any] = {}
+_sts_clients_lock = threading.Lock()
+
+
+@after_fork_in_child
+def _forget_sts_clients() -> None:
+    """
+    boto3 clients hold pooled connections, a forked child creates its own
+    """
+    global _sts_clients_lock #pylint: disable=global-statement,invalid-name
+    _sts_clients_lock = threading.Lock()
+    _sts_clients.clear()
+
+
+def sts_host(region: Optional[str] = None) -> str:
+    """
+    Hostname of the regional AWS STS endpoint, or the global one if no region is given
+    """
+    if not region or region == "global":
+        return GLOBAL_STS_HOST
+
+    suffix = "amazonaws.com.cn" if region.startswith("cn-") else "amazonaws.com"
+    return f"sts.{region}.{suffix}"
+
 
-class BearerAuth(requests.auth.AuthBase): #pylint: disable=too-few-public-methods
+def get_sts_client(region_name: Optional[str] = None, endpoint_url: Optional[str] = None):
     """
-    Returns a requests authorization object with the bearer token
+    Return a boto3 STS client shared by every Utils in the process with the
+    same region, endpoint and credential source, creating it on first use
     """
-    def __init__(self, token):
-        self.token = token
-    def __call__(self, auth_request):
-        auth_request.headers["authorization"] = "Bearer " + self.token
-        return auth_request
+    key = (
+        region_name,
+        endpoint_url,
+        os.environ.get("AWS_PROFILE"),
+        os.environ.get("AWS_ACCESS_KEY_ID")
+        )
+    with _sts_clients_lock:
+        client = _sts_clients.get(key)
+        if client is None:
+            import boto3 #pylint: disable=import-error,import-outside-toplevel
+
+            logger.debug("Creating shared STS client.")
+            client = boto3.client('sts', region_name=region_name, endpoint_url=endpoint_url)
+            _sts_clients[key] = client
+
+    return client
 
 
 class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-methods
     """
     Utility for AWS STS.
     """
-    def __init__( #pylint: disable=too-many-arguments
+    def __init__( #pylint: disable=too-many-arguments,too-many-locals
         self,
         aws_account_id: str,
         aws_role_name: str,
         aws_region: str,
         method: str,
         host: str,
-        gcp_service_account_email: str
+        gcp_service_account_email: str,
+        aws_session_duration: int = 3600,
+        aws_credentials_refresh_skew: int = 300,
+        session=None,
+        http_timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT,
+        http_pool_maxsize: int = DEFAULT_POOL_SIZE,
+        credential_provider: Optional[Callable[[], AwsCredentials]] = None,
+        sts_region: Optional[str] = None,
+        sts_endpoint_url: Optional[str] = None,
+        gcp_sts_url: str = GOOGLE_STS_URL,
+        gcp_iam_credentials_url: str = IAM_CREDENTIALS_URL
         ) -> None:
 
-        # Init STS client
-        self.sts_client = boto3.client('sts')
+        # STS client, shared process wide and created on first use
+        self._sts_client = None
+        self._shared_sts_client = True
+
+        # Pooled HTTP session for the Google APIs, shared process wide by default
+        self._session = session
+        self._shared_session = session is None
+        self.http_timeout = http_timeout
+        self.http_pool_maxsize = http_pool_maxsize
 
         self.aws_account_id = aws_account_id
         self.aws_role_name = aws_role_name
@@ -52,12 +117,78 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
         self.host = host
         self.gcp_service_account_email = gcp_service_account_email
 
+        # AssumeRole credentials are reused until ``aws_credentials_refresh_skew``
+        # seconds before their expiration
+        self.aws_session_duration = aws_session_duration
+        self.aws_credentials_refresh_skew = aws_credentials_refresh_skew
+        self._assumed_credentials: Optional[Tuple[str, str, str]] = None
+        self._assumed_credentials_expiration: Optional[datetime.datetime] = None
+        self._assume_role_lock = threading.Lock()
+
+        # When set, credentials come from this callable instead of sts:AssumeRole
+        self.credential_provider = credential_provider
+
+        # Region of the STS endpoint at ``host``, None for the global endpoint
+        # which is signed for us-east-1
+        self.sts_region = sts_region
+        self.signing_region = sts_region or "us-east-1"
+
         # STS url for GetCallerIdentity
-        self.url = 'https://sts.amazonaws.com?Action=GetCallerIdentity&Version=2011-06-15'
+        self.url = f'https://{self.host}?Action=GetCallerIdentity&Version=2011-06-15'
+
+        # Endpoints actually called, overridable e.g. for private endpoints or local fakes
+        self.sts_endpoint_url = sts_endpoint_url or f"https://{self.host}"
+        self.gcp_sts_url = gcp_sts_url
+        self.gcp_iam_credentials_url = gcp_iam_credentials_url.rstrip("/")
+
+    @property
+    def sts_client(self):
+        """
+        boto3 STS client
+        """
+        if self._sts_client is None:
+            self._sts_client = get_sts_client(self.signing_region, self.sts_endpoint_url)
+        return self._sts_client
+
+    @sts_client.setter
+    def sts_client(self, client) -> None:
+        self._sts_client = client
+        self._shared_sts_client = False
+
+    @property
+    def session(self):
+        """
+        requests session used for the Google APIs
+        """
+        if self._session is None:
+            self._session = get_shared_session(pool_maxsize=self.http_pool_maxsize)
+        return self._session
+
+    @session.setter
+    def session(self, session) -> None:
+        self._session = session
+        self._shared_session = False
+
+    def _after_fork_in_child(self) -> None:
+        """
+        Drop the parent's clients and connections, keeping the cached AWS credentials
+        """
+        self._assume_role_lock = threading.Lock()
+        if self._shared_sts_client:
+            self._sts_client = None
+        if self._shared_session:
+            self._session = None
+        elif self._session is not None:
+            # an injected session is kept, without the connections of the parent
+            self._session.close()
+        if hasattr(self.credential_provider, "_after_fork_in_child"):
+            self.credential_provider._after_fork_in_child() #pylint: disable=protected-access
 
     def _assume_role(self) -> Tuple[str, str, str]:
         """
-        Assumes the AWS IAM role used for federation
+        Assumes the AWS IAM role used for federation, reusing the
+        previous credentials until they are close to expiring.
+        With a ``credential_provider`` the ambient credentials are used instead.
 
         Returns:
             aws_access_key: str - AWS access key from the assumed IAM role
@@ -65,12 +196,46 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
             aws_session_token: str - AWS session token from the assumed IAM role
         """
 
+        with self._assume_role_lock:
+            if self._assumed_credentials_valid():
+                logger.debug("Reusing cached AWS IAM Role credentials.")
+                return self._assumed_credentials
+
+            if self.credential_provider is not None:
+                credentials = self.credential_provider()
+            else:
+                credentials = self._call_assume_role()
+            self._assumed_credentials = credentials[:3]
+            self._assumed_credentials_expiration = credentials[3]
+
+        return self._assumed_credentials
+
+    def _assumed_credentials_valid(self) -> bool:
+        if self._assumed_credentials is None or self._assumed_credentials_expiration is None:
+            return False
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        remaining = (self._assumed_credentials_expiration - now).total_seconds()
+        return remaining > self.aws_credentials_refresh_skew
+
+    def _call_assume_role(self) -> AwsCredentials:
+        """
+        Calls sts:AssumeRole
+
+        Returns:
+            the access key, secret access key and session token,
+            followed by the credentials expiration
+        """
+
+        from botocore import exceptions #pylint: disable=import-error,import-outside-toplevel
+
         # Assume AWS IAM role
         try:
             logger.info("Assuming AWS IAM Role.")
             assumed_role_object: dict = self.sts_client.assume_role(
                 RoleArn=f"arn:aws:iam::{self.aws_account_id}:role/{self.aws_role_name}",
-                RoleSessionName=self.aws_role_name
+                RoleSessionName=self.aws_role_name,
+                DurationSeconds=self.aws_session_duration
             )
         except exceptions.ClientError as err:
             raise err
@@ -91,12 +256,17 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
             logger.error("Something went wrong getting AssumeRole credentials")
             raise err
 
-        return aws_access_key, aws_secret_access_key, aws_session_token
+        # boto3 parses Expiration into a timezone aware datetime
+        expiration: Optional[datetime.datetime] = credentials.get('Expiration')
+
+        return aws_access_key, aws_secret_access_key, aws_session_token, expiration
 
     def _signed_request(self, data=None, params=None, headers=None, credentials=None) -> str:
         """
         Function to sign a request using botocore implementation
         """
+        from botocore.auth import SigV4Auth #pylint: disable=import-error,import-outside-toplevel
+        from botocore.awsrequest import AWSRequest #pylint: disable=import-error,import-outside-toplevel
 
         request = AWSRequest(
             method=self.method,
@@ -108,7 +278,7 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
 
         # inject auth header into requests object
         # SigV4Auth will split the query string automatically
-        SigV4Auth(credentials, "sts", self.aws_region).add_auth(request)
+        SigV4Auth(credentials, "sts", self.signing_region).add_auth(request)
 
         # return the auth object as thats the only thing we care about
         auth_headers = request.headers['Authorization']
@@ -153,7 +323,7 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
         """
 
         identity_token = {
-            "url": "https://sts.amazonaws.com?Action=GetCallerIdentity&Version=2011-06-15",
+            "url": self.url,
             "method": self.method,
             "headers": [
                 {
@@ -181,21 +351,24 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
 
         return identity_token
 
-    def _get_federated_access_token( #pylint: disable=no-self-use
+    def _federated_token_request( #pylint: disable=no-self-use
         self,
-        caller_identity_token: dict,
+        caller_identity_token: Union[dict, str],
         x_goog_cloud_target_resource: str
-        ) -> str:
+        ) -> Tuple[str, dict, dict]:
         """
-        Exchange our Caller Identity Token for a GCP federated token
+        Build the token exchange request for our Caller Identity Token,
+        given as a dict or already url encoded
 
         Returns:
-
-            federated_token: str - the GCP service account federated access token
+            url, json body and headers of the request
         """
 
         # token json must be url encoded
-        encoded_token: str = urllib.parse.quote(json.dumps(caller_identity_token))
+        if isinstance(caller_identity_token, str):
+            encoded_token = caller_identity_token
+        else:
+            encoded_token = urllib.parse.quote(json.dumps(caller_identity_token))
 
         # Create the body for our token exchange request
         body = {
@@ -207,32 +380,66 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
             "subjectToken": encoded_token
         }
 
-        # Add json headers and send the request
+        # Add json headers
         headers = {"content-type": "application/json; charset=utf-8"}
 
-        response = requests.post(
-            "https://sts.googleapis.com/v1beta/token",
-            json=body,
-            headers=headers
-            )
-        try:
-            federated_token: str = response.json()['access_token']
-        except KeyError:
+        return self.gcp_sts_url, body, headers
+
+    @staticmethod
+    def _parse_federated_token_response(response) -> Tuple[str, int]:
+        """
+        Extract the federated token and its lifetime in seconds from a Google STS response
+        """
+        # check the status first, a 5xx from the Google front end may not be JSON
+        if response.status_code != 200:
             logger.fatal("Failed to get federated token")
             logger.error(response.text)
             response.raise_for_status()
 
-        return federated_token
+        data = response.json()
+        return data['access_token'], int(data.get('expires_in', 3600))
 
-    def _get_sa_token(self, federated_token: str, gcp_token_lifetime: str, gcp_token_scopes: str) -> Tuple[str, str]: #pylint: disable=line-too-long
+    def _exchange_federated_token(
+        self,
+        caller_identity_token: Union[dict, str],
+        x_goog_cloud_target_resource: str
+        ) -> Tuple[str, int]:
         """
-        Exchanges a federated token (limited service support) for a a better supported SA token
+        Exchange our Caller Identity Token for a GCP federated token
 
         Returns:
-            accessToken: a GCP service account access token -
-            https://cloud.google.com/iam/docs/creating-short-lived-service-account-credentials#sa-credentials-oauth
 
-            expireTime: also called the token lifetime. Default is 1 hour
+            federated_token: str - the GCP service account federated access token
+            expires_in: int - the federated token lifetime in seconds
+        """
+
+        url, body, headers = self._federated_token_request(
+            caller_identity_token,
+            x_goog_cloud_target_resource
+            )
+
+        response = self.session.post(
+            url,
+            json=body,
+            headers=headers,
+            timeout=self.http_timeout
+            )
+
+        return self._parse_federated_token_response(response)
+
+    def _sa_token_request(
+        self,
+        federated_token: str,
+        gcp_token_lifetime: str,
+        gcp_token_scopes: str,
+        gcp_service_account_email: Optional[str] = None
+        ) -> Tuple[str, dict, dict]:
+        """
+        Build the generateAccessToken request for our federated token,
+        impersonating ``gcp_service_account_email`` (defaults to our own SA)
+
+        Returns:
+            url, json body and headers (including the bearer token) of the request
         """
 
         # Create the body for our token exchange request
@@ -241,16 +448,25 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
             "lifetime": gcp_token_lifetime
         }
 
-        # Add json headers and send the request
-        headers = {"content-type": "application/json; charset=utf-8", "Accept": "application/json"}
+        # Add json and auth headers
+        headers = {
+            "content-type": "application/json; charset=utf-8",
+            "Accept": "application/json",
+            "authorization": "Bearer " + federated_token
+            }
 
-        response = requests.post(
-            f"https://iamcredentials.googleapis.com/v1/projects/-/serviceAccounts/{self.gcp_service_account_email}:generateAccessToken", #pylint: disable=line-too-long
-            json=body,
-            headers=headers,
-            auth=BearerAuth(federated_token)
-            )
+        if gcp_service_account_email is None:
+            gcp_service_account_email = self.gcp_service_account_email
+
+        url = f"{self.gcp_iam_credentials_url}/projects/-/serviceAccounts/{gcp_service_account_email}:generateAccessToken" #pylint: disable=line-too-long
 
+        return url, body, headers
+
+    @staticmethod
+    def _parse_sa_token_response(response) -> Tuple[str, str]:
+        """
+        Extract the SA token and its expiry from a generateAccessToken response
+        """
         if response.status_code != 200:
             logger.fatal("Error getting SA token")
             logger.error(response.text)
@@ -258,3 +474,175 @@ class Utils: #pylint: disable=too-many-instance-attributes,too-few-public-method
 
         data = response.json()
         return data['accessToken'], data['expireTime']
+
+    def _downscoped_token_request(
+        self,
+        source_token: str,
+        access_boundary: str
+        ) -> Tuple[str, dict, dict]:
+        """
+        Build the token exchange request downscoping ``source_token`` (a SA access token)
+        to ``access_boundary``, the JSON encoded Credential Access Boundary
+
+        Returns:
+            url, json body and headers of the request
+        """
+        body = {
+            "grantType": TOKEN_EXCHANGE_GRANT_TYPE,
+            "requestedTokenType": ACCESS_TOKEN_TYPE,
+            "subjectTokenType": ACCESS_TOKEN_TYPE,
+            "subjectToken": source_token,
+            "options": access_boundary
+        }
+
+        headers = {"content-type": "application/json; charset=utf-8"}
+
+        return self.gcp_sts_url, body, headers
+
+    @staticmethod
+    def _parse_downscoped_token_response(response) -> Tuple[str, Optional[int]]:
+        """
+        Extract the downscoped token and, if sent, its lifetime in seconds from a Google STS
+        response. Without a lifetime the token expires with its source token.
+        """
+        if response.status_code != 200:
+            logger.fatal("Error getting downscoped token")
+            logger.error(response.text)
+            response.raise_for_status()
+
+        data = response.json()
+        expires_in = data.get('expires_in')
+        return data['access_token'], int(expires_in) if expires_in is not None else None
+
+    def _exchange_downscoped_token(
+        self,
+        source_token: str,
+        access_boundary: str
+        ) -> Tuple[str, Optional[int]]:
+        """
+        Exchange a SA access token for a token restricted to a Credential Access Boundary
+
+        Returns:
+            access_token: the downscoped token
+            expires_in: its lifetime in seconds, None if it expires with the source token
+        """
+
+        url, body, headers = self._downscoped_token_request(source_token, access_boundary)
+
+        response = self.session.post(
+            url,
+            json=body,
+            headers=headers,
+            timeout=self.http_timeout
+            )
+
+        return self._parse_downscoped_token_response(response)
+
+    def _id_token_request(
+        self,
+        credential_token: str,
+        audience: str,
+        include_email: bool = False,
+        gcp_service_account_email: Optional[str] = None
+        ) -> Tuple[str, dict, dict]:
+        """
+        Build the generateIdToken request for ``audience``, authorized by a federated
+        or SA access token and impersonating ``gcp_service_account_email``
+        (defaults to our own SA)
+
+        Returns:
+            url, json body and headers (including the bearer token) of the request
+        """
+        body = {
+            "audience": audience,
+            "includeEmail": include_email
+        }
+
+        headers = {
+            "content-type": "application/json; charset=utf-8",
+            "Accept": "application/json",
+            "authorization": "Bearer " + credential_token
+            }
+
+        if gcp_service_account_email is None:
+            gcp_service_account_email = self.gcp_service_account_email
+
+        url = f"{self.gcp_iam_credentials_url}/projects/-/serviceAccounts/{gcp_service_account_email}:generateIdToken" #pylint: disable=line-too-long
+
+        return url, body, headers
+
+    @staticmethod
+    def _parse_id_token_response(response) -> str:
+        """
+        Extract the ID token from a generateIdToken response
+        """
+        if response.status_code != 200:
+            logger.fatal("Error getting ID token")
+            logger.error(response.text)
+            response.raise_for_status()
+
+        return response.json()['token']
+
+    def _get_id_token(
+        self,
+        credential_token: str,
+        audience: str,
+        include_email: bool = False,
+        gcp_service_account_email: Optional[str] = None
+        ) -> str:
+        """
+        Mint an OIDC ID token for ``audience`` (e.g. a Cloud Run URL or an IAP client ID)
+
+        Returns:
+            token: a Google signed JWT, valid for one hour -
+            https://cloud.google.com/iam/docs/create-short-lived-credentials-direct#sa-credentials-oidc
+        """
+
+        url, body, headers = self._id_token_request(
+            credential_token,
+            audience,
+            include_email,
+            gcp_service_account_email
+            )
+
+        response = self.session.post(
+            url,
+            json=body,
+            headers=headers,
+            timeout=self.http_timeout
+            )
+
+        return self._parse_id_token_response(response)
+
+    def _get_sa_token(
+        self,
+        federated_token: str,
+        gcp_token_lifetime: str,
+        gcp_token_scopes: str,
+        gcp_service_account_email: Optional[str] = None
+        ) -> Tuple[str, str]:
+        """
+        Exchanges a federated token (limited service support) for a a better supported SA token
+
+        Returns:
+            accessToken: a GCP service account access token -
+            https://cloud.google.com/iam/docs/creating-short-lived-service-account-credentials#sa-credentials-oauth
+
+            expireTime: also called the token lifetime. Default is 1 hour
+        """
+
+        url, body, headers = self._sa_token_request(
+            federated_token,
+            gcp_token_lifetime,
+            gcp_token_scopes,
+            gcp_service_account_email
+            )
+
+        response = self.session.post(
+            url,
+            json=body,
+            headers=headers,
+            timeout=self.http_timeout
+            )
+
+        return self._parse_sa_token_response(response)
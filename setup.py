@@ -19,17 +19,26 @@ setup(
     author_email = 'info@scalesec.com',
     url='https://github.com/ScaleSec/gcp-workload-identity-federation',
     scripts=[],
+    entry_points={
+        'console_scripts': [
+            'scalesec-gcp-workload-identity=scalesec_gcp_workload_identity.cli:main'
+        ]
+    },
     packages=find_packages(exclude=['tests*']),
     install_requires=requires,
+    extras_require={
+        'async': ['httpx'],
+        'http2': ['httpx[http2]'],
+        'opentelemetry': ['opentelemetry-api']
+    },
     license="Apache License 2.0",
-    python_requires=">= 3.6, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*, !=3.5.*",
+    python_requires=">= 3.7",
     classifiers=[
         'Intended Audience :: Developers',
         'Natural Language :: English',
         'License :: OSI Approved :: Apache Software License',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
     ],
@@ -0,0 +1,51 @@
+"""
+Fixtures shared by the test modules.
+"""
+
+import pytest #pylint: disable=import-error
+
+from benchmarks.fakes import FakeUpstreams #pylint: disable=import-error
+from scalesec_gcp_workload_identity.main import TokenService #pylint: disable=import-error
+
+
+@pytest.fixture(name="workload")
+def fixture_workload() -> dict:
+    """
+    Arguments identifying the test workload: AWS role, workload pool, provider and SA
+    """
+    return {
+        "gcp_project_number": "123456789123",
+        "gcp_workload_id": "pool",
+        "gcp_workload_provider": "provider",
+        "gcp_service_account_email": "sa@project.iam.gserviceaccount.com",
+        "aws_account_id": "123456789123",
+        "aws_role_name": "role",
+        "aws_region": "us-east-1"
+    }
+
+
+@pytest.fixture(name="fake")
+def fixture_fake(monkeypatch):
+    """
+    Fake AWS STS, Google STS and IAM Credentials on a free port
+    """
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "AKIAFAKETEST")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "fake-secret")
+    with FakeUpstreams(seed=0) as fake:
+        yield fake
+
+
+@pytest.fixture(name="make_token_service")
+def fixture_make_token_service(workload):
+    """
+    Factory of TokenServices for the test workload, pointed at ``fake`` if given.
+    Keyword arguments override the workload and TokenService defaults.
+    """
+    def make_token_service(fake: FakeUpstreams = None, **kwargs) -> TokenService:
+        arguments = dict(workload)
+        if fake is not None:
+            arguments.update(fake.token_service_kwargs())
+        arguments.update(kwargs)
+        return TokenService(**arguments)
+
+    return make_token_service
@@ -0,0 +1,214 @@
+"""
+Unit tests for AsyncTokenService.
+"""
+
+import asyncio
+import datetime
+from unittest import mock
+
+import pytest #pylint: disable=import-error
+
+httpx = pytest.importorskip("httpx")
+
+from scalesec_gcp_workload_identity.aio import AsyncTokenService #pylint: disable=import-error,wrong-import-position
+from scalesec_gcp_workload_identity.cache import ( #pylint: disable=import-error,wrong-import-position
+    CachedToken,
+    FileTokenCache,
+    utcnow
+)
+from scalesec_gcp_workload_identity.circuit import CLOSED, CircuitBreaker #pylint: disable=import-error,wrong-import-position
+
+
+def _handler(calls: list):
+    def handler(request):
+        calls.append(request.url.host)
+        if request.url.host == "sts.googleapis.com":
+            return httpx.Response(200, json={"access_token": "federated", "expires_in": 3600})
+        assert request.headers["authorization"] == "Bearer federated"
+        return httpx.Response(200, json={
+            "accessToken": "ya29.async",
+            "expireTime": "2099-01-01T00:00:00Z"
+        })
+    return handler
+
+
+def _token_service(workload: dict, handler) -> AsyncTokenService:
+    return AsyncTokenService(
+        **workload,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+
+
+def test_concurrent_coroutines_share_one_mint(workload):
+    """
+    Concurrent get_token() calls should result in a single token exchange
+    """
+    calls = []
+    token_service = _token_service(workload, _handler(calls))
+
+    async def run():
+        with mock.patch.object(token_service.token_service, "_subject_token",
+                               return_value="subject") as subject_token:
+            results = await asyncio.gather(*[token_service.get_token() for _ in range(10)])
+            cached = await token_service.get_token()
+        return results, cached, subject_token.call_count
+
+    results, cached, aws_calls = asyncio.run(run())
+
+    assert {token for token, _ in results} == {"ya29.async"}
+    assert cached == ("ya29.async", "2099-01-01T00:00:00Z")
+    assert aws_calls == 1
+    assert calls == ["sts.googleapis.com", "iamcredentials.googleapis.com"]
+
+
+def test_forced_refresh_does_not_join_cached_mint(workload):
+    """
+    A forced get_token() waits for a mint in flight, then mints again
+    """
+    calls = []
+    token_service = _token_service(workload, _handler(calls))
+
+    async def run():
+        with mock.patch.object(token_service.token_service, "_subject_token",
+                               return_value="subject"):
+            inflight = asyncio.ensure_future(token_service.get_token())
+            await asyncio.sleep(0)
+            await asyncio.gather(
+                token_service.get_token(force_refresh=True),
+                token_service.get_token(force_refresh=True)
+                )
+            return await inflight
+
+    assert asyncio.run(run())[0] == "ya29.async"
+    assert calls == [
+        "sts.googleapis.com",
+        "iamcredentials.googleapis.com",
+        "iamcredentials.googleapis.com"
+    ]
+
+
+def test_transient_failure_is_retried(workload):
+    """
+    A 503 from IAM Credentials is retried under the TokenService retry policy
+    """
+    calls = []
+    handler = _handler(calls)
+
+    def flaky(request):
+        if request.url.host == "iamcredentials.googleapis.com" and "flaked" not in calls:
+            calls.append("flaked")
+            return httpx.Response(503, json={"error": {"code": 503}})
+        return handler(request)
+
+    token_service = _token_service(workload, flaky)
+
+    async def run():
+        with mock.patch.object(token_service.token_service, "_subject_token",
+                               return_value="subject"):
+            return await token_service.get_token()
+
+    assert asyncio.run(run())[0] == "ya29.async"
+    assert calls == ["sts.googleapis.com", "flaked", "iamcredentials.googleapis.com"]
+
+
+def test_rejected_federated_token_is_exchanged_again(workload):
+    """
+    A 401 for a cached federated token exchanges a new one, as TokenService does
+    """
+    calls = []
+    handler = _handler(calls)
+
+    def revoked(request):
+        if request.headers.get("authorization") == "Bearer revoked":
+            calls.append("revoked")
+            return httpx.Response(401, json={"error": {"code": 401}})
+        return handler(request)
+
+    token_service = _token_service(workload, revoked)
+    token_service.token_service._store_federated_token( #pylint: disable=protected-access
+        "revoked", 3600, utcnow() - datetime.timedelta(seconds=10)
+        )
+
+    async def run():
+        with mock.patch.object(token_service.token_service, "_subject_token",
+                               return_value="subject"):
+            return await token_service.get_token()
+
+    assert asyncio.run(run())[0] == "ya29.async"
+    assert calls == ["revoked", "sts.googleapis.com", "iamcredentials.googleapis.com"]
+
+
+def test_refresh_waits_for_other_processes(workload, tmp_path):
+    """
+    With a FileTokenCache the refresh takes the file lock and serves the
+    token another process stored while it waited
+    """
+    calls = []
+    cache = FileTokenCache(str(tmp_path))
+    token_service = _token_service(dict(workload, token_cache=cache), _handler(calls))
+    key = token_service.token_service._cache_key() #pylint: disable=protected-access
+    expires_at = utcnow() + datetime.timedelta(hours=1)
+    stored = CachedToken("ya29.other", expires_at.strftime('%Y-%m-%dT%H:%M:%SZ'), expires_at)
+
+    async def run():
+        with cache.refresh_lock(key):
+            refresh = asyncio.ensure_future(token_service.get_token())
+            await asyncio.sleep(0.1)
+            assert not refresh.done()
+            cache.set(key, stored)
+        return await refresh
+
+    assert asyncio.run(run())[0] == "ya29.other"
+    assert not calls
+
+
+def test_html_error_page_is_retried(workload):
+    """
+    A 502 page from the Google front end in front of STS is retried
+    """
+    calls = []
+    handler = _handler(calls)
+
+    def bad_gateway(request):
+        if request.url.host == "sts.googleapis.com" and "502" not in calls:
+            calls.append("502")
+            return httpx.Response(502, text="<html><title>502 Bad Gateway</title></html>")
+        return handler(request)
+
+    token_service = _token_service(workload, bad_gateway)
+
+    async def run():
+        with mock.patch.object(token_service.token_service, "_subject_token",
+                               return_value="subject"):
+            return await token_service.get_token()
+
+    assert asyncio.run(run())[0] == "ya29.async"
+    assert calls == ["502", "sts.googleapis.com", "iamcredentials.googleapis.com"]
+
+
+def test_cancelled_probe_releases_the_circuit(workload):
+    """
+    A half-open probe that is cancelled lets the next refresh probe again
+    """
+    breaker = CircuitBreaker(reset_timeout=0)
+    breaker.record_failure()
+    token_service = _token_service(dict(workload, circuit_breaker=breaker), _handler([]))
+
+    async def hang(_force):
+        await asyncio.Event().wait()
+
+    async def run():
+        with mock.patch.object(token_service, "_refresh", hang):
+            probe = asyncio.ensure_future(token_service.get_token())
+            await asyncio.sleep(0.01)
+            token_service._inflight.cancel() #pylint: disable=protected-access
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+
+        with mock.patch.object(token_service.token_service, "_subject_token",
+                               return_value="subject"):
+            return await token_service.get_token()
+
+    assert asyncio.run(run())[0] == "ya29.async"
+    assert breaker.probes == 2
+    assert breaker.state == CLOSED
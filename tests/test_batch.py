@@ -0,0 +1,51 @@
+"""
+Unit tests for batch token minting.
+"""
+
+from unittest import mock
+
+from requests.exceptions import HTTPError #pylint: disable=import-error
+
+
+
+def _get_sa_token(federated_token, gcp_token_lifetime, gcp_token_scopes, email):
+    assert federated_token == "federated"
+    assert (gcp_token_lifetime, gcp_token_scopes) == ("600s", "scope")
+    if email.startswith("denied"):
+        raise HTTPError("403 Client Error")
+    return f"ya29.{email}", "2099-01-01T00:00:00Z"
+
+
+def test_get_tokens_federates_once(make_token_service):
+    """
+    The federation leg runs once and a failing SA does not abort the batch
+    """
+    token_service = make_token_service()
+    emails = ["a@p.iam.gserviceaccount.com", "denied@p.iam.gserviceaccount.com",
+              "b@p.iam.gserviceaccount.com"]
+
+    with mock.patch.object(token_service, "_get_federated_token",
+                           return_value="federated") as federate, \
+         mock.patch.object(token_service.utils, "_get_sa_token", side_effect=_get_sa_token):
+        results = token_service.get_tokens(emails, "scope", "600s")
+        cached = token_service.get_tokens(emails[:1], "scope", "600s")
+
+    assert federate.call_count == 1
+    assert list(results) == emails
+    assert results[emails[0]].token == "ya29.a@p.iam.gserviceaccount.com"
+    assert isinstance(results[emails[1]].error, HTTPError)
+    assert results[emails[2]].error is None
+    assert cached[emails[0]] == results[emails[0]]
+
+
+def test_get_tokens_federation_failure(make_token_service):
+    """
+    A failed federation is reported for every service account
+    """
+    token_service = make_token_service()
+    error = HTTPError("400 Client Error")
+
+    with mock.patch.object(token_service, "_get_federated_token", side_effect=error):
+        results = token_service.get_tokens(["a@p.iam.gserviceaccount.com"])
+
+    assert results["a@p.iam.gserviceaccount.com"].error is error
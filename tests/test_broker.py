@@ -0,0 +1,133 @@
+"""
+Unit tests for the multi-tenant TokenBroker.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest #pylint: disable=import-error
+
+from benchmarks.fakes import AWS_STS, GOOGLE_STS, IAM_CREDENTIALS #pylint: disable=import-error
+from scalesec_gcp_workload_identity.broker import Tenant, TokenBroker #pylint: disable=import-error
+
+
+@pytest.fixture(name="make_tenant")
+def fixture_make_tenant(workload):
+    """
+    Factory of tenants sharing the test workload pool and provider
+    """
+    def make_tenant(index: int = 0, role: str = "role") -> Tenant:
+        return Tenant(**{
+            **workload,
+            "gcp_service_account_email": f"sa-{index}@project.iam.gserviceaccount.com",
+            "aws_role_name": role
+        })
+
+    return make_tenant
+
+
+class FakeClock: #pylint: disable=too-few-public-methods
+    """
+    Monotonic clock moved by hand
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_services_are_reused_and_share_clients(make_tenant):
+    """
+    A tenant gets the same TokenService every time, tenants share the STS client
+    """
+    broker = TokenBroker()
+
+    first = broker.get_service(make_tenant(0))
+    assert broker.get_service(make_tenant(0)) is first
+    second = broker.get_service(make_tenant(1))
+
+    assert second is not first
+    assert second.utils.sts_client is first.utils.sts_client
+    assert second.utils.session is first.utils.session
+    assert second.federated_token_cache is first.federated_token_cache
+    assert broker.stats() == {"size": 2, "max_size": 256, "hits": 1, "misses": 2,
+                              "evictions": 0, "expirations": 0}
+
+
+def test_least_recently_used_is_evicted(make_tenant):
+    """
+    Beyond max_size the least recently used tenant goes
+    """
+    broker = TokenBroker(max_size=2)
+
+    broker.get_service(make_tenant(0))
+    broker.get_service(make_tenant(1))
+    broker.get_service(make_tenant(0))
+    broker.get_service(make_tenant(2))
+
+    assert make_tenant(0) in broker and make_tenant(2) in broker
+    assert make_tenant(1) not in broker
+    assert broker.stats()["evictions"] == 1
+
+
+def test_idle_tenants_expire(make_tenant):
+    """
+    Tenants unused for longer than the TTL are evicted
+    """
+    clock = FakeClock()
+    broker = TokenBroker(ttl=60, clock=clock)
+
+    broker.get_service(make_tenant(0))
+    clock.now = 30
+    broker.get_service(make_tenant(1))
+    clock.now = 75
+    broker.get_service(make_tenant(1))
+
+    assert len(broker) == 1
+    assert make_tenant(0) not in broker
+    assert broker.stats()["expirations"] == 1
+
+
+def test_max_size_must_be_positive():
+    """
+    An empty broker would evict every tenant it creates
+    """
+    with pytest.raises(ValueError):
+        TokenBroker(max_size=0)
+
+
+def test_tenants_of_one_role_share_the_federated_token(fake, make_tenant):
+    """
+    Service accounts behind the same AWS role exchange a single federated token
+    """
+    broker = TokenBroker(**fake.token_service_kwargs())
+    tokens = [broker.get_token(make_tenant(index))[0] for index in range(3)]
+
+    assert len(set(tokens)) == 3
+    assert fake.calls[GOOGLE_STS] == 1
+    assert fake.calls[IAM_CREDENTIALS] == 3
+
+    broker.evict(make_tenant(0))
+    broker.get_token(make_tenant(0))
+    assert fake.calls[GOOGLE_STS] == 1
+    assert fake.calls[IAM_CREDENTIALS] == 4
+
+
+def test_concurrent_tenants_federate_once(fake, make_tenant):
+    """
+    Tenants of one role fetched concurrently wait for a single federation
+    """
+    broker = TokenBroker(**fake.token_service_kwargs())
+    tenants = [make_tenant(index) for index in range(10)]
+    barrier = threading.Barrier(len(tenants))
+
+    def get_token(tenant):
+        barrier.wait()
+        return broker.get_token(tenant)
+
+    with ThreadPoolExecutor(max_workers=len(tenants)) as executor:
+        tokens = list(executor.map(get_token, tenants))
+
+    assert len({token for token, _ in tokens}) == 10
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 1, IAM_CREDENTIALS: 10}
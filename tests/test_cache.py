@@ -0,0 +1,264 @@
+"""
+Unit tests for the SA token cache.
+"""
+
+import datetime
+import os
+import stat
+import threading
+import time
+from unittest import mock
+
+import pytest #pylint: disable=import-error
+
+from scalesec_gcp_workload_identity import cache as cache_module #pylint: disable=import-error
+from scalesec_gcp_workload_identity.cache import ( #pylint: disable=import-error
+    CachedToken,
+    FileTokenCache,
+    TokenCache,
+    parse_expire_time,
+    parse_jwt_expiry,
+    utcnow
+)
+
+
+def _token(seconds: int, token: str = "ya29.cached") -> CachedToken:
+    expires_at = utcnow() + datetime.timedelta(seconds=seconds)
+    return CachedToken(token, expires_at.strftime('%Y-%m-%dT%H:%M:%SZ'), expires_at)
+
+
+def test_parse_expire_time():
+    """
+    GCP returns RFC 3339 timestamps, sometimes with nanosecond precision
+    """
+    expected = datetime.datetime(2021, 3, 4, 5, 6, 7, tzinfo=datetime.timezone.utc)
+    assert parse_expire_time("2021-03-04T05:06:07Z") == expected
+    assert parse_expire_time("2021-03-04T05:06:07.123456789Z") == \
+        expected.replace(microsecond=123456)
+
+
+def test_parse_jwt_expiry():
+    """
+    The exp claim is read from the unpadded base64url payload
+    """
+    # {"alg":"none"}.{"aud":"a","exp":1700000000}
+    token = "eyJhbGciOiJub25lIn0.eyJhdWQiOiJhIiwiZXhwIjoxNzAwMDAwMDAwfQ.sig"
+    assert parse_jwt_expiry(token) == datetime.datetime(
+        2023, 11, 14, 22, 13, 20, tzinfo=datetime.timezone.utc)
+
+    for invalid in ("ya29.opaque", "not-a-jwt", "a.e30.b"):
+        with pytest.raises(ValueError):
+            parse_jwt_expiry(invalid)
+
+
+def test_cache_respects_min_ttl():
+    """
+    Tokens inside the refresh skew are treated as misses
+    """
+    cache = TokenCache()
+    cache.set("key", _token(120))
+
+    assert cache.get("key", min_ttl=60) is not None
+    assert cache.get("key", min_ttl=300) is None
+    assert cache.get("missing") is None
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 2}
+
+
+def test_get_token_serves_from_cache(make_token_service):
+    """
+    Only the first call should mint a token
+    """
+    token_service = make_token_service()
+    with mock.patch.object(token_service, "_mint_token", return_value=_token(3600)) as mint:
+        first = token_service.get_token()
+        second = token_service.get_token()
+
+    assert first == second
+    assert mint.call_count == 1
+    assert token_service.token_cache.hits == 1
+
+
+def test_get_token_refreshes_inside_skew(make_token_service):
+    """
+    A token about to expire is replaced in the background, any token when forced
+    """
+    token_service = make_token_service()
+    token_service.token_cache.set(token_service._cache_key(), _token(60, "ya29.old")) #pylint: disable=protected-access
+
+    with mock.patch.object(token_service, "_mint_token", return_value=_token(3600)) as mint:
+        sa_token, _ = token_service.get_token()
+        token_service._background_refresh.join() #pylint: disable=protected-access
+        assert token_service.get_token()[0] == "ya29.cached"
+        token_service.get_token(force_refresh=True)
+
+    assert sa_token == "ya29.old"
+    assert mint.call_count == 2
+
+
+def test_skew_is_limited_by_token_lifetime(make_token_service):
+    """
+    A skew as long as the token lifetime still lets the cached token be reused
+    """
+    token_service = make_token_service(gcp_token_lifetime="300s", token_refresh_skew=300)
+    with mock.patch.object(token_service, "_mint_token", return_value=_token(300)) as mint:
+        for _ in range(200):
+            token_service.get_token()
+
+    assert token_service.token_refresh_skew == 150
+    assert mint.call_count == 1
+
+
+def test_federated_token_is_cached_separately(make_token_service):
+    """
+    An SA token miss should reuse the cached federated token
+    """
+    token_service = make_token_service()
+    utils = token_service.utils
+    with mock.patch.object(token_service, "_subject_token", return_value="subject") as aws, \
+         mock.patch.object(utils, "_exchange_federated_token",
+                           return_value=("federated", 3600)) as federate, \
+         mock.patch.object(utils, "_get_sa_token",
+                           return_value=("ya29.sa", "2099-01-01T00:00:00Z")) as sa_token:
+        token_service.get_token()
+        token_service.get_token(force_refresh=True)
+
+    assert aws.call_count == federate.call_count == 1
+    assert sa_token.call_count == 2
+    assert token_service.gcp_federated_token == "federated"
+    assert token_service.federated_token_cache.hits == 1
+
+
+def test_refresh_lock_is_per_key():
+    """
+    Refreshes of one key are serialized, other keys proceed, unused locks are dropped
+    """
+    cache = TokenCache()
+    acquired = threading.Event()
+
+    def refresh(key):
+        with cache.refresh_lock(key):
+            acquired.set()
+
+    with cache.refresh_lock("a"):
+        other = threading.Thread(target=refresh, args=("b",))
+        other.start()
+        assert acquired.wait(1)
+        other.join()
+
+        acquired.clear()
+        same = threading.Thread(target=refresh, args=("a",))
+        same.start()
+        assert not acquired.wait(0.1)
+    same.join()
+
+    assert acquired.is_set()
+    assert not cache._refresh_locks #pylint: disable=protected-access
+
+
+def test_expired_tokens_are_pruned(tmp_path):
+    """
+    prune drops expired tokens only, and writes prune once PRUNE_INTERVAL has passed
+    """
+    for cache in (TokenCache(), FileTokenCache(str(tmp_path))):
+        cache.set("expired", _token(-1))
+        cache.set("valid", _token(3600))
+
+        assert cache.prune() == 1
+        assert cache.peek("expired") is None
+        assert cache.peek("valid") is not None
+
+        cache.set("expired", _token(-1))
+        cache._next_prune = 0 #pylint: disable=protected-access
+        cache.set("other", _token(3600))
+        assert len(cache) == 2
+
+
+@pytest.mark.skipif(cache_module.fcntl is None, reason="requires fcntl")
+def test_prune_removes_lock_files(tmp_path):
+    """
+    Lock files go with their expired token or when orphaned, not while a refresh holds them
+    """
+    cache = FileTokenCache(str(tmp_path))
+    for key, seconds in (("expired", -1), ("valid", 3600)):
+        with cache.refresh_lock(key):
+            cache.set(key, _token(seconds))
+    with cache.refresh_lock("orphan"):
+        pass
+
+    with cache.refresh_lock("refreshing"):
+        assert cache.prune() == 1
+        assert sorted(os.listdir(str(tmp_path))) == sorted(
+            os.path.basename(cache._path(key, suffix)) #pylint: disable=protected-access
+            for key, suffix in (("valid", ".json"), ("valid", ".lock"), ("refreshing", ".lock"))
+            )
+
+
+@pytest.mark.skipif(cache_module.fcntl is None, reason="requires fcntl")
+def test_lock_is_retaken_on_pruned_lock_file(tmp_path):
+    """
+    A process waiting on a lock file that is pruned locks the new file at the path
+    """
+    path = str(tmp_path / "token.lock")
+    held = cache_module._lock_file(path) #pylint: disable=protected-access
+    acquired = []
+    waiter = threading.Thread(
+        target=lambda: acquired.append(cache_module._lock_file(path)) #pylint: disable=protected-access
+        )
+    waiter.start()
+    time.sleep(0.1)
+    os.unlink(path)
+    os.close(held)
+    waiter.join()
+
+    assert os.fstat(acquired[0]).st_ino == os.stat(path).st_ino
+    os.close(acquired[0])
+
+
+def test_file_cache_round_trip(tmp_path):
+    """
+    Tokens survive a new cache instance and are stored owner-only
+    """
+    directory = str(tmp_path / "cache")
+    token = _token(3600)
+    FileTokenCache(directory).set(("sa", "scope", "3600s"), token)
+
+    cache = FileTokenCache(directory)
+    cached = cache.get(("sa", "scope", "3600s"), min_ttl=300)
+
+    assert cached.token == token.token
+    assert cached.expires_at == token.expires_at
+    assert cache.get(("sa", "scope", "600s")) is None
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    for name in os.listdir(directory):
+        assert stat.S_IMODE(os.stat(os.path.join(directory, name)).st_mode) == 0o600
+
+
+def test_file_cache_single_refresh_across_services(tmp_path, make_token_service):
+    """
+    Independent TokenServices (e.g. one per worker process) sharing a
+    directory should mint once
+    """
+    directory = str(tmp_path)
+    services = [make_token_service(token_cache=FileTokenCache(directory)) for _ in range(4)]
+    calls = []
+
+    def slow_mint():
+        calls.append(1)
+        time.sleep(0.2)
+        return _token(3600)
+
+    patches = [mock.patch.object(service, "_mint_token", side_effect=slow_mint)
+               for service in services]
+    for patch in patches:
+        patch.start()
+    try:
+        threads = [threading.Thread(target=service.get_token) for service in services]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    assert len(calls) == 1
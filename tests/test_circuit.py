@@ -0,0 +1,139 @@
+"""
+Tests of the refresh circuit breaker.
+"""
+
+import datetime
+
+import pytest #pylint: disable=import-error
+
+from benchmarks.fakes import ( #pylint: disable=import-error
+    IAM_CREDENTIALS,
+    UpstreamBehaviour
+)
+from scalesec_gcp_workload_identity.cache import CachedToken, utcnow #pylint: disable=import-error
+from scalesec_gcp_workload_identity.circuit import ( #pylint: disable=import-error
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError
+)
+from scalesec_gcp_workload_identity.main import TokenService #pylint: disable=import-error
+from scalesec_gcp_workload_identity.retry import NO_RETRIES #pylint: disable=import-error
+
+
+class FakeClock: #pylint: disable=too-few-public-methods
+    """
+    Monotonic clock moved by hand
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(name="make_guarded_service")
+def fixture_make_guarded_service(fake, make_token_service):
+    """
+    Factory of TokenServices behind a circuit breaker. With a skew equal to the
+    lifetime of the fake tokens every token is due for renewal, yet valid for an hour.
+    """
+    def make_guarded_service(breaker: CircuitBreaker) -> TokenService:
+        return make_token_service(
+            fake,
+            gcp_token_lifetime="7200s",
+            token_refresh_skew=3600,
+            retry_policy=NO_RETRIES,
+            circuit_breaker=breaker
+        )
+
+    return make_guarded_service
+
+
+def _wait_for_renewal(token_service: TokenService) -> None:
+    renewal = token_service._background_refresh #pylint: disable=protected-access
+    if renewal is not None:
+        renewal.join()
+
+
+def test_state_transitions():
+    """
+    closed -> open after the threshold, half open after the timeout, one probe at a time
+    """
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+
+    clock.now = 10
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    assert breaker.is_open()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock.now = 20
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.stats() == {
+        "state": CLOSED, "failures": 0, "opened": 2, "short_circuited": 2, "probes": 2
+    }
+
+
+def test_outage_serves_cached_token_then_recovers(fake, make_guarded_service):
+    """
+    A failed refresh opens the circuit and callers get the valid cached token
+    without calling the upstream, until a probe succeeds
+    """
+    clock = FakeClock()
+    breaker = CircuitBreaker(reset_timeout=30, clock=clock)
+    token_service = make_guarded_service(breaker)
+    token, _ = token_service.get_token()
+
+    fake.behaviours[IAM_CREDENTIALS] = UpstreamBehaviour(error_rate=1.0)
+    assert token_service.get_token()[0] == token
+    _wait_for_renewal(token_service)
+    assert breaker.state == OPEN
+    calls = fake.calls[IAM_CREDENTIALS]
+
+    for _ in range(10):
+        assert token_service.get_token()[0] == token
+    assert fake.calls[IAM_CREDENTIALS] == calls
+
+    fake.behaviours[IAM_CREDENTIALS] = UpstreamBehaviour()
+    clock.now = 30
+    assert token_service.get_token()[0] == token
+    _wait_for_renewal(token_service)
+    assert breaker.state == CLOSED
+    assert token_service.get_token()[0] != token
+    _wait_for_renewal(token_service)
+
+
+def test_failures_surface_once_the_token_expired(fake, make_guarded_service):
+    """
+    Without a valid cached token an open circuit raises immediately
+    """
+    breaker = CircuitBreaker(reset_timeout=30, clock=FakeClock())
+    token_service = make_guarded_service(breaker)
+
+    fake.behaviours[IAM_CREDENTIALS] = UpstreamBehaviour(error_rate=1.0)
+    with pytest.raises(Exception):
+        token_service.get_token()
+    assert breaker.state == OPEN
+
+    expired = utcnow() - datetime.timedelta(seconds=1)
+    token_service.token_cache.set(
+        token_service._cache_key(), #pylint: disable=protected-access
+        CachedToken("ya29.expired", "expired", expired, expired)
+        )
+    calls = fake.calls[IAM_CREDENTIALS]
+    with pytest.raises(CircuitOpenError):
+        token_service.get_token()
+    assert fake.calls[IAM_CREDENTIALS] == calls
@@ -0,0 +1,83 @@
+"""
+Unit tests for the command line entry point.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+from unittest import mock
+
+from scalesec_gcp_workload_identity import cli #pylint: disable=import-error
+
+PROBE = """
+import sys
+from scalesec_gcp_workload_identity.cli import main
+code = main(sys.argv[1:])
+print(sorted(m for m in ("boto3", "botocore", "requests") if m in sys.modules), file=sys.stderr)
+sys.exit(code)
+"""
+
+
+def _response(expires_in: float) -> dict:
+    return {
+        "version": 1,
+        "success": True,
+        "token_type": cli.ACCESS_TOKEN_TYPE,
+        "access_token": "ya29.cached",
+        "expiration_time": int(time.time() + expires_in)
+    }
+
+
+def test_cache_hit_does_not_import_heavy_modules(tmp_path):
+    """
+    A valid output file is printed without loading boto3, botocore or requests
+    """
+    output_file = tmp_path / "token.json"
+    output_file.write_text(json.dumps(_response(3600)))
+
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE, "--output-file", str(output_file), "--format", "token"],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+    assert result.stdout.strip() == "ya29.cached"
+    assert result.stderr.strip() == "[]"
+
+
+def test_cache_miss_mints_and_writes_output_file(tmp_path, capsys):
+    """
+    An expiring cached response is replaced by a new token
+    """
+    output_file = tmp_path / "token.json"
+    output_file.write_text(json.dumps(_response(60)))
+
+    with mock.patch("scalesec_gcp_workload_identity.main.TokenService.get_token",
+                    return_value=("ya29.new", "2099-01-01T00:00:00Z")):
+        assert cli.main(["--output-file", str(output_file)]) == 0
+
+    printed = json.loads(capsys.readouterr().out)
+    assert printed == json.loads(output_file.read_text())
+    assert printed["access_token"] == "ya29.new"
+    assert printed["expiration_time"] == 4070908800
+    assert os.stat(output_file).st_mode & 0o777 == 0o600
+
+
+def test_failure_is_reported_in_executable_format(capsys):
+    """
+    Errors are printed as an unsuccessful executable response
+    """
+    with mock.patch("scalesec_gcp_workload_identity.main.TokenService.get_token",
+                    side_effect=RuntimeError("no credentials")):
+        assert cli.main([]) == 1
+
+    assert json.loads(capsys.readouterr().out) == {
+        "version": 1,
+        "success": False,
+        "code": "RuntimeError",
+        "message": "no credentials"
+    }
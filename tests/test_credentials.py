@@ -0,0 +1,112 @@
+"""
+Unit tests for ambient AWS credentials against a local fake IMDS.
+"""
+
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest #pylint: disable=import-error
+
+from scalesec_gcp_workload_identity.credentials import ( #pylint: disable=import-error
+    AmbientCredentials,
+    CredentialsNotFound
+)
+
+
+class FakeImdsHandler(BaseHTTPRequestHandler):
+    """
+    Minimal IMDSv2: session token, role listing and role credentials
+    """
+    calls = []
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        pass
+
+    def _send(self, status: int, body: str) -> None:
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def do_PUT(self): #pylint: disable=invalid-name
+        """
+        IMDSv2 session token
+        """
+        self.calls.append(self.path)
+        self._send(200, "imds-token")
+
+    def do_GET(self): #pylint: disable=invalid-name
+        """
+        Role listing and credentials, which require the session token
+        """
+        self.calls.append(self.path)
+        if self.headers.get("X-aws-ec2-metadata-token") != "imds-token":
+            self._send(401, "")
+        elif self.path == "/latest/meta-data/iam/security-credentials/":
+            self._send(200, "instance-role")
+        elif self.path == "/latest/meta-data/iam/security-credentials/instance-role":
+            expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=6)
+            self._send(200, json.dumps({
+                "Code": "Success",
+                "AccessKeyId": "ASIAIMDS",
+                "SecretAccessKey": "imds-secret",
+                "Token": "imds-session",
+                "Expiration": expiration.strftime('%Y-%m-%dT%H:%M:%SZ')
+            }))
+        else:
+            self._send(404, "")
+
+
+@pytest.fixture(name="imds_endpoint")
+def fixture_imds_endpoint():
+    """
+    Run the fake IMDS on a free port
+    """
+    FakeImdsHandler.calls = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeImdsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_environment_credentials():
+    """
+    Lambda style environment credentials are used without any network call
+    """
+    provider = AmbientCredentials(environ={
+        "AWS_ACCESS_KEY_ID": "ASIAENV",
+        "AWS_SECRET_ACCESS_KEY": "env-secret",
+        "AWS_SESSION_TOKEN": "env-session"
+    })
+
+    assert provider() == ("ASIAENV", "env-secret", "env-session", None)
+
+
+def test_imds_credentials_are_cached(imds_endpoint, make_token_service):
+    """
+    IMDS credentials are fetched once and reused until they near expiration
+    """
+    token_service = make_token_service(aws_credential_source="ambient")
+    token_service.utils.credential_provider = AmbientCredentials(imds_endpoint, environ={})
+
+    first = token_service.utils._assume_role() #pylint: disable=protected-access
+    second = token_service.utils._assume_role() #pylint: disable=protected-access
+
+    assert first == second == ("ASIAIMDS", "imds-secret", "imds-session")
+    assert FakeImdsHandler.calls == [
+        "/latest/api/token",
+        "/latest/meta-data/iam/security-credentials/",
+        "/latest/meta-data/iam/security-credentials/instance-role"
+    ]
+
+
+def test_no_credentials():
+    """
+    An unreachable IMDS with nothing in the environment raises CredentialsNotFound
+    """
+    provider = AmbientCredentials("http://127.0.0.1:9", timeout=0.2, environ={})
+
+    with pytest.raises(CredentialsNotFound):
+        provider()
@@ -0,0 +1,153 @@
+"""
+Tests of Credential Access Boundaries and downscoped tokens.
+"""
+
+import datetime
+import json
+
+import pytest #pylint: disable=import-error
+
+from benchmarks.fakes import ( #pylint: disable=import-error
+    AWS_STS,
+    GOOGLE_STS,
+    IAM_CREDENTIALS,
+    UpstreamBehaviour
+)
+from scalesec_gcp_workload_identity.cache import ( #pylint: disable=import-error
+    CachedToken,
+    parse_expire_time,
+    utcnow
+)
+from scalesec_gcp_workload_identity.circuit import CLOSED, CircuitBreaker #pylint: disable=import-error
+from scalesec_gcp_workload_identity.downscope import ( #pylint: disable=import-error
+    MAX_RULES,
+    AccessBoundaryRule,
+    CredentialAccessBoundary,
+    gcs_bucket_rule
+)
+from scalesec_gcp_workload_identity.retry import NO_RETRIES #pylint: disable=import-error
+
+
+def _tenant_boundary(tenant: int) -> CredentialAccessBoundary:
+    return CredentialAccessBoundary([gcs_bucket_rule("shared-bucket", f"tenants/{tenant}/")])
+
+
+def test_boundary_encoding_is_canonical():
+    """
+    Equal rules give the same JSON and hash, other prefixes another hash
+    """
+    boundary = _tenant_boundary(1)
+
+    assert json.loads(boundary.to_json()) == {
+        "accessBoundary": {
+            "accessBoundaryRules": [{
+                "availableResource": "//storage.googleapis.com/projects/_/buckets/shared-bucket",
+                "availablePermissions": ["inRole:roles/storage.objectViewer"],
+                "availabilityCondition": {
+                    "expression": "resource.name.startsWith("
+                                  "'projects/_/buckets/shared-bucket/objects/tenants/1/')",
+                    "title": "shared-bucket/tenants/1/"
+                }
+            }]
+        }
+    }
+    assert boundary == _tenant_boundary(1)
+    assert boundary.hash != _tenant_boundary(2).hash
+    assert len({boundary, _tenant_boundary(1), _tenant_boundary(2)}) == 2
+
+
+def test_boundary_validation():
+    """
+    A boundary needs between one and MAX_RULES rules, each with permissions
+    """
+    with pytest.raises(ValueError):
+        CredentialAccessBoundary([])
+    with pytest.raises(ValueError):
+        CredentialAccessBoundary([gcs_bucket_rule(f"bucket-{i}") for i in range(MAX_RULES + 1)])
+    with pytest.raises(ValueError):
+        CredentialAccessBoundary([AccessBoundaryRule("//storage.googleapis.com/x", ())])
+
+
+def test_downscoped_tokens_share_one_sa_token(fake, make_token_service):
+    """
+    Every boundary costs one STS exchange of the same SA token, then is served from cache
+    """
+    token_service = make_token_service(fake)
+    boundaries = [_tenant_boundary(tenant) for tenant in range(20)]
+
+    results = token_service.get_downscoped_tokens(boundaries)
+    assert all(result.error is None for result in results.values())
+    assert len({result.token for result in results.values()}) == 20
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 21, IAM_CREDENTIALS: 1}
+    assert not token_service.token_cache._refresh_locks #pylint: disable=protected-access
+
+    token, expire_time = token_service.get_downscoped_token(_tenant_boundary(3))
+    assert token == results[boundaries[3]].token
+    assert token.startswith("ya29.downscoped.")
+    assert parse_expire_time(expire_time) <= parse_expire_time(token_service.get_token()[1])
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 21, IAM_CREDENTIALS: 1}
+
+
+def test_force_refresh(fake, make_token_service):
+    """
+    force_refresh exchanges the cached SA token again
+    """
+    token_service = make_token_service(fake)
+    token, _ = token_service.get_downscoped_token(_tenant_boundary(1))
+
+    assert token_service.get_downscoped_token(_tenant_boundary(1), force_refresh=True)[0] != token
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 3, IAM_CREDENTIALS: 1}
+
+
+def test_no_exchange_while_sa_token_is_renewed(fake, make_token_service):
+    """
+    Inside the skew the cached downscoped token is served until the renewed
+    SA token can give one that lasts longer
+    """
+    token_service = make_token_service(fake)
+    key = token_service._cache_key() #pylint: disable=protected-access
+    sa_token, _ = token_service.get_token()
+    expires_at = utcnow() + datetime.timedelta(seconds=100)
+    token_service.token_cache.set(
+        key, CachedToken(sa_token, expires_at.strftime('%Y-%m-%dT%H:%M:%SZ'), expires_at)
+        )
+
+    # a renewal holds the lock, callers keep the SA token inside the skew meanwhile
+    with token_service._refresh_lock: #pylint: disable=protected-access
+        tokens = {token_service.get_downscoped_token(_tenant_boundary(1))[0] for _ in range(5)}
+    assert len(tokens) == 1
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 2, IAM_CREDENTIALS: 1}
+
+    token_service._refresh() #pylint: disable=protected-access
+    assert token_service.get_downscoped_token(_tenant_boundary(1))[0] not in tokens
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 3, IAM_CREDENTIALS: 2}
+
+
+def test_recovers_through_half_open_circuit(fake, make_token_service):
+    """
+    After an outage outlasting the SA token, the probe renews the SA token and
+    the downscoped token is exchanged again
+    """
+    # with no reset timeout the circuit is half open right after opening
+    breaker = CircuitBreaker(reset_timeout=0)
+    token_service = make_token_service(fake, retry_policy=NO_RETRIES, circuit_breaker=breaker)
+    boundary = _tenant_boundary(1)
+    token, _ = token_service.get_downscoped_token(boundary)
+
+    expired_at = utcnow() - datetime.timedelta(seconds=1)
+    expired = CachedToken("ya29.expired", "expired", expired_at, expired_at)
+    token_service.token_cache.set(token_service._cache_key(), expired) #pylint: disable=protected-access
+    token_service.token_cache.set(
+        token_service._downscoped_cache_key(boundary), #pylint: disable=protected-access
+        expired
+        )
+
+    fake.behaviours[IAM_CREDENTIALS] = UpstreamBehaviour(error_rate=1.0)
+    with pytest.raises(Exception):
+        token_service.get_downscoped_token(boundary)
+    assert breaker.stats()["opened"] == 1
+
+    fake.behaviours[IAM_CREDENTIALS] = UpstreamBehaviour()
+    renewed, _ = token_service.get_downscoped_token(boundary)
+    assert renewed not in (token, "ya29.expired")
+    assert breaker.state == CLOSED
@@ -0,0 +1,123 @@
+"""
+End-to-end tests of the full mint path against the fake upstreams.
+"""
+
+import threading
+from unittest import mock
+
+import pytest #pylint: disable=import-error
+
+from benchmarks.bench_token_service import regressions #pylint: disable=import-error
+from benchmarks.fakes import ( #pylint: disable=import-error
+    AWS_STS,
+    GOOGLE_STS,
+    IAM_CREDENTIALS,
+    UpstreamBehaviour
+)
+from scalesec_gcp_workload_identity.cache import parse_jwt_expiry #pylint: disable=import-error
+
+EMAIL = "sa@project.iam.gserviceaccount.com"
+
+
+def test_cold_mint_and_refresh_upstream_calls(fake, make_token_service):
+    """
+    A cold mint calls every upstream once, a refresh only generateAccessToken
+    """
+    token_service = make_token_service(fake)
+
+    sa_token, _ = token_service.get_token()
+    assert sa_token.startswith(f"ya29.fake.{EMAIL}.")
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 1, IAM_CREDENTIALS: 1}
+
+    token_service.get_token()
+    assert fake.calls[IAM_CREDENTIALS] == 1
+
+    token_service.get_token(force_refresh=True)
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 1, IAM_CREDENTIALS: 2}
+
+
+def test_upstream_errors_surface(fake, make_token_service):
+    """
+    An upstream that keeps failing fails the mint once retries are exhausted
+    """
+    fake.behaviours[IAM_CREDENTIALS] = UpstreamBehaviour(error_rate=1.0)
+
+    with pytest.raises(Exception):
+        make_token_service(fake).get_token()
+    assert fake.errors[IAM_CREDENTIALS] == 3
+
+
+def test_id_tokens_are_cached_per_audience(fake, make_token_service):
+    """
+    ID tokens reuse the federated token and are cached per audience until their exp
+    """
+    token_service = make_token_service(fake)
+    token_service.get_token()
+
+    id_token, expire_time = token_service.get_id_token("https://service.a.run.app")
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 1, IAM_CREDENTIALS: 2}
+    assert parse_jwt_expiry(id_token).strftime('%Y-%m-%dT%H:%M:%SZ') == expire_time
+
+    for _ in range(100):
+        assert token_service.get_id_token("https://service.a.run.app")[0] == id_token
+    assert fake.calls[IAM_CREDENTIALS] == 2
+
+    other, _ = token_service.get_id_token("https://other.a.run.app", include_email=True)
+    assert other != id_token
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 1, IAM_CREDENTIALS: 3}
+
+    refreshed, _ = token_service.get_id_token("https://service.a.run.app", force_refresh=True)
+    assert refreshed != id_token
+    assert fake.calls[IAM_CREDENTIALS] == 4
+
+
+def test_id_token_refreshed_inside_skew(fake, make_token_service):
+    """
+    An ID token expiring within token_refresh_skew is replaced
+    """
+    fake.token_lifetime = 200
+    token_service = make_token_service(fake)
+
+    first, _ = token_service.get_id_token("https://service.a.run.app")
+    second, _ = token_service.get_id_token("https://service.a.run.app")
+    assert first != second
+
+
+def test_id_token_audiences_are_minted_concurrently(fake, make_token_service):
+    """
+    A slow mint for one audience does not delay the mint for another
+    """
+    token_service = make_token_service(fake)
+    mint_id_token = token_service._mint_id_token #pylint: disable=protected-access
+    slow_started, release = threading.Event(), threading.Event()
+
+    def mint(audience, include_email):
+        if audience == "https://slow.a.run.app":
+            slow_started.set()
+            release.wait(5)
+        return mint_id_token(audience, include_email)
+
+    with mock.patch.object(token_service, "_mint_id_token", side_effect=mint):
+        slow = threading.Thread(target=token_service.get_id_token, args=("https://slow.a.run.app",))
+        slow.start()
+        assert slow_started.wait(5)
+
+        token_service.get_id_token("https://fast.a.run.app")
+        assert slow.is_alive()
+        release.set()
+        slow.join()
+
+    assert fake.calls[IAM_CREDENTIALS] == 2
+
+
+def test_regressions():
+    """
+    Slower latencies, lower throughput and extra upstream calls are regressions
+    """
+    baseline = {"refresh_p50_ms": 10.0, "mints_per_sec_c4": 100.0,
+                "upstream_calls_per_refresh": 1.0}
+
+    assert not regressions({"refresh_p50_ms": 15.0, "mints_per_sec_c4": 60.0,
+                            "upstream_calls_per_refresh": 1.0}, baseline, 2.0)
+    assert len(regressions({"refresh_p50_ms": 25.0, "mints_per_sec_c4": 40.0,
+                            "upstream_calls_per_refresh": 2.0}, baseline, 2.0)) == 3
@@ -0,0 +1,137 @@
+"""
+Tests of the state a forked child inherits from a TokenService.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+import pytest #pylint: disable=import-error
+
+from benchmarks.fakes import AWS_STS, GOOGLE_STS, IAM_CREDENTIALS #pylint: disable=import-error
+from scalesec_gcp_workload_identity import retry, session #pylint: disable=import-error
+from scalesec_gcp_workload_identity.cache import CachedToken, utcnow #pylint: disable=import-error
+from scalesec_gcp_workload_identity.ratelimit import GOOGLE_STS as GOOGLE_STS_ENDPOINT #pylint: disable=import-error
+from scalesec_gcp_workload_identity.ratelimit import RateLimiter #pylint: disable=import-error
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+
+
+def _in_child(func) -> dict:
+    """
+    Run ``func`` in a forked child and return its JSON result
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0: # pragma: no cover
+        os.close(read_fd)
+        status = 0
+        try:
+            result = func()
+        except BaseException as err: #pylint: disable=broad-except
+            result = {"error": repr(err)}
+            status = 1
+        with os.fdopen(write_fd, "w") as pipe:
+            json.dump(result, pipe)
+        os._exit(status) #pylint: disable=protected-access
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        result = json.load(pipe)
+    os.waitpid(pid, 0)
+    return result
+
+
+def test_child_keeps_token_and_drops_connections(fake, make_token_service):
+    """
+    The child serves the parent's token and does not reuse its clients or sockets
+    """
+    token_service = make_token_service(fake)
+    token, _ = token_service.get_token()
+    assert token_service.utils._session is not None #pylint: disable=protected-access
+
+    def child():
+        return {
+            "token": token_service.get_token()[0],
+            "session": token_service.utils._session is None, #pylint: disable=protected-access
+            "sts_client": token_service.utils._sts_client is None, #pylint: disable=protected-access
+            "shared_sessions": len(session._shared_sessions), #pylint: disable=protected-access
+            "hedge_executor": retry._hedge_executor is None #pylint: disable=protected-access
+        }
+
+    assert _in_child(child) == {
+        "token": token,
+        "session": True,
+        "sts_client": True,
+        "shared_sessions": 0,
+        "hedge_executor": True
+    }
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 1, IAM_CREDENTIALS: 1}
+
+
+def test_child_can_mint_while_parent_thread_holds_the_lock(fake, make_token_service):
+    """
+    Locks held by parent threads at fork time are replaced in the child
+    """
+    token_service = make_token_service(fake)
+    token, _ = token_service.get_token()
+
+    with token_service._refresh_lock: #pylint: disable=protected-access
+        result = _in_child(lambda: {"token": token_service.get_token(force_refresh=True)[0]})
+
+    assert result["token"] != token
+    assert fake.calls[IAM_CREDENTIALS] == 2
+
+
+def test_prewarm_before_fork(fake, make_token_service):
+    """
+    With prewarm_before_fork the parent mints once and the children inherit the token
+    """
+    token_service = make_token_service(fake, prewarm_before_fork=True)
+
+    first = _in_child(lambda: {"token": token_service.get_token()[0]})
+    second = _in_child(lambda: {"token": token_service.get_token()[0]})
+
+    assert first == second == {"token": token_service.get_token()[0]}
+    assert fake.calls == {AWS_STS: 1, GOOGLE_STS: 1, IAM_CREDENTIALS: 1}
+
+
+def test_prewarm_renews_expiring_token_before_fork(fake, make_token_service):
+    """
+    A token within the refresh skew is renewed in the parent before forking, not in a thread
+    """
+    token_service = make_token_service(fake, prewarm_before_fork=True)
+    token_service.get_token()
+    expires_at = utcnow() + datetime.timedelta(seconds=100)
+    token_service.token_cache.set(
+        token_service._cache_key(), #pylint: disable=protected-access
+        CachedToken("ya29.expiring", expires_at.strftime('%Y-%m-%dT%H:%M:%SZ'), expires_at)
+        )
+
+    result = _in_child(lambda: {"token": token_service.get_token()[0]})
+
+    assert token_service._background_refresh is None #pylint: disable=protected-access
+    assert result["token"] not in ("ya29.expiring", None)
+    assert result == {"token": token_service.get_token()[0]}
+    assert fake.calls[IAM_CREDENTIALS] == 2
+
+
+def test_rate_limiter_queues_are_dropped_in_child():
+    """
+    Waiters of the parent do not block the child's callers
+    """
+    limiter = RateLimiter(rates={GOOGLE_STS_ENDPOINT: (1.0, 1.0)}, max_wait=5)
+    limiter.acquire(GOOGLE_STS_ENDPOINT, "parent")
+    waiter = threading.Thread(target=limiter.acquire, args=(GOOGLE_STS_ENDPOINT, "parent"))
+    waiter.start()
+    while limiter.stats()[GOOGLE_STS_ENDPOINT]["queue_depth"] < 1:
+        pass
+
+    result = _in_child(lambda: {
+        "queue_depth": limiter.stats()[GOOGLE_STS_ENDPOINT]["queue_depth"],
+        "waited": limiter.acquire(GOOGLE_STS_ENDPOINT, "child") < 2
+    })
+    waiter.join()
+
+    assert result == {"queue_depth": 0, "waited": True}
@@ -0,0 +1,96 @@
+"""
+Tests of the GCS listing and download helper against the fake upstreams and fake GCS.
+"""
+
+import os
+import time
+
+import pytest #pylint: disable=import-error
+
+from benchmarks.fakes import IAM_CREDENTIALS, FakeGcs #pylint: disable=import-error
+from scalesec_gcp_workload_identity.gcs import GcsClient, GcsObject #pylint: disable=import-error
+
+NAMES = [f"data/{index:03d}.bin" for index in range(25)]
+
+
+@pytest.fixture(name="gcs")
+def fixture_gcs():
+    """
+    Fake GCS holding NAMES, 100 KiB each
+    """
+    with FakeGcs(FakeGcs.generate(NAMES, 100 * 1024)) as gcs:
+        yield gcs
+
+
+@pytest.fixture(name="make_client")
+def fixture_make_client(fake, gcs, make_token_service):
+    """
+    Factory of GcsClients for fake GCS, authenticated against the fake upstreams
+    """
+    def make_client(**kwargs) -> GcsClient:
+        token_service = make_token_service(fake)
+        return GcsClient(token_service, endpoint=gcs.base_url, chunk_size=8192, **kwargs)
+
+    return make_client
+
+
+def test_listing_is_paginated_lazily(make_client, gcs):
+    """
+    Pages are only requested as the generator is consumed
+    """
+    objects = make_client().list_objects("bucket", prefix="data/", page_size=10)
+
+    first = next(objects)
+    assert first == GcsObject(NAMES[0], 100 * 1024, "1", first.md5_hash, first.updated)
+    assert gcs.list_calls == 1
+
+    assert [item.name for item in objects] == NAMES[1:]
+    assert gcs.list_calls == 3
+
+
+def test_download_many_streams_every_object(make_client, gcs, tmp_path):
+    """
+    Objects are written in full, unsafe names are skipped
+    """
+    gcs.objects["../escape.bin"] = b"nope"
+    client = make_client(pool_maxsize=4)
+
+    results = list(client.download_many("bucket", client.list_objects("bucket"), str(tmp_path)))
+
+    assert sorted(result.name for result in results) == NAMES
+    assert all(result.error is None for result in results)
+    for result in results:
+        with open(result.path, "rb") as downloaded:
+            assert downloaded.read() == gcs.objects[result.name]
+    assert not (tmp_path.parent / "escape.bin").exists()
+    assert not [name for name in os.listdir(tmp_path / "data") if name.startswith(".download-")]
+
+
+def test_rejected_token_is_replaced_once(make_client, fake, gcs, tmp_path):
+    """
+    A 401 from GCS mints a new token, shared by the concurrent downloads
+    """
+    client = make_client(pool_maxsize=8)
+    token, _ = client.token_service.get_token()
+    gcs.revoked.add(token)
+
+    results = list(client.download_many("bucket", NAMES, str(tmp_path)))
+
+    assert all(result.error is None for result in results)
+    assert fake.calls[IAM_CREDENTIALS] == 2
+
+
+def test_token_renewed_mid_listing(make_client, fake):
+    """
+    A token nearing its expireTime is renewed between pages, without stalling the listing
+    """
+    fake.token_lifetime = 301 # cached for one second with the default 300s skew
+    client = make_client()
+    objects = client.list_objects("bucket", page_size=10)
+
+    next(objects)
+    assert fake.calls[IAM_CREDENTIALS] == 1
+    time.sleep(1.1)
+    assert len(list(objects)) == len(NAMES) - 1
+    client.token_service._background_refresh.join() #pylint: disable=protected-access
+    assert fake.calls[IAM_CREDENTIALS] == 2
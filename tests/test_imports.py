@@ -0,0 +1,12 @@
+"""
+Guards against heavy modules being imported eagerly.
+"""
+
+from benchmarks.bench_import import measure #pylint: disable=import-error
+
+
+def test_no_heavy_imports_until_first_token():
+    """
+    Importing main and building a TokenService must not load boto3, botocore or requests
+    """
+    assert not measure(runs=1)["heavy_modules"]
@@ -0,0 +1,131 @@
+"""
+Unit tests for the pipeline instrumentation and its exporters.
+"""
+
+from unittest import mock
+
+import pytest #pylint: disable=import-error
+
+from benchmarks.fakes import IAM_CREDENTIALS, UpstreamBehaviour #pylint: disable=import-error
+from scalesec_gcp_workload_identity.instrumentation import ( #pylint: disable=import-error
+    CacheEvent,
+    Observer,
+    OpenTelemetryObserver,
+    PrometheusObserver,
+    StageEvent,
+    timed
+)
+
+
+class RecordingObserver(Observer):
+    """
+    Keeps every event it receives
+    """
+    def __init__(self):
+        self.stages = []
+        self.cache = []
+
+    def on_stage(self, event):
+        self.stages.append(event)
+
+    def on_cache(self, event):
+        self.cache.append(event)
+
+
+def test_stage_and_cache_events(fake, make_token_service):
+    """
+    A cold mint reports every stage, a second call a cache hit
+    """
+    observer = RecordingObserver()
+    token_service = make_token_service(fake, observers=[observer])
+
+    token_service.get_token()
+    token_service.get_token()
+
+    assert [event.stage for event in observer.stages] == [
+        "assume_role", "sign", "federated_token", "sa_token", "mint"]
+    assert all(event.outcome == "success" for event in observer.stages)
+    assert observer.stages[2].status_code == 200
+    assert observer.cache == [
+        CacheEvent("sa_token", False),
+        CacheEvent("federated_token", False),
+        CacheEvent("sa_token", True)
+    ]
+
+
+def test_failed_stage_reports_status_code(fake, make_token_service):
+    """
+    Upstream errors are reported with their HTTP status
+    """
+    fake.behaviours[IAM_CREDENTIALS] = UpstreamBehaviour(error_rate=1.0)
+    observer = RecordingObserver()
+    token_service = make_token_service(fake)
+    token_service.add_observer(observer)
+
+    with pytest.raises(Exception):
+        token_service.get_token()
+
+    failed = [event for event in observer.stages if event.outcome == "error"]
+    assert [(event.stage, event.status_code, event.attempt) for event in failed] == [
+        ("sa_token", 503, 1), ("sa_token", 503, 2), ("sa_token", 503, 3), ("mint", 503, 1)]
+
+
+def test_failing_observer_does_not_fail_mint(fake, make_token_service):
+    """
+    Exceptions raised by observers are logged and swallowed
+    """
+    observer = mock.Mock(spec=Observer)
+    observer.on_stage.side_effect = RuntimeError("boom")
+    observer.on_cache.side_effect = RuntimeError("boom")
+
+    sa_token, _ = make_token_service(fake, observers=[observer]).get_token()
+
+    assert sa_token.startswith("ya29.fake.")
+
+
+def test_timed_without_observers_is_a_plain_call():
+    """
+    Nothing is timed when no observer is registered
+    """
+    with mock.patch("scalesec_gcp_workload_identity.instrumentation.time") as clock:
+        assert timed((), "sign", lambda value: value * 2, 21) == 42
+    clock.perf_counter.assert_not_called()
+
+
+def test_prometheus_render():
+    """
+    Histogram, counters and cache lookups in the text exposition format
+    """
+    observer = PrometheusObserver(buckets=(0.1, 1.0))
+    observer.on_stage(StageEvent("sa_token", 0.05, "success", 200))
+    observer.on_stage(StageEvent("sa_token", 0.5, "error", 503, attempt=2))
+    observer.on_cache(CacheEvent("sa_token", True))
+
+    text = observer.render()
+
+    assert ('gcp_workload_identity_stage_duration_seconds_bucket'
+            '{stage="sa_token",outcome="success",le="0.1"} 1') in text
+    assert ('gcp_workload_identity_stage_duration_seconds_bucket'
+            '{stage="sa_token",outcome="error",le="0.1"} 0') in text
+    assert ('gcp_workload_identity_stage_duration_seconds_count'
+            '{stage="sa_token",outcome="error"} 1') in text
+    assert ('gcp_workload_identity_stage_requests_total'
+            '{stage="sa_token",outcome="error",status_code="503"} 1') in text
+    assert 'gcp_workload_identity_stage_retries_total{stage="sa_token"} 1' in text
+    assert 'gcp_workload_identity_cache_lookups_total{cache="sa_token",result="hit"} 1' in text
+
+
+def test_opentelemetry_spans():
+    """
+    Each stage becomes a span with its timing and attributes
+    """
+    tracer = mock.Mock()
+    observer = OpenTelemetryObserver(tracer=tracer)
+
+    observer.on_stage(StageEvent("federated_token", 0.25, "success", 200, start_time=10.0))
+
+    tracer.start_span.assert_called_once_with(
+        "gcp_workload_identity.federated_token", start_time=10_000_000_000)
+    span = tracer.start_span.return_value
+    span.set_attribute.assert_any_call("http.status_code", 200)
+    span.end.assert_called_once_with(end_time=10_250_000_000)
@@ -0,0 +1,68 @@
+"""
+Unit tests for the metadata server emulator.
+"""
+
+import json
+import threading
+import urllib.error
+import urllib.request
+from unittest import mock
+
+import pytest #pylint: disable=import-error
+
+from scalesec_gcp_workload_identity.metadata_server import MetadataServer #pylint: disable=import-error
+
+EMAIL = "sa@project.iam.gserviceaccount.com"
+
+
+@pytest.fixture(name="metadata_url")
+def fixture_metadata_url(make_token_service):
+    """
+    Run a metadata server on a free port with a stubbed TokenService
+    """
+    token_service = make_token_service(gcp_service_account_email=EMAIL)
+    server = MetadataServer(token_service, ("127.0.0.1", 0), background_refresh=False)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+
+    with mock.patch.object(token_service, "get_token",
+                           return_value=("ya29.token", "2099-01-01T00:00:00Z")):
+        thread.start()
+        yield f"http://127.0.0.1:{server.server_address[1]}/computeMetadata/v1"
+        server.shutdown()
+    server.server_close()
+
+
+def _get(url: str, flavor: str = "Google"):
+    request = urllib.request.Request(url, headers={"Metadata-Flavor": flavor})
+    with urllib.request.urlopen(request) as response:
+        assert response.headers["Metadata-Flavor"] == "Google"
+        return response.read().decode("utf-8")
+
+
+def test_token_endpoint(metadata_url):
+    """
+    The token endpoint returns the GCE token JSON
+    """
+    body = json.loads(_get(f"{metadata_url}/instance/service-accounts/default/token"))
+
+    assert body["access_token"] == "ya29.token"
+    assert body["token_type"] == "Bearer"
+    assert body["expires_in"] > 0
+
+
+def test_email_endpoint(metadata_url):
+    """
+    The SA is reachable as default and by its email
+    """
+    assert _get(f"{metadata_url}/instance/service-accounts/default/email") == EMAIL
+    assert json.loads(_get(f"{metadata_url}/instance/service-accounts/{EMAIL}/"))["email"] == EMAIL
+
+
+def test_metadata_flavor_required(metadata_url):
+    """
+    Requests without the Metadata-Flavor header are rejected
+    """
+    with pytest.raises(urllib.error.HTTPError) as err:
+        _get(f"{metadata_url}/instance/service-accounts/default/token", flavor="")
+
+    assert err.value.code == 403
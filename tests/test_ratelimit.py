@@ -0,0 +1,149 @@
+"""
+Unit tests for the client-side rate limiters.
+"""
+
+import threading
+import time
+
+import pytest #pylint: disable=import-error
+import requests #pylint: disable=import-error
+
+from scalesec_gcp_workload_identity.ratelimit import ( #pylint: disable=import-error
+    GOOGLE_STS,
+    IAM_CREDENTIALS,
+    FileRateLimiter,
+    RateLimiter,
+    RateLimitExceeded,
+    rate_limited
+)
+
+
+def _wait_for_queue_depth(limiter: RateLimiter, endpoint: str, depth: int) -> None:
+    deadline = time.monotonic() + 5
+    while limiter.stats()[endpoint]["queue_depth"] < depth:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def _http_error(status_code: int, retry_after: str) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers["Retry-After"] = retry_after
+    return requests.HTTPError(f"{status_code}", response=response)
+
+
+def test_burst_then_wait():
+    """
+    The burst is admitted at once, the next caller waits for the bucket to refill
+    """
+    limiter = RateLimiter(rates={GOOGLE_STS: (20.0, 3.0)})
+
+    assert [limiter.acquire(GOOGLE_STS, "a") for _ in range(3)] == [0.0, 0.0, 0.0]
+    waited = limiter.acquire(GOOGLE_STS, "a")
+    assert 0.02 < waited < 0.5
+
+    stats = limiter.stats()[GOOGLE_STS]
+    assert stats["admitted"] == 4
+    assert stats["delayed"] == 1
+    assert stats["queue_depth"] == 0
+    assert stats["wait_seconds_max"] == pytest.approx(waited)
+
+
+def test_unlisted_endpoints_are_not_limited():
+    """
+    Endpoints without a rate are always admitted
+    """
+    limiter = RateLimiter(rates={GOOGLE_STS: (1.0, 1.0)})
+
+    for _ in range(10):
+        assert limiter.acquire(IAM_CREDENTIALS) == 0.0
+    assert IAM_CREDENTIALS not in limiter.stats()
+
+
+def test_service_accounts_are_served_round_robin():
+    """
+    A service account with many queued calls does not starve another one
+    """
+    limiter = RateLimiter(rates={IAM_CREDENTIALS: (20.0, 1.0)})
+    limiter.acquire(IAM_CREDENTIALS, "busy")
+
+    admitted = []
+    threads = []
+    for depth, key in enumerate(["busy", "busy", "busy", "quiet"], start=1):
+        thread = threading.Thread(
+            target=lambda key=key: admitted.append(limiter.acquire(IAM_CREDENTIALS, key) and key)
+            )
+        thread.start()
+        threads.append(thread)
+        _wait_for_queue_depth(limiter, IAM_CREDENTIALS, depth)
+
+    for thread in threads:
+        thread.join()
+
+    assert admitted == ["busy", "quiet", "busy", "busy"]
+
+
+def test_max_wait_raises():
+    """
+    A caller that cannot be admitted within max_wait is rejected
+    """
+    limiter = RateLimiter(rates={GOOGLE_STS: (0.5, 1.0)}, max_wait=0.05)
+    limiter.acquire(GOOGLE_STS)
+
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(GOOGLE_STS)
+    stats = limiter.stats()[GOOGLE_STS]
+    assert stats["rejected"] == 1
+    assert stats["queue_depth"] == 0
+
+
+def test_429_pauses_the_endpoint_for_retry_after():
+    """
+    A 429 with Retry-After blocks the endpoint even though the bucket is full
+    """
+    limiter = RateLimiter(rates={GOOGLE_STS: (1000.0, 1000.0)})
+
+    def throttled_call():
+        raise _http_error(429, "0.1")
+
+    with pytest.raises(requests.HTTPError):
+        rate_limited(limiter, GOOGLE_STS, "a", throttled_call)()
+
+    assert limiter.acquire(GOOGLE_STS, "a") > 0.05
+    assert limiter.stats()[GOOGLE_STS]["throttled"] == 1
+
+
+def test_no_rate_limiter_leaves_the_call_unwrapped():
+    """
+    rate_limited is free when no limiter is configured
+    """
+    assert rate_limited(None, GOOGLE_STS, "a", len) is len
+
+
+def test_file_rate_limiters_share_buckets(tmp_path):
+    """
+    Two FileRateLimiters on the same directory draw from the same bucket
+    """
+    rates = {GOOGLE_STS: (0.1, 2.0)}
+    first = FileRateLimiter(rates=rates, max_wait=0.05, directory=str(tmp_path))
+    second = FileRateLimiter(rates=rates, max_wait=0.05, directory=str(tmp_path))
+
+    assert first.acquire(GOOGLE_STS) == 0.0
+    assert second.acquire(GOOGLE_STS) == 0.0
+    with pytest.raises(RateLimitExceeded):
+        first.acquire(GOOGLE_STS)
+
+
+def test_token_service_calls_are_admitted(fake, make_token_service):
+    """
+    Every Google STS and IAM Credentials call of a mint goes through the limiter
+    """
+    limiter = RateLimiter()
+
+    token_service = make_token_service(fake, rate_limiter=limiter)
+    token_service.get_token()
+    token_service.get_token(force_refresh=True)
+
+    stats = limiter.stats()
+    assert stats[GOOGLE_STS]["admitted"] == 1
+    assert stats[IAM_CREDENTIALS]["admitted"] == 2
@@ -0,0 +1,106 @@
+"""
+Unit tests for single-flight and background token refresh.
+"""
+
+import datetime
+import threading
+import time
+from unittest import mock
+
+from scalesec_gcp_workload_identity.cache import CachedToken, utcnow #pylint: disable=import-error
+from scalesec_gcp_workload_identity.refresher import BackgroundRefresher #pylint: disable=import-error
+
+
+def _token(seconds: float, lifetime: float = 3600) -> CachedToken:
+    now = utcnow()
+    expires_at = now + datetime.timedelta(seconds=seconds)
+    issued_at = expires_at - datetime.timedelta(seconds=lifetime)
+    expire_time = expires_at.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return CachedToken("ya29.token", expire_time, expires_at, issued_at)
+
+
+def test_concurrent_callers_share_one_mint(make_token_service):
+    """
+    Many threads hitting an empty cache should trigger a single mint
+    """
+    token_service = make_token_service()
+
+    def slow_mint():
+        time.sleep(0.2)
+        return _token(3600)
+
+    with mock.patch.object(token_service, "_mint_token", side_effect=slow_mint) as mint:
+        threads = [threading.Thread(target=token_service.get_token) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert mint.call_count == 1
+
+
+def test_valid_token_served_during_refresh(make_token_service):
+    """
+    Callers should not wait on an in-flight refresh while the token is still valid
+    """
+    token_service = make_token_service()
+    token_service.token_cache.set(token_service._cache_key(), _token(60)) #pylint: disable=protected-access
+
+    with token_service._refresh_lock: #pylint: disable=protected-access
+        sa_token, _ = token_service.get_token()
+
+    assert sa_token == "ya29.token"
+
+
+def test_token_inside_skew_is_renewed_without_blocking(make_token_service):
+    """
+    The first caller to see a valid token inside the skew does not wait on the mint
+    """
+    token_service = make_token_service()
+    token_service.token_cache.set(token_service._cache_key(), _token(60)) #pylint: disable=protected-access
+    renewed = CachedToken("ya29.renewed", *_token(3600)[1:])
+
+    def slow_mint():
+        time.sleep(0.5)
+        return renewed
+
+    with mock.patch.object(token_service, "_mint_token", side_effect=slow_mint) as mint:
+        started = time.monotonic()
+        sa_token, _ = token_service.get_token()
+        assert time.monotonic() - started < 0.25
+        token_service._background_refresh.join() #pylint: disable=protected-access
+
+    assert sa_token == "ya29.token"
+    assert token_service.get_token()[0] == "ya29.renewed"
+    assert mint.call_count == 1
+
+
+def test_jitter_is_drawn_once_per_token(make_token_service):
+    """
+    Waking up early does not move the refresh point of the same token
+    """
+    token_service = make_token_service()
+    token_service.token_cache.set(token_service._cache_key(), _token(3000)) #pylint: disable=protected-access
+    refresher = BackgroundRefresher(token_service, refresh_fraction=0.5, jitter=0.5)
+
+    first = refresher._seconds_until_refresh() #pylint: disable=protected-access
+    for _ in range(20):
+        assert abs(refresher._seconds_until_refresh() - first) < 1 #pylint: disable=protected-access
+
+
+def test_background_refresh_renews_token(make_token_service):
+    """
+    A token past its refresh fraction should be renewed without any caller
+    """
+    token_service = make_token_service()
+    token_service.token_cache.set(token_service._cache_key(), _token(10, lifetime=100)) #pylint: disable=protected-access
+
+    with mock.patch.object(token_service, "_mint_token", return_value=_token(3600)) as mint:
+        token_service.start_background_refresh(refresh_fraction=0.5, jitter=0.0)
+        for _ in range(50):
+            if mint.called:
+                break
+            time.sleep(0.05)
+        token_service.stop_background_refresh(timeout=1)
+
+    assert mint.call_count == 1
@@ -0,0 +1,132 @@
+"""
+Unit tests for retries, hedging and clock skew re-signing.
+"""
+
+import datetime
+import threading
+import time
+from unittest import mock
+
+import pytest #pylint: disable=import-error
+import requests #pylint: disable=import-error
+
+from benchmarks.fakes import ( #pylint: disable=import-error
+    GOOGLE_STS,
+    IAM_CREDENTIALS,
+    UpstreamBehaviour
+)
+from scalesec_gcp_workload_identity.retry import ( #pylint: disable=import-error
+    RetryPolicy,
+    call_with_retries,
+    retry_after_seconds
+)
+from scalesec_gcp_workload_identity.utils import Utils #pylint: disable=import-error
+
+
+class StatusError(Exception):
+    """
+    An HTTP error carrying a response with a status code and headers
+    """
+    def __init__(self, status_code, headers=None):
+        super().__init__(status_code)
+        self.response = mock.Mock(status_code=status_code, headers=headers or {})
+
+
+def test_retry_delay():
+    """
+    Only transient statuses are retried, with capped backoff and Retry-After honoured
+    """
+    policy = RetryPolicy(max_attempts=4, initial_backoff=0.1, max_backoff=0.3)
+
+    assert policy.retry_delay(StatusError(400), 1) is None
+    assert policy.retry_delay(StatusError(503), 4) is None
+    assert 0 <= policy.retry_delay(StatusError(503), 1) <= 0.1
+    assert 0 <= policy.retry_delay(StatusError(429), 3) <= 0.3
+    assert policy.retry_delay(StatusError(429, {"Retry-After": "0.25"}), 1) == 0.25
+    assert policy.retry_delay(StatusError(429, {"Retry-After": "60"}), 1) == 0.3
+
+
+def test_retry_after_http_date():
+    """
+    Retry-After may be an HTTP date
+    """
+    later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    err = StatusError(503, {"Retry-After": later.strftime("%a, %d %b %Y %H:%M:%S GMT")})
+
+    assert 25 <= retry_after_seconds(err) <= 30
+
+
+def test_html_error_page_is_retryable():
+    """
+    A 502 page from the Google front end raises a retryable HTTPError, not a JSON error
+    """
+    response = requests.Response()
+    response.status_code = 502
+    response.url = "https://sts.googleapis.com/v1beta/token"
+    response._content = b"<html><title>502 Bad Gateway</title></html>" #pylint: disable=protected-access
+
+    with pytest.raises(requests.HTTPError) as error:
+        Utils._parse_federated_token_response(response) #pylint: disable=protected-access
+    assert RetryPolicy().retry_delay(error.value, 1) is not None
+
+
+def test_transient_failures_are_retried(fake, make_token_service):
+    """
+    A 503 from Google STS and one from IAM Credentials cost one extra call each
+    """
+    fake.behaviours[GOOGLE_STS] = UpstreamBehaviour(fail_next=1)
+    fake.behaviours[IAM_CREDENTIALS] = UpstreamBehaviour(fail_next=1)
+    token_service = make_token_service(fake, retry_policy=RetryPolicy(initial_backoff=0.01))
+
+    sa_token, _ = token_service.get_token()
+
+    assert sa_token.startswith("ya29.fake.")
+    assert fake.calls[GOOGLE_STS] == fake.calls[IAM_CREDENTIALS] == 2
+
+
+def test_clock_skew_is_corrected(fake, make_token_service):
+    """
+    A subject token rejected for its date is re-signed with the server's clock
+    """
+    fake.clock_offset = 3600
+    token_service = make_token_service(fake)
+
+    sa_token, _ = token_service.get_token()
+
+    assert sa_token.startswith("ya29.fake.")
+    assert fake.calls[GOOGLE_STS] == 2
+    assert 3590 <= token_service.clock_offset.total_seconds() <= 3610
+
+
+def test_clock_skew_without_resigns_fails(fake, make_token_service):
+    """
+    max_resigns=0 surfaces the rejection
+    """
+    fake.clock_offset = 3600
+
+    with pytest.raises(Exception):
+        make_token_service(fake, retry_policy=RetryPolicy(max_resigns=0)).get_token()
+
+
+def test_hedged_request_wins():
+    """
+    A slow first attempt is raced by a hedged request
+    """
+    calls = []
+    lock = threading.Lock()
+
+    def upstream():
+        with lock:
+            calls.append(1)
+            first = len(calls) == 1
+        if first:
+            time.sleep(1)
+            return "slow"
+        return "fast"
+
+    start = time.perf_counter()
+    result = call_with_retries(RetryPolicy(hedge_after=0.05), (), "sa_token", upstream)
+
+    assert result == "fast"
+    assert len(calls) == 2
+    assert time.perf_counter() - start < 0.5
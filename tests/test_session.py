@@ -0,0 +1,43 @@
+"""
+Unit tests for the pooled HTTP sessions.
+"""
+
+import socket
+
+from scalesec_gcp_workload_identity.session import ( #pylint: disable=import-error
+    build_session,
+    get_shared_session
+)
+
+
+def test_session_is_shared_between_token_services(make_token_service):
+    """
+    TokenServices in the same process should reuse one connection pool
+    """
+    first = make_token_service()
+    second = make_token_service()
+
+    assert first.utils.session is second.utils.session
+    assert first.utils.session is get_shared_session()
+
+
+def test_injected_session_is_used(make_token_service):
+    """
+    A caller supplied session takes precedence over the shared one
+    """
+    session = build_session(pool_maxsize=2)
+    token_service = make_token_service(http_session=session, http_timeout=3)
+
+    assert token_service.utils.session is session
+    assert token_service.utils.http_timeout == 3
+
+
+def test_pool_size_and_keepalive():
+    """
+    The adapter should honour the pool size and enable TCP keep-alive
+    """
+    adapter = build_session(pool_maxsize=4).get_adapter("https://sts.googleapis.com")
+
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == 4
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in \
+        adapter.poolmanager.connection_pool_kw["socket_options"]
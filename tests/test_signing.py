@@ -0,0 +1,63 @@
+"""
+Unit tests for the precomputed caller identity token.
+"""
+
+import datetime
+import json
+import urllib.parse
+from unittest import mock
+
+from botocore.credentials import ReadOnlyCredentials #pylint: disable=import-error
+
+from scalesec_gcp_workload_identity.signing import CallerIdentityTokenBuilder #pylint: disable=import-error
+from scalesec_gcp_workload_identity.utils import Utils #pylint: disable=import-error
+
+HOST = "sts.eu-west-1.amazonaws.com"
+TARGET = "//iam.googleapis.com/projects/1/locations/global/workloadIdentityPools/p/providers/a"
+CREDENTIALS = ("ASIAEXAMPLE", "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY", "session/token+==")
+NOW = datetime.datetime(2021, 3, 4, 5, 6, 7, tzinfo=datetime.timezone.utc)
+
+
+def _botocore_token() -> dict:
+    utils = Utils("1", "role", "eu-west-1", "POST", HOST, "sa@p.iam.gserviceaccount.com",
+                  sts_region="eu-west-1")
+    credentials = ReadOnlyCredentials(*CREDENTIALS)
+    x_amz_date = NOW.strftime('%Y%m%dT%H%M%SZ')
+
+    with mock.patch("botocore.auth.get_current_datetime", return_value=NOW.replace(tzinfo=None)):
+        authorization_header = utils._generate_auth_header(x_amz_date, credentials) #pylint: disable=protected-access
+
+    return utils._generate_caller_identity_token( #pylint: disable=protected-access
+        authorization_header,
+        x_amz_date,
+        TARGET,
+        credentials
+        )
+
+
+def test_matches_botocore_signature():
+    """
+    The prebuilt token must be identical to the one signed by botocore
+    """
+    builder = CallerIdentityTokenBuilder(HOST, "eu-west-1", TARGET)
+    expected = _botocore_token()
+
+    subject_token = builder.build(CREDENTIALS, now=NOW)
+
+    assert json.loads(urllib.parse.unquote(subject_token)) == expected
+    assert subject_token == urllib.parse.quote(json.dumps(expected))
+
+
+def test_signing_key_cached_per_day():
+    """
+    The signing key is derived once per secret and day
+    """
+    builder = CallerIdentityTokenBuilder(HOST, "eu-west-1", TARGET)
+    builder.build(CREDENTIALS, now=NOW)
+    first_key = builder.signing_key(CREDENTIALS[1], "20210304")
+
+    builder.build(CREDENTIALS, now=NOW + datetime.timedelta(minutes=5))
+    assert builder.signing_key(CREDENTIALS[1], "20210304") is first_key
+
+    builder.build(CREDENTIALS, now=NOW + datetime.timedelta(days=1))
+    assert list(builder._signing_keys) == [(CREDENTIALS[1], "20210305")] #pylint: disable=protected-access
@@ -0,0 +1,106 @@
+"""
+Unit tests for the Utils helpers.
+"""
+
+import datetime
+import json
+import urllib.parse
+from unittest import mock
+
+from scalesec_gcp_workload_identity.utils import Utils, sts_host #pylint: disable=import-error
+
+
+def _utils() -> Utils:
+    return Utils(
+        "123456789123",
+        "role",
+        "us-east-1",
+        "POST",
+        "sts.amazonaws.com",
+        "sa@project.iam.gserviceaccount.com",
+        aws_session_duration=900
+    )
+
+
+def _assume_role_response(seconds: int) -> dict:
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+    return {
+        "Credentials": {
+            "AccessKeyId": "AKIAEXAMPLE",
+            "SecretAccessKey": "secret",
+            "SessionToken": "session",
+            "Expiration": expiration
+        }
+    }
+
+
+def test_assume_role_credentials_are_reused():
+    """
+    AssumeRole should only be called once while the credentials are valid
+    """
+    utils = _utils()
+    utils.sts_client = sts_client = mock.Mock()
+    sts_client.assume_role.return_value = _assume_role_response(3600)
+
+    first = utils._assume_role() #pylint: disable=protected-access
+    second = utils._assume_role() #pylint: disable=protected-access
+
+    assert first == second == ("AKIAEXAMPLE", "secret", "session")
+    sts_client.assume_role.assert_called_once_with(
+        RoleArn="arn:aws:iam::123456789123:role/role",
+        RoleSessionName="role",
+        DurationSeconds=900
+    )
+
+
+def test_assume_role_refreshes_near_expiry():
+    """
+    Credentials inside the refresh skew should be replaced
+    """
+    utils = _utils()
+    utils.sts_client = sts_client = mock.Mock()
+    sts_client.assume_role.return_value = _assume_role_response(60)
+
+    utils._assume_role() #pylint: disable=protected-access
+    utils._assume_role() #pylint: disable=protected-access
+
+    assert sts_client.assume_role.call_count == 2
+
+
+def test_sts_client_is_shared():
+    """
+    The STS client is created lazily and shared between Utils instances
+    """
+    first, second = _utils(), _utils()
+
+    assert first._sts_client is None #pylint: disable=protected-access
+    assert first.sts_client is second.sts_client
+
+
+def test_regional_sts_endpoint(make_token_service):
+    """
+    The signed request, caller identity token and STS client follow aws_region
+    """
+    token_service = make_token_service(aws_region="eu-west-1")
+    utils = token_service.utils
+    utils._assumed_credentials = ("ASIAEXAMPLE", "secret", "session") #pylint: disable=protected-access
+    utils._assumed_credentials_expiration = datetime.datetime.max.replace( #pylint: disable=protected-access
+        tzinfo=datetime.timezone.utc)
+
+    subject_token = token_service._subject_token() #pylint: disable=protected-access
+    caller_identity_token = json.loads(urllib.parse.unquote(subject_token))
+    headers = {header["key"]: header["value"] for header in caller_identity_token["headers"]}
+
+    assert caller_identity_token["url"].startswith("https://sts.eu-west-1.amazonaws.com?")
+    assert headers["host"] == "sts.eu-west-1.amazonaws.com"
+    assert "/eu-west-1/sts/aws4_request" in headers["Authorization"]
+    assert utils.sts_client.meta.endpoint_url == "https://sts.eu-west-1.amazonaws.com"
+
+
+def test_sts_host():
+    """
+    Global, commercial and China partition hosts
+    """
+    assert sts_host(None) == sts_host("global") == "sts.amazonaws.com"
+    assert sts_host("us-west-2") == "sts.us-west-2.amazonaws.com"
+    assert sts_host("cn-north-1") == "sts.cn-north-1.amazonaws.com.cn"